@@ -0,0 +1,12 @@
+import os
+
+
+def setup(settings_module='sql_util.tests.test_sqlite_settings'):
+    """
+    Configure Django for running a benchmark outside of the test runner. The
+    benchmarks use the test models, so they default to the sqlite test settings.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+
+    import django
+    django.setup()
@@ -0,0 +1,261 @@
+"""
+Benchmark aggregates computed with joins (Count('child') etc.) against the
+sql_util subquery versions, on the test models.
+
+For each data size, the tables are filled with that many outer rows (parents,
+authors, sellers, teams) and a fixed number of related rows per outer row. Each
+case is then timed in each variant:
+
+    join          Django's aggregate over a join, with GROUP BY
+    subquery      the sql_util expression, as a correlated subquery
+    grouped_join  the sql_util expression with strategy='grouped_join'
+
+Two times are reported: `compile`, building the queryset and compiling it to
+SQL in Python, and `execute`, running the SQL and fetching the rows. The
+variants of a case must return the same rows.
+
+The results are printed as JSON. With --baseline, a previous JSON output, times
+more than --threshold times the baseline are reported as regressions and the
+exit status is 1.
+
+Run with:
+
+    python -m benchmarks.aggregates [--sizes 100,1000] [--fanout 5] [--number 5]
+                                    [--settings sql_util.tests.test_sqlite_settings]
+                                    [--baseline baseline.json] [--threshold 1.5] [--output results.json]
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import timeit
+from datetime import date, datetime, timedelta
+
+from benchmarks import setup
+
+
+def get_cases():
+    """
+    Return {case: {variant: function returning a queryset}}. The querysets are
+    ordered so the variants' rows can be compared.
+    """
+    from django.db.models import Count, Sum, Q
+    from sql_util.utils import SubqueryCount, SubquerySum, Exists
+    from sql_util.tests.models import Parent, Author, Seller, Team
+
+    return {
+        'parent_child_count': {
+            'join': lambda: Parent.objects.annotate(n=Count('da_child')).order_by('pk').values_list('pk', 'n'),
+            'subquery': lambda: (Parent.objects.annotate(n=SubqueryCount('da_child'))
+                                 .order_by('pk').values_list('pk', 'n')),
+            'grouped_join': lambda: (Parent.objects.annotate(n=SubqueryCount('da_child', strategy='grouped_join'))
+                                     .order_by('pk').values_list('pk', 'n')),
+        },
+        'author_book_count': {
+            'join': lambda: (Author.objects.annotate(n=Count('authored_books'))
+                             .order_by('pk').values_list('pk', 'n')),
+            'subquery': lambda: (Author.objects.annotate(n=SubqueryCount('authored_books'))
+                                 .order_by('pk').values_list('pk', 'n')),
+            'grouped_join': lambda: (Author.objects.annotate(n=SubqueryCount('authored_books',
+                                                                             strategy='grouped_join'))
+                                     .order_by('pk').values_list('pk', 'n')),
+        },
+        'seller_sale_count_sum': {
+            # Two aggregates over the same join, the case that needs no distinct
+            'join': lambda: (Seller.objects.annotate(n=Count('sale'), total=Sum('sale__revenue'))
+                             .order_by('pk').values_list('pk', 'n', 'total')),
+            'subquery': lambda: (Seller.objects.annotate(n=SubqueryCount('sale'),
+                                                         total=SubquerySum('sale__revenue'))
+                                 .order_by('pk').values_list('pk', 'n', 'total')),
+            'grouped_join': lambda: (Seller.objects.annotate(n=SubqueryCount('sale', strategy='grouped_join'),
+                                                             total=SubquerySum('sale__revenue',
+                                                                               strategy='grouped_join'))
+                                     .order_by('pk').values_list('pk', 'n', 'total')),
+        },
+        'team_game_counts': {
+            # Aggregates over two joins multiply each other's rows, so the join
+            # version needs distinct
+            'join': lambda: (Team.objects.annotate(home=Count('team1_game', distinct=True),
+                                                   away=Count('team2_game', distinct=True))
+                             .order_by('pk').values_list('pk', 'home', 'away')),
+            'subquery': lambda: (Team.objects.annotate(home=SubqueryCount('team1_game'),
+                                                       away=SubqueryCount('team2_game'))
+                                 .order_by('pk').values_list('pk', 'home', 'away')),
+            'grouped_join': lambda: (Team.objects.annotate(
+                home=SubqueryCount('team1_game', strategy='grouped_join'),
+                away=SubqueryCount('team2_game', strategy='grouped_join')
+            ).order_by('pk').values_list('pk', 'home', 'away')),
+        },
+        'parent_child_exists': {
+            'join': lambda: (Parent.objects.filter(da_child__name='child 0').distinct()
+                             .order_by('pk').values_list('pk', flat=True)),
+            'subquery': lambda: (Parent.objects.filter(Exists('da_child', filter=Q(name='child 0')))
+                                 .order_by('pk').values_list('pk', flat=True)),
+        },
+    }
+
+
+def bulk_create(model, objs):
+    """Create `objs` and return them with their primary keys, which Django < 4.0 doesn't set on SQLite"""
+    model.objects.bulk_create(objs)
+    return list(model.objects.order_by('pk'))
+
+
+def generate(size, fanout, seed=0):
+    """
+    Replace the rows of the benchmarked models with `size` outer rows, each
+    with up to 2 * `fanout` related rows.
+    """
+    from django.conf import settings
+    from django.utils.timezone import make_aware
+    from sql_util.tests.models import (Parent, Child, Author, Book, BookAuthor, Store, Seller, Sale, Team,
+                                       Game)
+
+    for model in (Child, Parent, BookAuthor, Book, Author, Sale, Seller, Store, Game, Team):
+        model.objects.all().delete()
+
+    rng = random.Random(seed)
+    related = [rng.randint(0, 2 * fanout) for _ in range(size)]
+    timestamp = datetime(2020, 1, 1)
+    if settings.USE_TZ:
+        timestamp = make_aware(timestamp)
+
+    parents = bulk_create(Parent, [Parent(name='parent %d' % i) for i in range(size)])
+    Child.objects.bulk_create([Child(parent=parent, name='child %d' % j, timestamp=timestamp)
+                               for parent, n in zip(parents, related) for j in range(n)])
+
+    authors = bulk_create(Author, [Author(name='author %d' % i) for i in range(size)])
+    books = bulk_create(Book, [Book(title='book %d' % i) for i in range(size)])
+    BookAuthor.objects.bulk_create([BookAuthor(author=author, book=rng.choice(books))
+                                    for author, n in zip(authors, related) for _ in range(n)])
+
+    store = Store.objects.create(name='store')
+    sellers = bulk_create(Seller, [Seller(store=store, name='seller %d' % i) for i in range(size)])
+    Sale.objects.bulk_create([Sale(seller=seller, date=date(2020, 1, 1) + timedelta(days=j),
+                                   revenue=rng.uniform(0, 100), expenses=rng.uniform(0, 10))
+                              for seller, n in zip(sellers, related) for j in range(n)])
+
+    teams = bulk_create(Team, [Team(name='team %d' % i) for i in range(size)])
+    Game.objects.bulk_create([Game(played=date(2020, 1, 1), team1=team, team2=rng.choice(teams))
+                              for team, n in zip(teams, related) for _ in range(n)])
+
+
+def time_compile(factory, connection, number):
+    def compile_queryset():
+        return factory().query.get_compiler(connection=connection).as_sql()
+    return min(timeit.repeat(compile_queryset, number=number, repeat=3)) / number
+
+
+def time_execute(factory, connection, number):
+    sql, params = factory().query.get_compiler(connection=connection).as_sql()
+
+    def execute():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+    return statistics.median(timeit.repeat(execute, number=1, repeat=number))
+
+
+def normalize(rows):
+    # Sums can differ in the last digits depending on the order rows are added
+    return [tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+            if isinstance(row, tuple) else row for row in rows]
+
+
+def run(sizes, fanout, number, using='default'):
+    from django.db import connections
+    connection = connections[using]
+
+    results = []
+    for size in sizes:
+        generate(size, fanout)
+        for case, variants in get_cases().items():
+            expected = None
+            for variant, factory in variants.items():
+                rows = normalize(list(factory()))
+                if expected is None:
+                    expected = rows
+                elif rows != expected:
+                    raise AssertionError('{} {} returned different rows than {}'.format(case, variant,
+                                                                                       list(variants)[0]))
+                results.append({
+                    'size': size,
+                    'case': case,
+                    'variant': variant,
+                    'rows': len(rows),
+                    'compile': time_compile(factory, connection, number * 20),
+                    'execute': time_execute(factory, connection, number),
+                })
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the results more than `threshold` times slower than the matching
+    result of `baseline`, a previous output, for either time.
+    """
+    previous = {(r['size'], r['case'], r['variant']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['size'], result['case'], result['variant']))
+        if before is None:
+            continue
+        for metric in ('compile', 'execute'):
+            if before[metric] and result[metric] / before[metric] > threshold:
+                regressions.append({
+                    'size': result['size'],
+                    'case': result['case'],
+                    'variant': result['variant'],
+                    'metric': metric,
+                    'baseline': before[metric],
+                    'result': result[metric],
+                    'ratio': result[metric] / before[metric],
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--settings', default='sql_util.tests.test_sqlite_settings', help='Define settings.')
+    parser.add_argument('--sizes', default='100,1000', help='Comma separated numbers of outer rows')
+    parser.add_argument('--fanout', default=5, type=int, help='Average number of related rows per outer row')
+    parser.add_argument('--number', default=5, type=int, help='Executions timed per variant')
+    parser.add_argument('--baseline', help='JSON output of a previous run to compare with')
+    parser.add_argument('--threshold', default=1.5, type=float,
+                        help='Slowdown relative to the baseline reported as a regression')
+    parser.add_argument('--output', help='Write the JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    setup(args.settings)
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        results = run([int(size) for size in args.sizes.split(',')], args.fanout, args.number)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    output = {
+        'vendor': connection.vendor,
+        'fanout': args.fanout,
+        'threshold': args.threshold,
+        'results': results,
+        'regressions': [],
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            output['regressions'] = compare(results, json.load(f), args.threshold)
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if output['regressions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
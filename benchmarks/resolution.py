@@ -0,0 +1,70 @@
+"""
+Micro-benchmark for resolving sql_util subqueries against outer querysets of
+increasing size.
+
+For each size, the outer queryset gets that many plain annotations and that many
+filters, then a SubqueryCount is resolved against it. We report the time and the
+peak memory allocated per resolution, next to what a full clone of the outer query
+costs, which is what resolving used to pay on top of building the subquery.
+
+Run with:
+
+    python -m benchmarks.resolution [--sizes 0,10,50,100] [--number 200]
+"""
+import argparse
+import timeit
+import tracemalloc
+
+from benchmarks import setup
+
+
+def build_outer_query(size):
+    from django.db.models import F, Q, Value, IntegerField
+    from sql_util.tests.models import Parent
+
+    queryset = Parent.objects.all()
+    for i in range(size):
+        queryset = queryset.annotate(**{'extra_%d' % i: Value(i, output_field=IntegerField()) + F('id')})
+        queryset = queryset.filter(Q(name__startswith='p%d' % i) | Q(da_child__name='c%d' % i))
+    return queryset.query
+
+
+def measure(func, number):
+    seconds = timeit.timeit(func, number=number) / number
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def run(sizes, number):
+    from sql_util.aggregates import SubqueryCount
+
+    rows = []
+    for size in sizes:
+        query = build_outer_query(size)
+        resolve_time, resolve_bytes = measure(lambda: SubqueryCount('da_child').resolve_expression(query), number)
+        clone_time, clone_bytes = measure(query.clone, number)
+        rows.append((size, resolve_time, resolve_bytes, clone_time, clone_bytes))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='0,10,50,100', help='Comma separated numbers of annotations/filters')
+    parser.add_argument('--number', default=200, type=int, help='Resolutions timed per size')
+    args = parser.parse_args()
+
+    setup()
+    rows = run([int(size) for size in args.sizes.split(',')], args.number)
+
+    print('{:>6} {:>14} {:>14} {:>14} {:>14}'.format('size', 'resolve (us)', 'resolve (B)', 'clone (us)', 'clone (B)'))
+    for size, resolve_time, resolve_bytes, clone_time, clone_bytes in rows:
+        print('{:>6} {:>14.1f} {:>14} {:>14.1f} {:>14}'.format(size, resolve_time * 1e6, resolve_bytes,
+                                                              clone_time * 1e6, clone_bytes))
+
+
+if __name__ == '__main__':
+    main()
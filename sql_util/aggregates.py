@@ -1,10 +1,43 @@
+import copy
+import json
+from collections.abc import Mapping
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
 from django.core.exceptions import FieldError
-from django.db.models import Q, F, QuerySet, BooleanField, Sum, Avg, ForeignKey
+from django.db.models import Q, F, QuerySet, BooleanField, Sum, Avg, ForeignKey, Aggregate, DateTimeField, JSONField
 from django.db.models import Subquery as DjangoSubquery, OuterRef, IntegerField, Min, Max, Count
 from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import ExpressionWrapper, OrderBy
+from django.db.models.functions import Trunc
+from django.db.models.lookups import Exact, GreaterThan, GreaterThanOrEqual, IsNull, LessThan, LessThanOrEqual
+from django.db.models.sql import Query
+from django.db.models.sql.where import AND, WhereNode
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.hashable import make_hashable
+
+from sql_util.cache import fragment_cache, path_cache
+from sql_util.instrumentation import instrumented
+from sql_util.joins import (AggregateJoin, AutoAggregateJoin, LateralAggregateJoin, FirstJoin, LateralFirstJoin,
+                            KeysJoin, JoinedColumn, KEY_COLUMN)
+from sql_util.strategy import SUBQUERY, GROUPED_JOIN, LATERAL, SEMI_JOIN, ANTI_JOIN, AUTO, choose_strategy
+
+STRATEGIES = (SUBQUERY, GROUPED_JOIN, LATERAL, AUTO)
+JOIN_CLASSES = {GROUPED_JOIN: AggregateJoin, LATERAL: LateralAggregateJoin, AUTO: AutoAggregateJoin}
+EXISTS_STRATEGIES = (SUBQUERY, SEMI_JOIN, ANTI_JOIN, AUTO)
+FIRST_STRATEGIES = (SUBQUERY, GROUPED_JOIN, LATERAL)
+FIRST_JOIN_CLASSES = {GROUPED_JOIN: FirstJoin, LATERAL: LateralFirstJoin}
 
 
 class Subquery(DjangoSubquery):
+    # By default the subquery selects from the shallowest model along the
+    # expression's path that has the columns it needs. When True, it selects
+    # from the model at the end of the path instead.
+    select_from_related_model = False
+    # Identifies the definition of the subquery in sql_util.cache.fragment_cache
+    fragment_key = None
+
     def __init__(self, queryset_or_expression, **extra):
         if isinstance(queryset_or_expression, QuerySet):
             self.queryset = queryset_or_expression
@@ -30,29 +63,161 @@ class Subquery(DjangoSubquery):
         # We can set it here because we now have access to the outer query object,
         # which is the first parameter of this method.
         if self.query is None or self.queryset is None:
-            # Don't pass allow_joins = False here
-            queryset = self.get_queryset(query.clone(), True, reuse, summarize)
-            self.queryset = queryset
-            self.query = queryset.query
+            self.fragment_key = self._get_fragment_key(query)
+            if self.fragment_key is not None:
+                self.query = self._get_cached_query(query, reuse, summarize)
+                # Set like the queryset, resolving the query of an outer
+                # queryset used as a subquery resolves its expressions again.
+                self.queryset = QuerySet(model=self.query.model, query=self.query)
+            else:
+                # Don't pass allow_joins = False here
+                queryset = self.get_queryset(self._get_resolution_query(query), True, reuse, summarize)
+                self.queryset = queryset
+                self.query = queryset.query
         return super(Subquery, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
 
+    def _get_fragment_key(self, query):
+        """
+        Return what the inner query built for the outer `query` depends on, or
+        None when the SQL_UTIL_FRAGMENT_CACHE setting is off or the expression
+        can't be part of a key, e.g. a filter on an unhashable value.
+        """
+        if not getattr(settings, 'SQL_UTIL_FRAGMENT_CACHE', False) or getattr(self, 'expression', None) is None:
+            return None
+        key = (query.model, self.identity)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @property
+    def identity(self):
+        """
+        What the subquery computes: the subqueries with the same identity over
+        the same outer query are the same SQL, and compare equal. Subqueries of
+        querysets are only equal to themselves.
+        """
+        if getattr(self, 'expression', None) is None:
+            return None
+        extra = {name: value for name, value in self.extra.items() if name != 'output_field'}
+        return (type(self), self.expression, self.filter, self.distinct, self.outer_ref, self.unordered,
+                make_hashable(getattr(self, 'aggregate', None)), make_hashable(getattr(self, 'ordering', None)),
+                getattr(self, 'negated', None), getattr(self, 'strategy', None), getattr(self, 'cap', None),
+                make_hashable(extra))
+
+    def __eq__(self, other):
+        if not isinstance(other, Subquery):
+            return NotImplemented
+        identity = self.identity
+        if identity is None or other.identity is None:
+            return self is other
+        return identity == other.identity
+
+    def __hash__(self):
+        identity = self.identity
+        if identity is None:
+            return id(self)
+        try:
+            return hash(identity)
+        except TypeError:
+            # e.g. a filter on a list, equal subqueries still have the same hash
+            return hash((type(self), self._get_lookup_name()))
+
+    def _get_cached_query(self, query, reuse, summarize):
+        """
+        Return a copy of the inner query for self.fragment_key, building it on
+        the first call, which skips building a queryset for each resolution.
+        """
+        entry = fragment_cache.get(('query', self.fragment_key))
+        if entry is None:
+            queryset = self.get_queryset(self._get_resolution_query(query), True, reuse, summarize)
+            entry = (queryset.query, self.output_field)
+            fragment_cache.set(('query', self.fragment_key), entry)
+        inner_query, output_field = entry
+        if not self.output_field:
+            self._output_field = self.output_field = output_field
+
+        inner_query = inner_query.clone()
+        # Resolving against the outer query replaces the lookups' OuterRefs in
+        # place, the cached query's lookups must not be shared.
+        inner_query.where = _copy_where(inner_query.where)
+        return inner_query
+
+    @instrumented
+    def as_sql(self, compiler, connection, template=None, **extra_context):
+        """
+        With the SQL_UTIL_FRAGMENT_CACHE setting on, the SQL and params are kept
+        in sql_util.cache.fragment_cache and reused when the same subquery is
+        compiled for the same aliases of the outer query on the same database.
+        """
+        if self.fragment_key is None or extra_context:
+            return super(Subquery, self).as_sql(compiler, connection, template, **extra_context)
+        key = ('sql', self.fragment_key, connection.alias, template, self.template, self.query.alias_prefix,
+               tuple(self.query.alias_map), tuple(sorted(self.query.external_aliases.items())))
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            sql, params = super(Subquery, self).as_sql(compiler, connection, template, **extra_context)
+            fragment = (sql, tuple(params))
+            fragment_cache.set(key, fragment)
+        return fragment
+
+    def _get_resolution_query(self, query):
+        """
+        Return the query that self.expression is resolved against to find the
+        models and fields along its path.
+
+        Only the outer model's metadata is needed for that, and resolving adds
+        joins to the query it is given, so we use an empty query on the outer
+        model instead of cloning the outer query with all of its filters,
+        annotations and joins.
+        """
+        return Query(query.model)
+
     def get_queryset(self, query, allow_joins, reuse, summarize):
         # This is a customization hook for child classes to override the base queryset computed automatically
         return self._get_base_queryset(query, allow_joins, reuse, summarize)
 
     def _get_base_queryset(self, query, allow_joins, reuse, summarize):
-        resolved_expression = self.expression.resolve_expression(query, allow_joins, reuse, summarize)
-        model = self._get_model_from_resolved_expression(resolved_expression)
-
-        reverse, outer_ref = self._get_reverse_outer_ref_from_expression(model, query)
+        model, reverse, outer_ref = self._resolve_path(query, allow_joins, reuse, summarize)
 
-        outer_ref = self.outer_ref or outer_ref
         q = self.filter & Q(**{reverse: OuterRef(outer_ref)})
         queryset = model._default_manager.filter(q)
         if self.unordered:
             queryset = queryset.order_by()
         return queryset.values(reverse)
 
+    def _resolve_path(self, query, allow_joins, reuse, summarize):
+        """
+        Return (model, reverse, outer_ref) for this expression in the outer query:
+        the model the subquery selects from, the lookup from that model back to
+        the outer model, and the outer field the subquery is correlated with.
+
+        Walking the relation path is relatively expensive and the answer only
+        depends on the outer model and the lookup, so it is kept in a process
+        wide cache, see sql_util.cache.path_cache.
+        """
+        key = (query.model, self._get_lookup_name(), self.outer_ref, self.select_from_related_model)
+        resolved_path = path_cache.get(key)
+        if resolved_path is None:
+            if self.select_from_related_model:
+                path, _, _, _ = query.names_to_path(self._get_lookup_name().split(LOOKUP_SEP), query.get_meta(),
+                                                    allow_many=True, fail_on_missing=True)
+                model = path[-1].to_opts.model
+            else:
+                resolved_expression = self.expression.resolve_expression(query, allow_joins, reuse, summarize)
+                model = self._get_model_from_resolved_expression(resolved_expression)
+            reverse, outer_ref = self._get_reverse_outer_ref_from_expression(model, query)
+            resolved_path = (model, reverse, self.outer_ref or outer_ref)
+            path_cache.set(key, resolved_path)
+        return resolved_path
+
+    def _get_lookup_name(self):
+        source = self.expression
+        while hasattr(source, 'get_source_expressions'):
+            source = source.get_source_expressions()[0]
+        return source.name
+
     def _get_model_from_resolved_expression(self, resolved_expression):
         """
         Retrieve the correct model from the resolved_expression.
@@ -95,10 +260,7 @@ class Subquery(DjangoSubquery):
         return fields, model
 
     def _get_reverse_outer_ref_from_expression(self, model, query):
-        source = self.expression
-        while hasattr(source, 'get_source_expressions'):
-            source = source.get_source_expressions()[0]
-        field_list = source.name.split(LOOKUP_SEP)
+        field_list = self._get_lookup_name().split(LOOKUP_SEP)
         path, _, _, _ = query.names_to_path(field_list, query.get_meta(), allow_many=True, fail_on_missing=True)
 
         fields, model = self._get_fields_model_from_path(path, model, query.model)
@@ -115,6 +277,43 @@ class Subquery(DjangoSubquery):
 
         return reverse, outer_ref
 
+    def _resolve_to_target(self, resolved_expression, query, allow_joins, reuse, summarize):
+        if resolved_expression.get_source_expressions():
+            c = resolved_expression.copy()
+            c.is_summary = summarize
+            new_source_expressions = [self._resolve_to_target(source_expressions, query, allow_joins, reuse, summarize)
+                                      for source_expressions in resolved_expression.get_source_expressions()]
+            c.set_source_expressions(new_source_expressions)
+            return c
+
+        else:
+            try:
+                return F(resolved_expression.target.name).resolve_expression(query, allow_joins, reuse, summarize)
+            except (FieldError, AttributeError):
+                return resolved_expression
+
+
+def _copy_where(node):
+    # Lookups only have copy() from Django 4.0
+    children = [_copy_where(child) if hasattr(child, 'children') else copy.copy(child) for child in node.children]
+    return WhereNode(children, node.connector, node.negated)
+
+
+def _contains_outer_ref(value):
+    """Whether `value`, a Q, a Q's (lookup, value) child or an expression, refers to the outer query"""
+    if isinstance(value, OuterRef):
+        return True
+    if isinstance(value, Q):
+        return any(_contains_outer_ref(child) for child in value.children)
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], str):
+        return _contains_outer_ref(value[1])
+    if isinstance(value, (list, tuple)):
+        return any(_contains_outer_ref(item) for item in value)
+    # The aggregate of most subqueries is a class, e.g. Count
+    if hasattr(value, 'get_source_expressions') and not isinstance(value, type):
+        return any(_contains_outer_ref(source) for source in value.get_source_expressions() if source is not None)
+    return False
+
 
 class SubqueryAggregate(Subquery):
     """
@@ -135,17 +334,60 @@ class SubqueryAggregate(Subquery):
 
     queryset.annotate(min_field=SubqueryMin('field'))
 
+    `strategy` selects the SQL generated:
+
+    'subquery' (the default) is a correlated subquery evaluated for each row of
+    the outer query.
+
+    'grouped_join' computes the aggregate for all rows at once in a derived
+    table grouped by the related key, which is joined to the outer query. That
+    usually wins when the outer query returns many rows. Aggregates over the same
+    relation and filter share the derived table.
+
+    'lateral' moves the correlated subquery into a LEFT JOIN LATERAL, which lets
+    the planner pick how to evaluate it and computes aggregates over the same
+    relation and filter in one correlated scan. It is used on PostgreSQL and
+    MySQL 8.0.14+, other backends get the 'subquery' SQL.
+
+    'auto' picks between 'subquery' and 'grouped_join' when the outer query is
+    compiled, from EXPLAIN costs or the table sizes and the outer query's slice,
+    see sql_util.strategy.
+
+    Where the outer query can't have joins, e.g. in update(), the join
+    strategies fall back to a correlated subquery.
+
+    The default strategy can be changed with the SQL_UTIL_DEFAULT_STRATEGY setting.
     """
     aggregate = None  # Must be set by the subclass, or passed as kwarg
     unordered = None
+    strategy = None
 
     def __init__(self, *args, **extra):
         self.aggregate = extra.pop('aggregate', self.aggregate)
         self.ordering = extra.pop('ordering', None)
+        self.strategy = extra.pop('strategy', self.strategy)
         assert self.aggregate is not None, "Error: Attempt to instantiate a " \
                                            "SubqueryAggregate with no aggregate function"
+        if self.strategy is not None and self.strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy {!r}, expected one of {}'.format(self.strategy, ', '.join(STRATEGIES)))
         super(SubqueryAggregate, self).__init__(*args, **extra)
 
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        if self.get_strategy() in JOIN_CLASSES and allow_joins and not for_save:
+            return self._resolve_as_join(query, allow_joins, reuse, summarize)
+        return super(SubqueryAggregate, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+    def get_strategy(self):
+        strategy = self.strategy or getattr(settings, 'SQL_UTIL_DEFAULT_STRATEGY', SUBQUERY)
+        if strategy in (GROUPED_JOIN, AUTO) and self.refers_to_outer_query():
+            # The derived table is computed for all the outer rows at once
+            return SUBQUERY
+        return strategy
+
+    def refers_to_outer_query(self):
+        """Whether the filter or the aggregate use OuterRef"""
+        return _contains_outer_ref(getattr(self, 'filter', None)) or _contains_outer_ref(self.aggregate)
+
     def get_queryset(self, query, allow_joins, reuse, summarize):
         queryset = self._get_base_queryset(query, allow_joins, reuse, summarize)
         annotation = self._get_annotation(query, allow_joins, reuse, summarize)
@@ -162,7 +404,7 @@ class SubqueryAggregate(Subquery):
 
     def _get_annotation(self, query, allow_joins, reuse, summarize):
         resolved_expression = self.expression.resolve_expression(query, allow_joins, reuse, summarize)
-        model = self._get_model_from_resolved_expression(resolved_expression)
+        model, _, _ = self._resolve_path(query, allow_joins, reuse, summarize)
         queryset = model._default_manager.all()
         # resolved_expression was resolved in the outer query to get the model
         # target_expression is resolved in the subquery to get the field to aggregate
@@ -184,31 +426,247 @@ class SubqueryAggregate(Subquery):
 
         return annotation
 
-    def _resolve_to_target(self, resolved_expression, query, allow_joins, reuse, summarize):
-        if resolved_expression.get_source_expressions():
-            c = resolved_expression.copy()
-            c.is_summary = summarize
-            new_source_expressions = [self._resolve_to_target(source_expressions, query, allow_joins, reuse, summarize)
-                                      for source_expressions in resolved_expression.get_source_expressions()]
-            c.set_source_expressions(new_source_expressions)
-            return c
+    def _resolve_as_join(self, query, allow_joins, reuse, summarize):
+        """
+        Compute the aggregate in a derived table joined to the outer query, and
+        return a reference to its column.
+        """
+        resolution_query = self._get_resolution_query(query)
+        model, reverse, outer_ref = self._resolve_path(resolution_query, allow_joins, reuse, summarize)
+        aggregation = self._get_annotation(resolution_query, allow_joins, reuse, summarize)['aggregation']
+        join_class = JOIN_CLASSES[self.get_strategy()]
+        alias, column = join_class.add(query, (model, reverse, outer_ref, self.filter), aggregation)
+        output_field = self.output_field or query.alias_map[alias].output_field(column)
+        return JoinedColumn(alias, column, output_field, default=self.empty_value, source=self)
 
-        else:
-            try:
-                return F(resolved_expression.target.name).resolve_expression(query, allow_joins, reuse, summarize)
-            except (FieldError, AttributeError):
-                return resolved_expression
+    @property
+    def empty_value(self):
+        """The value of the aggregate over no rows, when it isn't NULL"""
+        aggregate = self.aggregate if isinstance(self.aggregate, type) else type(self.aggregate)
+        return 0 if issubclass(aggregate, Count) else None
+
+
+class RelatedAggregate(SubqueryAggregate):
+    """
+    A SubqueryAggregate where `aggregate` is an aggregate instance written
+    relative to the related model, e.g.
+
+    RelatedAggregate('sale', aggregate=Sum('revenue', filter=Q(expenses__gt=0)))
+
+    These are the members of SubqueryAggregates, which use the 'grouped_join'
+    strategy by default so the aggregates share one derived table.
+    """
+    unordered = True
+    select_from_related_model = True
+    strategy = GROUPED_JOIN
+
+    def __init__(self, *args, **extra):
+        super(RelatedAggregate, self).__init__(*args, **extra)
+        if self.empty_value is not None:
+            self.template = 'COALESCE((%(subquery)s), {})'.format(self.empty_value)
+
+    def _get_annotation(self, query, allow_joins, reuse, summarize):
+        if not self.output_field:
+            model, _, _ = self._resolve_path(query, allow_joins, reuse, summarize)
+            resolved = self.aggregate.resolve_expression(model._default_manager.all().query, allow_joins, reuse)
+            self._output_field = self.output_field = resolved.output_field
+        return {'aggregation': self.aggregate}
+
+
+class SubqueryAggregates(Mapping):
+    """
+    Several aggregates over the same relation, computed in a single pass over
+    the related rows instead of one correlated subquery each. The aggregates are
+    written relative to the related model and the mapping is unpacked into
+    annotate() to get one annotation per aggregate:
+
+    Seller.objects.annotate(**SubqueryAggregates('sale', n=Count('pk'), total=Sum('revenue')))
+
+    generates SQL like
+
+    SELECT seller.*, COALESCE(sale_agg.agg_1, 0) AS n, sale_agg.agg_2 AS total
+    FROM seller
+    LEFT OUTER JOIN (SELECT sale.seller_id AS sql_util_key, COUNT(sale.id) AS agg_1, SUM(sale.revenue) AS agg_2
+                     FROM sale GROUP BY sale.seller_id) sale_agg ON (seller.id = sale_agg.sql_util_key)
+
+    `filter` and `outer_ref` have the same meaning as for the other Subquery
+    classes and `strategy` as for SubqueryAggregate.
+    """
+    def __init__(self, expression, **aggregates):
+        extra = {key: aggregates.pop(key) for key in ('filter', 'outer_ref', 'strategy') if key in aggregates}
+        self.aggregates = {name: RelatedAggregate(expression, aggregate=aggregate, **extra)
+                           for name, aggregate in aggregates.items()}
+
+    def __getitem__(self, name):
+        return self.aggregates[name]
+
+    def __iter__(self):
+        return iter(self.aggregates)
+
+    def __len__(self):
+        return len(self.aggregates)
+
+
+class SubqueryPivot(SubqueryAggregates):
+    """
+    The aggregate of the related rows for each of the `values` of the `by`
+    field, one annotation per value, computed in one pass like
+    SubqueryAggregates:
+
+    Seller.objects.annotate(**SubqueryPivot('sale', by='status', values=['new', 'paid']))
+
+    annotates status_new and status_paid with the number of sales in each
+    status. `aggregate` is applied to `field` of the related model, e.g.
+    aggregate=Sum, field='revenue'. With a dict of values, its keys are the
+    names of the annotations.
+
+    Each value is a filtered aggregate, COUNT(...) FILTER (WHERE ...) where
+    the database supports it, e.g. PostgreSQL and SQLite 3.30+, and
+    COUNT(CASE WHEN ... THEN ... END) elsewhere.
+    """
+    def __init__(self, expression, by, values, aggregate=Count, field='pk', **extra):
+        if not isinstance(values, Mapping):
+            values = {'{}_{}'.format(by.replace(LOOKUP_SEP, '_'), value): value for value in values}
+        aggregates = {name: aggregate(field, filter=Q(**{by: value})) for name, value in values.items()}
+        super(SubqueryPivot, self).__init__(expression, **dict(aggregates, **extra))
 
 
 class SubqueryCount(SubqueryAggregate):
+    """
+    The number of related rows.
+
+    Comparisons with integers don't count all of them: n__gte=5 is true when
+    there's a 5th row, EXISTS(SELECT ... LIMIT 1 OFFSET 4), n=0 when there
+    isn't a 1st, and n=3 when there are 3 of the first 4.
+
+    With `cap`, the count stops at `cap` rows, e.g. to display "99+" with
+    cap=100:
+
+    (SELECT COUNT(*) FROM (SELECT child.id FROM child WHERE ... LIMIT 100) sql_util_capped)
+
+    These are correlated subqueries, the count is one whatever the strategy.
+    """
     template = 'COALESCE((%(subquery)s), 0)'
     aggregate = Count
     unordered = True
+    cap = None
 
     def __init__(self, expression, reverse='', *args, **kwargs):
         kwargs['output_field'] = kwargs.get('output_field', IntegerField())
+        self.cap = kwargs.pop('cap', self.cap)
         super(SubqueryCount, self).__init__(expression, reverse=reverse, *args, **kwargs)
 
+    def get_strategy(self):
+        if self.cap is not None:
+            return SUBQUERY
+        return super(SubqueryCount, self).get_strategy()
+
+    def get_lookup(self, lookup):
+        if lookup in COUNT_LOOKUPS:
+            return COUNT_LOOKUPS[lookup]
+        return super(SubqueryCount, self).get_lookup(lookup)
+
+    @instrumented
+    def as_sql(self, compiler, connection, template=None, **extra_context):
+        if self.cap is not None:
+            return self.as_capped_sql(compiler, connection, self.cap)
+        return super(SubqueryCount, self).as_sql(compiler, connection, template, **extra_context)
+
+    def get_rows_query(self, low, high):
+        """
+        The resolved query of the counted rows numbered low (from 0) to high,
+        excluded.
+        """
+        query = self.query.clone()
+        aggregation = query.annotations['aggregation']
+        target = aggregation.get_source_expressions()[0]
+        query.annotations = {}
+        query.set_annotation_mask(None)
+        query.group_by = None
+        query.default_cols = False
+        query.values_select = ()
+        query.selected = None
+        query.select = (target,)
+        if getattr(target, 'target', None) is None or target.target.null:
+            query.where.add(IsNull(target, False), AND)
+        query.distinct = bool(aggregation.distinct)
+        query.set_limits(low, high)
+        return query
+
+    def as_capped_sql(self, compiler, connection, cap):
+        sql, params = compiler.compile(self.get_rows_query(0, cap))
+        return '(SELECT COUNT(*) FROM {} {})'.format(sql, connection.ops.quote_name('sql_util_capped')), params
+
+    def as_at_least_sql(self, compiler, connection, number):
+        """Whether there are at least `number` rows"""
+        if self.distinct:
+            # SQLite drops the DISTINCT of an EXISTS subquery, even with an
+            # OFFSET
+            sql, params = self.as_capped_sql(compiler, connection, number)
+            return '{} = %s'.format(sql), tuple(params) + (number,)
+        sql, params = compiler.compile(self.get_rows_query(number - 1, number))
+        return 'EXISTS{}'.format(sql), params
+
+
+class CountThreshold(object):
+    """
+    A lookup comparing a SubqueryCount with an integer, compiled to stop
+    counting once the comparison is known.
+    """
+    def is_bounded(self):
+        """Whether the comparison stops counting, rather than comparing the count"""
+        # Counts of querysets, without an expression, are compared as they are
+        return (isinstance(self.lhs, SubqueryCount) and getattr(self.lhs, 'expression', None) is not None
+                and self.lhs.cap is None and self.lhs.query is not None
+                and isinstance(self.rhs, int) and not isinstance(self.rhs, bool))
+
+    def as_sql(self, compiler, connection):
+        if self.is_bounded():
+            sql = self.as_threshold_sql(compiler, connection, self.rhs)
+            if sql is not None:
+                return sql
+        return super(CountThreshold, self).as_sql(compiler, connection)
+
+    def at_least(self, compiler, connection, number, negated=False):
+        if number < 1:
+            return None
+        sql, params = self.lhs.as_at_least_sql(compiler, connection, number)
+        return ('NOT ({})'.format(sql) if negated else sql), params
+
+
+class CountExact(CountThreshold, Exact):
+    def as_threshold_sql(self, compiler, connection, value):
+        if value == 0:
+            return self.at_least(compiler, connection, 1, negated=True)
+        if value > 0:
+            sql, params = self.lhs.as_capped_sql(compiler, connection, value + 1)
+            return '{} = %s'.format(sql), tuple(params) + (value,)
+        return None
+
+
+class CountGreaterThan(CountThreshold, GreaterThan):
+    def as_threshold_sql(self, compiler, connection, value):
+        return self.at_least(compiler, connection, value + 1)
+
+
+class CountGreaterThanOrEqual(CountThreshold, GreaterThanOrEqual):
+    def as_threshold_sql(self, compiler, connection, value):
+        return self.at_least(compiler, connection, value)
+
+
+class CountLessThan(CountThreshold, LessThan):
+    def as_threshold_sql(self, compiler, connection, value):
+        return self.at_least(compiler, connection, value, negated=True)
+
+
+class CountLessThanOrEqual(CountThreshold, LessThanOrEqual):
+    def as_threshold_sql(self, compiler, connection, value):
+        return self.at_least(compiler, connection, value + 1, negated=True)
+
+
+COUNT_LOOKUPS = {lookup.lookup_name: lookup for lookup in (CountExact, CountGreaterThan, CountGreaterThanOrEqual,
+                                                           CountLessThan, CountLessThanOrEqual)}
+
 
 class SubqueryMin(SubqueryAggregate):
     aggregate = Min
@@ -230,25 +688,608 @@ class SubqueryAvg(SubqueryAggregate):
     unordered = True
 
 
+class JSONArrayAgg(Aggregate):
+    """
+    A JSON array with the JSON array of the expressions for each row, in the
+    order of the `ordering` expressions where the database supports ordered
+    aggregates.
+    """
+    function = 'json_group_array'
+    row_function = 'json_array'
+    template = '%(function)s(%(row_function)s(%(expressions)s)%(ordering)s)'
+    output_field = JSONField()
+
+    def __init__(self, *expressions, **extra):
+        self.ordering = extra.pop('ordering', ())
+        super(JSONArrayAgg, self).__init__(*expressions, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        extra_context.setdefault('row_function', self.row_function)
+        params = ()
+        if self.ordering and self.supports_ordering(connection):
+            compiled = [compiler.compile(expression) for expression in self.ordering]
+            extra_context['ordering'] = ' ORDER BY {}'.format(', '.join(sql for sql, _ in compiled))
+            params = tuple(param for _, expression_params in compiled for param in expression_params)
+        else:
+            extra_context['ordering'] = ''
+        sql, sql_params = super(JSONArrayAgg, self).as_sql(compiler, connection, **extra_context)
+        return sql, tuple(sql_params) + params
+
+    def supports_ordering(self, connection):
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 44)
+        return connection.vendor == 'postgresql'
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function='JSON_ARRAYAGG', row_function='JSON_ARRAY', **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function='json_agg', row_function='json_build_array',
+                           **extra_context)
+
+
+# The values SubqueryJSONAgg(decode=...) turns each row into
+JSON_ROW_DECODERS = {
+    None: list,
+    'tuples': tuple,
+    'dicts': dict,
+}
+
+
+def decode_json_rows(rows, fields, decode='tuples'):
+    """
+    Return the rows of a SubqueryJSONAgg, a list of JSON arrays, as tuples or
+    dicts of Python values. `fields` are the (name, model field) of the
+    columns, whose to_python() converts the JSON values, e.g. timestamps,
+    without instantiating the models.
+    """
+    decoded = []
+    for row in rows:
+        values = []
+        for (name, field), value in zip(fields, row):
+            if value is not None:
+                value = field.to_python(value)
+                if isinstance(field, DateTimeField) and settings.USE_TZ and timezone.is_naive(value):
+                    # The backends store and return datetimes in UTC
+                    value = timezone.make_aware(value, dt_timezone.utc)
+            values.append(value)
+        if decode == 'dicts':
+            decoded.append(dict(zip((name for name, _ in fields), values)))
+        else:
+            decoded.append(JSON_ROW_DECODERS[decode](values))
+    return decoded
+
+
+class JSONRowsField(JSONField):
+    """
+    The output field of SubqueryJSONAgg: a list of rows, with no related rows
+    an empty list rather than NULL.
+    """
+    def __init__(self, fields=(), decode=None, **kwargs):
+        self.row_fields = fields
+        self.decode = decode
+        super(JSONRowsField, self).__init__(**kwargs)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            value = json.loads(value)
+        if self.decode is None:
+            return value
+        return decode_json_rows(value, self.row_fields, self.decode)
+
+
+class SubqueryJSONAgg(SubqueryAggregate):
+    """
+    The related rows as a JSON array of the `fields`, relative to the related
+    model, of each row, optionally ordered by `ordering` and cut to the first
+    `limit` rows:
+
+    Parent.objects.annotate(children=SubqueryJSONAgg('da_child', fields=['name', 'timestamp'], ordering='timestamp'))
+
+    generates SQL like
+
+    (SELECT json_group_array(json_array(name, timestamp))
+     FROM (SELECT child.name, child.timestamp FROM child WHERE child.parent_id = parent.id ORDER BY timestamp) ...)
+
+    with JSON_ARRAYAGG on MySQL and json_agg on PostgreSQL, which fetches the
+    related rows in the same query, instead of prefetch_related's second query
+    and model instances. Rows are lists of the JSON values, with
+    decode='tuples' or 'dicts' they are converted to Python values by the
+    fields, see decode_json_rows().
+
+    The ordering is applied in the aggregate too, json_agg(... ORDER BY ...),
+    where the database supports it: PostgreSQL and SQLite 3.44+.
+
+    This is a correlated subquery whatever the strategy.
+    """
+    aggregate = JSONArrayAgg
+    unordered = True
+    # Prefixes of the names of the columns of the derived table
+    column_prefix = 'sql_util_json_'
+    ordering_prefix = 'sql_util_order_'
+    table_alias = 'sql_util_json'
+
+    def __init__(self, expression, fields=None, ordering=None, limit=None, decode=None, **extra):
+        if not fields:
+            raise ValueError('SubqueryJSONAgg requires fields')
+        if decode not in JSON_ROW_DECODERS:
+            raise ValueError('Unknown decode {!r}, expected one of {}'.format(
+                decode, ', '.join(repr(name) for name in JSON_ROW_DECODERS)))
+        if isinstance(ordering, str):
+            ordering = [ordering]
+        self.fields = tuple(fields)
+        self.limit = limit
+        self.decode = decode
+        super(SubqueryJSONAgg, self).__init__(expression, ordering=tuple(ordering or ()), **extra)
+
+    @property
+    def identity(self):
+        identity = super(SubqueryJSONAgg, self).identity
+        if identity is None:
+            return None
+        return identity + (self.fields, self.limit, self.decode)
+
+    def get_strategy(self):
+        return SUBQUERY
+
+    def get_queryset(self, query, allow_joins, reuse, summarize):
+        """The related rows, the JSON array is built around them in as_sql()"""
+        queryset = self._get_base_queryset(query, allow_joins, reuse, summarize)
+        columns = {self.column_prefix + str(index): F(field) for index, field in enumerate(self.fields)}
+        # The ordering fields are selected for the aggregate's ORDER BY
+        columns.update({column: F(name.lstrip('-')) for column, name in zip(self.get_ordering_columns(),
+                                                                          self.ordering)})
+        queryset = queryset.values(**columns).order_by(*self.get_order_by())
+        if self.limit is not None:
+            queryset = queryset[:self.limit]
+        if not self.output_field:
+            annotations = queryset.query.annotations
+            fields = [(name, annotations[column].output_field) for name, column in zip(self.fields, columns)]
+            self._output_field = self.output_field = JSONRowsField(fields=fields, decode=self.decode)
+        return queryset
+
+    def get_ordering_columns(self):
+        return [self.ordering_prefix + str(index) for index in range(len(self.ordering))]
+
+    def get_order_by(self):
+        """The ordering of the derived table, by its columns"""
+        return ['-' + column if name.startswith('-') else column
+                for column, name in zip(self.get_ordering_columns(), self.ordering)]
+
+    @instrumented
+    def as_sql(self, compiler, connection, template=None, **extra_context):
+        query = self.query
+        if self.ordering and not query.order_by:
+            # Django < 4.0 drops the ordering of subqueries without a slice
+            query = query.clone()
+            query.add_ordering(*self.get_order_by())
+        if connection.vendor == 'mysql' and query.order_by and query.high_mark is None:
+            # MySQL drops the ORDER BY of a derived table without LIMIT
+            query = query.clone()
+            query.set_limits(high=int(connection.ops.no_limit_value()))
+        rows_sql, rows_params = compiler.compile(query)
+        columns = [JoinedColumn(self.table_alias, name, annotation.output_field)
+                   for name, annotation in query.annotation_select.items() if name.startswith(self.column_prefix)]
+        ordering = [OrderBy(JoinedColumn(self.table_alias, column, None), descending=name.startswith('-'))
+                    for column, name in zip(self.get_ordering_columns(), self.ordering)]
+        aggregate_sql, aggregate_params = compiler.compile(JSONArrayAgg(*columns, ordering=ordering))
+        sql = '(SELECT {} FROM {} {})'.format(aggregate_sql, rows_sql, connection.ops.quote_name(self.table_alias))
+        return sql, tuple(aggregate_params) + tuple(rows_params)
+
+
+SERIES_BUCKETS = ('hour', 'day', 'week', 'month', 'quarter', 'year')
+# The number of months in the buckets that aren't a fixed length
+BUCKET_MONTHS = {'month': 1, 'quarter': 3, 'year': 12}
+
+
+def truncate_date(value, bucket):
+    """The start of the `bucket` containing the date or naive datetime `value`"""
+    if bucket == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    if isinstance(value, datetime):
+        value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        return value - timedelta(days=value.weekday())
+    if bucket == 'month':
+        return value.replace(day=1)
+    if bucket == 'quarter':
+        return value.replace(month=value.month - (value.month - 1) % 3, day=1)
+    if bucket == 'year':
+        return value.replace(month=1, day=1)
+    return value
+
+
+def next_bucket(value, bucket):
+    """The start of the bucket after the one starting at `value`"""
+    if bucket == 'hour':
+        return value + timedelta(hours=1)
+    if bucket in ('day', 'week'):
+        return value + timedelta(days=1 if bucket == 'day' else 7)
+    month = value.month - 1 + BUCKET_MONTHS[bucket]
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+class JSONSeriesField(JSONField):
+    """
+    The output field of SubquerySeries: the (bucket, value) pairs of the
+    buckets with rows, decoded into a value for each of `buckets`, a list of
+    (naive start, key) with `fill` for the buckets without rows.
+    """
+    def __init__(self, buckets=(), value_field=None, fill=0, as_dict=False, **kwargs):
+        self.buckets = buckets
+        self.value_field = value_field
+        self.fill = fill
+        self.as_dict = as_dict
+        super(JSONSeriesField, self).__init__(**kwargs)
+
+    def from_db_value(self, value, expression, connection):
+        if isinstance(value, str):
+            value = json.loads(value)
+        values = {}
+        for start, aggregate in value or []:
+            # Date buckets are returned as dates by some backends, e.g. SQLite on Django < 4.0
+            start = parse_datetime(start) or datetime.combine(parse_date(start), time())
+            if timezone.is_aware(start):
+                start = timezone.make_naive(start)
+            values[start] = self.value_field.to_python(aggregate) if aggregate is not None else None
+        series = []
+        for start, key in self.buckets:
+            value = values.get(start if isinstance(start, datetime) else datetime.combine(start, time()))
+            series.append((key, self.fill if value is None else value))
+        return dict(series) if self.as_dict else [value for _, value in series]
+
+
+class SubquerySeries(SubqueryJSONAgg):
+    """
+    The aggregate of the related rows for each `bucket` (hour, day, week,
+    month, quarter or year) of `date_field`, from the bucket of `start` to the
+    bucket of `end`, included, e.g. the revenue of each of the last 30 days:
+
+    Seller.objects.annotate(revenue=SubquerySeries('sale__revenue', date_field='date', start=today - timedelta(29),
+                                                   end=today))
+
+    The related rows are grouped by the database's truncation of the date, as
+    Django's Trunc, in one correlated subquery selecting the buckets with rows
+    as JSON:
+
+    (SELECT json_group_array(json_array(bucket, value))
+     FROM (SELECT DATE_TRUNC('day', sale.date) AS bucket, SUM(sale.revenue) AS value FROM sale
+           WHERE sale.seller_id = seller.id AND sale.date >= ... AND sale.date < ... GROUP BY 1) ...)
+
+    The value is a list with the aggregate of each bucket, `fill` for the
+    buckets without rows, or with `as_dict` a dict keyed by the start of the
+    buckets. Datetime buckets are in the current time zone.
+    """
+    aggregate = Sum
+
+    def __init__(self, expression, bucket='day', date_field='date', start=None, end=None, fill=0, as_dict=False,
+                 **extra):
+        if bucket not in SERIES_BUCKETS:
+            raise ValueError('Unknown bucket {!r}, expected one of {}'.format(bucket, ', '.join(SERIES_BUCKETS)))
+        if start is None or end is None:
+            raise ValueError('SubquerySeries requires a start and an end')
+        self.bucket = bucket
+        self.date_field = date_field
+        self.start = start
+        self.end = end
+        self.fill = fill
+        self.as_dict = as_dict
+        super(SubquerySeries, self).__init__(expression, fields=[date_field], **extra)
+
+    @property
+    def identity(self):
+        identity = super(SubquerySeries, self).identity
+        if identity is None:
+            return None
+        return identity + (self.bucket, self.date_field, self.start, self.end, self.fill, self.as_dict)
+
+    def get_buckets(self, datetimes):
+        """
+        The (start, key) of each bucket, the start a date or a naive datetime
+        in the current time zone and the key what the value is keyed by.
+        """
+        start, end = self.start, self.end
+        if datetimes:
+            start, end = (_naive_datetime(value) for value in (start, end))
+        else:
+            start, end = (value.date() if isinstance(value, datetime) else value for value in (start, end))
+        buckets = []
+        bucket = truncate_date(start, self.bucket)
+        while bucket <= end:
+            buckets.append((bucket, _aware_datetime(bucket) if datetimes else bucket))
+            bucket = next_bucket(bucket, self.bucket)
+        return buckets
+
+    def get_queryset(self, query, allow_joins, reuse, summarize):
+        """The related rows grouped by bucket, the JSON array is built around them in as_sql()"""
+        queryset = self._get_base_queryset(query, allow_joins, reuse, summarize)
+        aggregation = self._get_annotation(query, allow_joins, reuse, summarize)['aggregation']
+        model, _, _ = self._resolve_path(query, allow_joins, reuse, summarize)
+        datetimes = isinstance(model._meta.get_field(self.date_field), DateTimeField)
+        buckets = self.get_buckets(datetimes)
+        lower, upper = buckets[0][0], next_bucket(buckets[-1][0], self.bucket)
+        if datetimes:
+            lower, upper = _aware_datetime(lower), _aware_datetime(upper)
+
+        bucket_column, value_column = self.column_prefix + '0', self.column_prefix + '1'
+        queryset = (queryset.filter(**{self.date_field + '__gte': lower, self.date_field + '__lt': upper})
+                    .values(**{bucket_column: Trunc(self.date_field, self.bucket)})
+                    .annotate(**{value_column: aggregation})
+                    .order_by())
+        self._output_field = self.output_field = JSONSeriesField(
+            buckets=buckets, value_field=queryset.query.annotations[value_column].output_field, fill=self.fill,
+            as_dict=self.as_dict)
+        return queryset
+
+
+def _naive_datetime(value):
+    """`value`, a date or datetime, as a naive datetime in the current time zone"""
+    if not isinstance(value, datetime):
+        return datetime.combine(value, time())
+    if timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def _aware_datetime(value):
+    return timezone.make_aware(value) if settings.USE_TZ else value
+
+
+class SubqueryFirst(Subquery):
+    """
+    The value of an expression for the first related row in `ordering`, which
+    is a field name or a list of them, relative to the related model, with a
+    '-' prefix for descending order:
+
+    Parent.objects.annotate(first_child=SubqueryFirst('child__name', ordering='timestamp'))
+
+    The correlated subquery is SELECT ... ORDER BY ... LIMIT 1, which an index
+    on the related key and the ordering fields answers without reading the
+    other related rows. Rows ordered the same are returned in no particular
+    order, add the primary key to `ordering` to pick one.
+
+    `strategy` is one of:
+
+    'subquery' (the default), the correlated subquery.
+
+    'grouped_join', a derived table of the first row of every related key,
+    joined to the outer query. It is computed with DISTINCT ON where the
+    database supports it (PostgreSQL), with the ROW_NUMBER() window function
+    elsewhere.
+
+    'lateral', the correlated subquery in a LEFT JOIN LATERAL, which selects
+    the expressions of the SubqueryFirsts over the same relation and ordering
+    from one lookup of the first row. It is used on PostgreSQL and MySQL
+    8.0.14+, other backends get the 'subquery' SQL.
+
+    The SQL_UTIL_DEFAULT_STRATEGY setting applies when it is one of these.
+    """
+    unordered = None
+    strategy = None
+    # Whether `ordering` is reversed, to select the last row in it
+    reverse_ordering = False
+
+    def __init__(self, expression, ordering=None, **extra):
+        if not ordering:
+            raise ValueError('{} requires an ordering'.format(self.__class__.__name__))
+        if isinstance(ordering, str):
+            ordering = [ordering]
+        if self.reverse_ordering:
+            ordering = [name[1:] if name.startswith('-') else '-' + name for name in ordering]
+        self.ordering = tuple(ordering)
+        self.strategy = extra.pop('strategy', self.strategy)
+        if self.strategy is not None and self.strategy not in FIRST_STRATEGIES:
+            raise ValueError('Unknown strategy {!r}, expected one of {}'.format(self.strategy,
+                                                                               ', '.join(FIRST_STRATEGIES)))
+        super(SubqueryFirst, self).__init__(expression, **extra)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        if self.get_strategy() in FIRST_JOIN_CLASSES and allow_joins and not for_save:
+            return self._resolve_as_join(query, allow_joins, reuse, summarize)
+        return super(SubqueryFirst, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+    def get_strategy(self):
+        strategy = self.strategy or getattr(settings, 'SQL_UTIL_DEFAULT_STRATEGY', SUBQUERY)
+        if strategy == GROUPED_JOIN and _contains_outer_ref(getattr(self, 'filter', None)):
+            # The derived table is computed for all the outer rows at once
+            return SUBQUERY
+        return strategy if strategy in FIRST_STRATEGIES else SUBQUERY
+
+    def get_queryset(self, query, allow_joins, reuse, summarize):
+        queryset = self._get_base_queryset(query, allow_joins, reuse, summarize)
+        target = self._get_target(query, allow_joins, reuse, summarize)
+        return queryset.annotate(sql_util_first=target).order_by(*self.ordering).values('sql_util_first')[:1]
+
+    def _get_target(self, query, allow_joins, reuse, summarize):
+        """The expression resolved against the related model"""
+        resolved_expression = self.expression.resolve_expression(query, allow_joins, reuse, summarize)
+        model, _, _ = self._resolve_path(query, allow_joins, reuse, summarize)
+        target = self._resolve_to_target(resolved_expression, model._default_manager.all().query, allow_joins, reuse,
+                                         summarize)
+        if not self.output_field:
+            self._output_field = self.output_field = target.output_field
+        return target
+
+    def _resolve_as_join(self, query, allow_joins, reuse, summarize):
+        resolution_query = self._get_resolution_query(query)
+        model, reverse, outer_ref = self._resolve_path(resolution_query, allow_joins, reuse, summarize)
+        target = self._get_target(resolution_query, allow_joins, reuse, summarize)
+        join_class = FIRST_JOIN_CLASSES[self.get_strategy()]
+        alias, column = join_class.add(query, (model, reverse, outer_ref, self.filter, self.ordering), target)
+        return JoinedColumn(alias, column, self.output_field, source=self)
+
+
+class SubqueryLatest(SubqueryFirst):
+    """
+    The value of an expression for the last related row in `ordering`, e.g. the
+    status of the most recent child:
+
+    Parent.objects.annotate(status=SubqueryLatest('child__status', ordering='timestamp'))
+    """
+    reverse_ordering = True
+
+
 class Exists(Subquery):
+    """
+    EXISTS over a relation of the outer model, or over a queryset like Django's
+    Exists.
+
+    `strategy` selects the SQL generated for a relation:
+
+    'subquery' (the default) is a correlated EXISTS(...).
+
+    'semi_join' compares the outer column with the set of related keys,
+    outer.id IN (SELECT child.parent_id FROM child WHERE ...), which is computed
+    once rather than probed for each row of the outer query.
+
+    'anti_join' left joins the distinct related keys and tests the joined key,
+    ... WHERE child_keys.sql_util_key IS NULL for NOT EXISTS, which databases
+    without anti-join plans for NOT EXISTS or NOT IN run as a hash join. Where
+    joins aren't allowed, e.g. in update(), the semi-join is used instead.
+
+    'auto' picks between the two when the outer query is compiled, see
+    sql_util.strategy.
+
+    The default strategy can be changed with the SQL_UTIL_DEFAULT_EXISTS_STRATEGY
+    setting.
+
+    Exists over the same relation combined with | are one EXISTS of the OR of
+    their filters, and so are ~Exists combined with &:
+
+    Exists('child', filter=Q(name='A')) | Exists('child', filter=Q(name='B'))
+
+    is Exists('child', filter=Q(name='A') | Q(name='B')).
+    """
     unordered = True
     template = 'EXISTS(%(subquery)s)'
+    strategy = None
+    # The resolved (query, outer column, relation) of the semi-join, when the
+    # strategy may use it
+    semi_join = None
 
     def __init__(self, *args, **kwargs):
         self.negated = kwargs.pop('negated', False)
+        self.strategy = kwargs.pop('strategy', self.strategy)
+        if self.strategy is not None and self.strategy not in EXISTS_STRATEGIES:
+            raise ValueError('Unknown strategy {!r}, expected one of {}'.format(self.strategy,
+                                                                               ', '.join(EXISTS_STRATEGIES)))
         super(Exists, self).__init__(*args, **kwargs)
         self.output_field = BooleanField()
 
     def __invert__(self):
-        # Be careful not to evaluate self.queryset on this line
-        return type(self)(self.queryset if self.queryset is not None else self.expression, negated=(not self.negated), **self.extra)
+        kwargs = dict(self.extra, negated=(not self.negated), strategy=self.strategy)
+        expression = getattr(self, 'expression', None)
+        if expression is None:
+            # Be careful not to evaluate self.queryset on this line
+            return type(self)(self.queryset, **kwargs)
+        kwargs.update(filter=self.filter, distinct=self.distinct, outer_ref=self.outer_ref)
+        return type(self)(expression, **kwargs)
+
+    def __or__(self, other):
+        # EXISTS(a) OR EXISTS(b) is EXISTS(a OR b)
+        if self._can_merge(other) and not self.negated and not other.negated:
+            return self._merge(other)
+        return super(Exists, self).__or__(other)
+
+    def __and__(self, other):
+        # NOT EXISTS(a) AND NOT EXISTS(b) is NOT EXISTS(a OR b)
+        if self._can_merge(other) and self.negated and other.negated:
+            return self._merge(other)
+        return super(Exists, self).__and__(other)
+
+    def _can_merge(self, other):
+        """Whether `other` is an Exists over the same relation"""
+        if type(other) is not type(self) or getattr(self, 'expression', None) is None:
+            return False
+        if getattr(other, 'expression', None) is None:
+            return False
+        return (self.expression == other.expression and self.outer_ref == other.outer_ref
+                and self.distinct == other.distinct and self.strategy == other.strategy and self.extra == other.extra)
+
+    def _merge(self, other):
+        # An empty filter matches every related row
+        filter = self.filter | other.filter if self.filter and other.filter else Q()
+        return type(self)(self.expression, filter=filter, distinct=self.distinct, outer_ref=self.outer_ref,
+                          negated=self.negated, strategy=self.strategy, **self.extra)
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        expression = getattr(self, 'expression', None)
+        if self.get_strategy() == ANTI_JOIN and expression is not None and allow_joins and not for_save:
+            return self._resolve_as_join(query)
+        resolved = super(Exists, self).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+        if self.get_strategy() != SUBQUERY and getattr(self, 'expression', None) is not None:
+            resolved.semi_join = self._resolve_semi_join(query)
+        return resolved
+
+    def get_strategy(self):
+        strategy = self.strategy or getattr(settings, 'SQL_UTIL_DEFAULT_EXISTS_STRATEGY', SUBQUERY)
+        if strategy == ANTI_JOIN and _contains_outer_ref(getattr(self, 'filter', None)):
+            # The joined keys are computed for all the outer rows at once
+            return SUBQUERY
+        return strategy
 
+    def _resolve_semi_join(self, query):
+        model, reverse, outer_ref = self._resolve_path(self._get_resolution_query(query), True, None, False)
+        # NULL keys are left out so NOT IN isn't NULL for every row
+        queryset = (model._default_manager.filter(self.filter & Q(**{reverse + '__isnull': False}))
+                    .order_by()
+                    .values(reverse))
+        return queryset.query.resolve_expression(query), query.resolve_ref(outer_ref), (model, reverse, outer_ref,
+                                                                                        self.filter)
+
+    def _resolve_as_join(self, query):
+        model, reverse, outer_ref = self._resolve_path(self._get_resolution_query(query), True, None, False)
+        alias = KeysJoin.add(query, (model, reverse, outer_ref, self.filter))
+        key = JoinedColumn(alias, KEY_COLUMN, query.alias_map[alias].output_field(), source=self)
+        # The key is NULL for outer rows without related rows. Lookups are
+        # only expressions, e.g. in annotate(), from Django 4.2.
+        return ExpressionWrapper(WhereNode([IsNull(key, self.negated)]), output_field=BooleanField())
+
+    def uses_semi_join(self, compiler, connection):
+        if self.semi_join is None:
+            return False
+        if self.get_strategy() == AUTO:
+            strategy = choose_strategy(compiler, connection, 'exists', self.semi_join[2], (SUBQUERY, SEMI_JOIN),
+                                       negated=self.negated)
+            return strategy == SEMI_JOIN
+        return True
+
+    @instrumented
     def as_sql(self, compiler, connection, template=None, **extra_context):
+        if self.uses_semi_join(compiler, connection):
+            return self.as_semi_join_sql(compiler, connection)
         sql, params = super(Exists, self).as_sql(compiler, connection, template, **extra_context)
         if self.negated:
             sql = 'NOT {}'.format(sql)
         return sql, params
 
+    def as_semi_join_sql(self, compiler, connection):
+        query, lhs, _ = self.semi_join
+        lhs_sql, lhs_params = compiler.compile(lhs)
+        query_sql, query_params = compiler.compile(query)
+        params = tuple(lhs_params) + tuple(query_params)
+        if self.negated:
+            sql = '{} NOT IN {}'.format(lhs_sql, query_sql)
+        else:
+            sql = '{} IN {}'.format(lhs_sql, query_sql)
+        if getattr(getattr(lhs, 'target', None), 'null', True):
+            # A NULL outer column has no related rows, but IN would be NULL
+            if self.negated:
+                sql = '({} IS NULL OR {})'.format(lhs_sql, sql)
+            else:
+                sql = '({} IS NOT NULL AND {})'.format(lhs_sql, sql)
+            params = tuple(lhs_params) + params
+        return sql, params
+
+    def relabeled_clone(self, change_map):
+        clone = super(Exists, self).relabeled_clone(change_map)
+        if self.semi_join is not None:
+            query, lhs, relation = self.semi_join
+            clone.semi_join = query.relabeled_clone(change_map), lhs.relabeled_clone(change_map), relation
+        return clone
+
     def as_oracle(self, compiler, connection, template=None, **extra_context):
         # Oracle doesn't allow EXISTS() in the SELECT list, so wrap it with a
         # CASE WHEN expression. Change the template since the When expression
@@ -0,0 +1,102 @@
+from collections import OrderedDict, namedtuple
+from threading import RLock
+
+from django.core.signals import setting_changed
+from django.db.models.signals import class_prepared, post_migrate
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    A small thread safe mapping with a bound on the number of entries. When the
+    bound is reached, the least recently used entry is evicted.
+
+    Hits and misses are counted so callers can check whether the cache is
+    effective, in the same spirit as functools.lru_cache's cache_info().
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+# Maps (outer model, lookup, outer_ref) to the (model, reverse, outer_ref) computed
+# by Subquery when it walks the relation path of its expression.
+path_cache = LRUCache(maxsize=1024)
+
+# Maps the shape of a query (and the database vendor) to the strategy chosen for
+# sql_util expressions with strategy='auto', see sql_util.strategy.
+strategy_cache = LRUCache(maxsize=1024)
+
+# Maps the definition of a subquery expression to its built inner query, and
+# the resolved inner query to its compiled SQL and params, when the
+# SQL_UTIL_FRAGMENT_CACHE setting is on. See Subquery.as_sql.
+fragment_cache = LRUCache(maxsize=1024)
+
+
+def clear_caches():
+    path_cache.clear()
+    strategy_cache.clear()
+    fragment_cache.clear()
+
+
+def _clear_on_class_prepared(sender, **kwargs):
+    # A model class being (re)created means the app registry changed and cached
+    # paths may point at stale model classes.
+    clear_caches()
+
+
+def _clear_on_setting_changed(setting, **kwargs):
+    if setting == 'INSTALLED_APPS':
+        clear_caches()
+    elif setting.startswith('SQL_UTIL_'):
+        # Settings like SQL_UTIL_TABLE_SIZES feed into the chosen strategies
+        strategy_cache.clear()
+        fragment_cache.clear()
+
+
+def _clear_on_post_migrate(sender, **kwargs):
+    # Migrations may have changed the columns cached SQL refers to
+    clear_caches()
+
+
+class_prepared.connect(_clear_on_class_prepared)
+setting_changed.connect(_clear_on_setting_changed)
+post_migrate.connect(_clear_on_post_migrate)
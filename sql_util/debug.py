@@ -1,5 +1,533 @@
+import copy
+import json
+import re
+import statistics
+import time
+
 import sqlparse
+from django.db import connections
+from django.db.models import Value
+from django.db.models.sql.where import WhereNode
+
+from sql_util.aggregates import Subquery, Exists
+from sql_util.joins import JoinedColumn, SubqueryJoin
 
 
 def pretty_print_sql(queryset, **options):
     print(sqlparse.format(str(queryset.query), reindent=True, indent_width=4, **options))
+
+
+class PlanNode(object):
+    """
+    A node of a query plan, in the same shape for every backend.
+
+    `operation` is what the node does, e.g. 'SCAN', 'Index Scan' or 'ref'
+    depending on the backend, `relation` and `alias` the table read, `index`
+    the index used, if any. The estimates and, with analyze, the actual rows
+    and time (in milliseconds) are filled in where the backend reports them.
+
+    `per_row` is True for subqueries evaluated for each row of the outer query,
+    i.e. correlated subqueries the database didn't turn into a join.
+    `annotations` names the sql_util annotations (or 'filter' for expressions
+    in the WHERE clause) the node comes from. `raw` is what the backend
+    reported for the node.
+    """
+    def __init__(self, operation, detail='', relation=None, alias=None, index=None, estimated_rows=None,
+                 estimated_cost=None, actual_rows=None, actual_time=None, loops=None, per_row=False, raw=None):
+        self.operation = operation
+        self.detail = detail
+        self.relation = relation
+        self.alias = alias
+        self.index = index
+        self.estimated_rows = estimated_rows
+        self.estimated_cost = estimated_cost
+        self.actual_rows = actual_rows
+        self.actual_time = actual_time
+        self.loops = loops
+        self.per_row = per_row
+        self.raw = raw
+        self.annotations = []
+        self.children = []
+
+    def __repr__(self):
+        return '<PlanNode {}>'.format(self.describe())
+
+    def describe(self):
+        parts = [self.detail or ' '.join(str(part) for part in (self.operation, self.relation) if part)]
+        if self.index and self.index not in parts[0]:
+            parts.append('using {}'.format(self.index))
+        if self.per_row:
+            parts.append('(per row)')
+        if self.annotations:
+            parts.append('[{}]'.format(', '.join(self.annotations)))
+        return ' '.join(parts)
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for node in child.walk():
+                yield node
+
+    def as_dict(self):
+        return {
+            'operation': self.operation,
+            'detail': self.detail,
+            'relation': self.relation,
+            'alias': self.alias,
+            'index': self.index,
+            'estimated_rows': self.estimated_rows,
+            'estimated_cost': self.estimated_cost,
+            'actual_rows': self.actual_rows,
+            'actual_time': self.actual_time,
+            'loops': self.loops,
+            'per_row': self.per_row,
+            'annotations': list(self.annotations),
+            'children': [child.as_dict() for child in self.children],
+        }
+
+
+class Plan(object):
+    """
+    The plan of a queryset as returned by explain_queryset(), with the SQL and
+    params that were explained and, with analyze, the execution time in
+    milliseconds.
+    """
+    def __init__(self, root, sql, params, vendor, execution_time=None):
+        self.root = root
+        self.sql = sql
+        self.params = params
+        self.vendor = vendor
+        self.execution_time = execution_time
+
+    def nodes(self, annotation=None):
+        """The nodes of the plan, or those coming from `annotation`"""
+        return [node for node in self.root.walk() if annotation is None or annotation in node.annotations]
+
+    def as_dict(self):
+        return {
+            'sql': self.sql,
+            'params': list(self.params),
+            'vendor': self.vendor,
+            'execution_time': self.execution_time,
+            'plan': self.root.as_dict(),
+        }
+
+    def __str__(self):
+        lines = []
+
+        def add(node, depth):
+            lines.append('{}{}'.format('    ' * depth, node.describe()))
+            for child in node.children:
+                add(child, depth + 1)
+        add(self.root, 0)
+        return '\n'.join(lines)
+
+
+def explain_queryset(queryset, analyze=False, using=None):
+    """
+    EXPLAIN the SQL of `queryset`, with its params bound by the database, and
+    return the Plan.
+
+    SQLite's EXPLAIN QUERY PLAN, PostgreSQL's EXPLAIN (FORMAT JSON) and MySQL's
+    EXPLAIN FORMAT=JSON are parsed into PlanNodes. With `analyze`, PostgreSQL
+    runs EXPLAIN ANALYZE and reports actual rows and times for each node, on
+    the other backends the query is run once to time it.
+
+    The nodes reading the tables of a sql_util expression are marked with its
+    annotation's name. To tell them apart, the expressions' table aliases are
+    renamed to sqlu<n>_<i> in the explained SQL.
+    """
+    connection = connections[using or queryset.db]
+    query, labels = tag_sql_util_aliases(queryset.query)
+    sql, params = query.get_compiler(connection=connection).as_sql()
+
+    explain = EXPLAIN.get(connection.vendor)
+    if explain is None:
+        raise NotImplementedError('explain_queryset() does not support {}'.format(connection.vendor))
+    root, execution_time = explain(connection, sql, params, analyze)
+    mark_annotations(root, labels)
+    return Plan(root, sql, params, connection.vendor, execution_time)
+
+
+def tag_sql_util_aliases(query):
+    """
+    Return a copy of `query` where the table aliases of each sql_util
+    expression have a distinct prefix, and a dict of alias prefix (or the alias
+    of a join) to the names of the annotations using it.
+    """
+    query = query.clone()
+    labels = {}
+    tagger = _Tagger(query, labels)
+    query.annotations = {name: tagger.tag(annotation, name) for name, annotation in query.annotations.items()}
+    query.where = tagger.tag(query.where, 'filter')
+    return query, labels
+
+
+class _Tagger(object):
+    def __init__(self, query, labels):
+        self.query = query
+        self.labels = labels
+
+    def prefix(self, labels):
+        prefix = 'sqlu{}_'.format(len(self.labels) + 1)
+        self.labels[prefix] = labels
+        return prefix
+
+    def tag(self, expression, label):
+        if isinstance(expression, Subquery):
+            return self.tag_subquery(expression, label)
+        if isinstance(expression, JoinedColumn):
+            self.tag_join(expression.alias, label)
+            return expression
+        if isinstance(expression, WhereNode):
+            return WhereNode([self.tag(child, label) for child in expression.children], expression.connector,
+                             expression.negated)
+        sources = expression.get_source_expressions() if hasattr(expression, 'get_source_expressions') else []
+        if not any(isinstance(source, (Subquery, JoinedColumn, WhereNode)) or
+                   (source is not None and hasattr(source, 'get_source_expressions')) for source in sources):
+            return expression
+        # Lookups only have copy() from Django 4.0
+        clone = copy.copy(expression)
+        clone.set_source_expressions([self.tag(source, label) if source is not None else None
+                                      for source in sources])
+        return clone
+
+    def tag_subquery(self, expression, label):
+        if getattr(expression, 'expression', None) is None:
+            # Subqueries of querysets aren't sql_util's
+            return expression
+        prefix = self.prefix([label])
+        clone = expression.copy()
+        clone.query = relabel(expression.query, prefix)
+        if isinstance(expression, Exists) and expression.semi_join is not None:
+            semi_query, lhs, relation = expression.semi_join
+            clone.semi_join = relabel(semi_query, prefix, start=len(expression.query.alias_map)), lhs, relation
+        return clone
+
+    def tag_join(self, alias, label):
+        join = self.query.alias_map.get(alias)
+        if not isinstance(join, SubqueryJoin):
+            return
+        if alias in self.labels:
+            # Joins are shared by the annotations over the same relation
+            if label not in self.labels[alias]:
+                self.labels[alias].append(label)
+            return
+        self.labels[alias] = [label]
+        prefix = self.prefix(self.labels[alias])
+        queries = [join.inner_query, getattr(join, 'distinct_query', None)] + list((join.scalar_queries or {}).values())
+        inner_aliases = []
+        for query in queries:
+            if query is not None:
+                inner_aliases.extend(alias for alias in query.alias_map if alias not in inner_aliases)
+        change_map = {inner_alias: '{}{}'.format(prefix, i) for i, inner_alias in enumerate(inner_aliases)}
+        self.query.alias_map[alias] = join.relabeled_clone(change_map)
+
+
+def relabel(query, prefix, start=0):
+    return query.relabeled_clone({alias: '{}{}'.format(prefix, start + i) for i, alias in enumerate(query.alias_map)})
+
+
+def mark_annotations(root, labels):
+    def labels_of(name):
+        name = name.strip('"`').lower()
+        for prefix, names in labels.items():
+            if name == prefix.lower() or (prefix.endswith('_') and name.startswith(prefix.lower())):
+                return names
+        return []
+
+    def mark(node):
+        names = [node.alias, node.relation] + re.findall(r'\b(sqlu\d+_\d+)\b', node.detail or '')
+        if node.operation.startswith('MATERIALIZE'):
+            names.append(node.detail.split()[-1])
+        found = []
+        for name in names:
+            if name:
+                found.extend(label for label in labels_of(name) if label not in found)
+        for child in node.children:
+            mark(child)
+            if node.per_row or node.operation.startswith(SUBQUERY_OPERATIONS):
+                found.extend(label for label in child.annotations if label not in found)
+        node.annotations = found
+    mark(root)
+
+
+SUBQUERY_OPERATIONS = ('SUBQUERY', 'subquery', 'SubPlan', 'InitPlan', 'MATERIALIZE', 'CO-ROUTINE',
+                       'materialized')
+
+
+def timed(connection, sql, params):
+    with connection.cursor() as cursor:
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        rows = len(cursor.fetchall())
+    return rows, (time.perf_counter() - start) * 1000
+
+
+def explain_sqlite(connection, sql, params, analyze):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        rows = cursor.fetchall()
+    root = parse_sqlite(rows)
+    execution_time = None
+    if analyze:
+        root.actual_rows, execution_time = timed(connection, sql, params)
+        root.actual_time = execution_time
+    return root, execution_time
+
+
+def parse_sqlite(rows):
+    """Build the plan tree from the (id, parent, notused, detail) rows of EXPLAIN QUERY PLAN"""
+    root = PlanNode('QUERY PLAN')
+    nodes = {0: root}
+    for node_id, parent, _, detail in rows:
+        node = sqlite_node(detail)
+        nodes[node_id] = node
+        nodes.get(parent, root).children.append(node)
+    return root
+
+
+_sqlite_detail = re.compile(r'^(?P<operation>SCAN|SEARCH)\s+(?:TABLE\s+)?(?P<relation>\S+)'
+                            r'(?:\s+AS\s+(?P<alias>\S+))?')
+_sqlite_index = re.compile(r'USING (?:(?:AUTOMATIC )?(?:COVERING )?INDEX (?P<index>\S+)|(?P<pk>INTEGER PRIMARY KEY))')
+
+
+def sqlite_node(detail):
+    match = _sqlite_detail.match(detail)
+    if match is None:
+        operation = re.sub(r'\s+\d+$', '', detail)
+        return PlanNode(operation, detail=detail, per_row=detail.startswith('CORRELATED'), raw=detail)
+
+    relation = match.group('relation')
+    alias = match.group('alias') or relation
+    index = None
+    index_match = _sqlite_index.search(detail)
+    if index_match:
+        index = index_match.group('index') or index_match.group('pk')
+    elif 'AUTOMATIC' in detail:
+        index = 'AUTOMATIC INDEX'
+    return PlanNode(match.group('operation'), detail=detail, relation=relation, alias=alias, index=index, raw=detail)
+
+
+def explain_postgresql(connection, sql, params, analyze):
+    options = 'ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON'
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN ({}) {}'.format(options, sql), params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return parse_postgresql(plan[0]['Plan']), plan[0].get('Execution Time')
+
+
+def parse_postgresql(data):
+    relationship = data.get('Parent Relationship')
+    node = PlanNode(data['Node Type'],
+                    detail=' '.join(part for part in (data.get('Subplan Name'), data['Node Type'],
+                                                      data.get('Relation Name')) if part),
+                    relation=data.get('Relation Name'),
+                    alias=data.get('Alias'),
+                    index=data.get('Index Name'),
+                    estimated_rows=data.get('Plan Rows'),
+                    estimated_cost=data.get('Total Cost'),
+                    actual_rows=data.get('Actual Rows'),
+                    actual_time=data.get('Actual Total Time'),
+                    loops=data.get('Actual Loops'),
+                    # SubPlans are evaluated for each row, InitPlans once
+                    per_row=relationship == 'SubPlan',
+                    raw=data)
+    if relationship in ('SubPlan', 'InitPlan'):
+        node.operation = relationship
+    node.children = [parse_postgresql(child) for child in data.get('Plans', [])]
+    return node
+
+
+def explain_mysql(connection, sql, params, analyze):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN FORMAT=JSON ' + sql, params)
+        plan = json.loads(cursor.fetchone()[0])
+    root = parse_mysql(plan['query_block'])
+    execution_time = None
+    if analyze:
+        root.actual_rows, execution_time = timed(connection, sql, params)
+        root.actual_time = execution_time
+    return root, execution_time
+
+
+MYSQL_OPERATIONS = ('ordering_operation', 'grouping_operation', 'duplicates_removal', 'windowing')
+MYSQL_SUBQUERIES = ('select_list_subqueries', 'attached_subqueries', 'optimized_away_subqueries',
+                    'order_by_subqueries', 'group_by_subqueries', 'having_subqueries')
+
+
+def parse_mysql(data, operation='query_block'):
+    """Build the plan tree from a query_block (or one of its operations) of EXPLAIN FORMAT=JSON"""
+    cost = data.get('cost_info', {}).get('query_cost')
+    node = PlanNode(operation, detail=operation if 'select_id' not in data else 'select #{}'.format(data['select_id']),
+                    estimated_cost=float(cost) if cost is not None else None, raw=data)
+    node.children = _mysql_children(data)
+    return node
+
+
+def _mysql_children(data):
+    children = []
+    tables = [data['table']] if 'table' in data else [item['table'] for item in data.get('nested_loop', [])
+                                                     if 'table' in item]
+    children.extend(_mysql_table(table) for table in tables)
+    for operation in MYSQL_OPERATIONS:
+        if operation in data:
+            children.append(parse_mysql(data[operation], operation))
+    children.extend(_mysql_subqueries(data))
+    return children
+
+
+def _mysql_subqueries(data):
+    subqueries = []
+    for key in MYSQL_SUBQUERIES:
+        for subquery in data.get(key, []):
+            node = parse_mysql(subquery['query_block'], 'subquery')
+            node.detail = '{} subquery #{}'.format('dependent' if subquery.get('dependent') else 'independent',
+                                                   subquery['query_block'].get('select_id'))
+            node.per_row = bool(subquery.get('dependent')) and not subquery.get('cacheable', False)
+            subqueries.append(node)
+    return subqueries
+
+
+def _mysql_table(table):
+    cost_info = table.get('cost_info', {})
+    cost = cost_info.get('prefix_cost')
+    node = PlanNode(table.get('access_type', 'table'),
+                    detail='{} {}'.format(table.get('access_type', ''), table.get('table_name', '')).strip(),
+                    relation=table.get('table_name'),
+                    alias=table.get('table_name'),
+                    index=table.get('key'),
+                    estimated_rows=table.get('rows_examined_per_scan'),
+                    estimated_cost=float(cost) if cost is not None else None,
+                    raw=table)
+    if 'materialized_from_subquery' in table:
+        subquery = table['materialized_from_subquery']
+        child = parse_mysql(subquery['query_block'], 'materialized')
+        child.per_row = bool(subquery.get('dependent'))
+        node.children.append(child)
+    node.children.extend(_mysql_subqueries(table))
+    return node
+
+
+EXPLAIN = {
+    'sqlite': explain_sqlite,
+    'postgresql': explain_postgresql,
+    'mysql': explain_mysql,
+}
+
+
+def profile_annotations(queryset, repeat=5, using=None):
+    """
+    Time `queryset` with and without each of its sql_util annotations, to find
+    the ones that dominate its execution time.
+
+    The queryset is executed `repeat` times in each variant: as is, without
+    any sql_util annotation (the base), with only one of them and without only
+    one of them. Left out annotations are selected as NULL, so that the rows
+    and the other annotations and filters are unchanged.
+
+    Return a dict with the median execution time, in seconds, of the queryset
+    (`total`) and of the base (`base`), and for each annotation:
+
+        added       the time with only this annotation minus the base's
+        removed     the total time minus the time without this annotation
+        per_row     whether the database runs one of its subqueries per row
+        rows        the number of rows the plan is estimated to read for it,
+                    None when the database doesn't estimate it (SQLite)
+    """
+    connection = connections[using or queryset.db]
+    names = [name for name, annotation in queryset.query.annotations.items() if _sql_util_columns(annotation)]
+
+    variants = {'total': queryset.query, 'base': _without(queryset.query, names)}
+    for name in names:
+        variants[('added', name)] = _without(queryset.query, [other for other in names if other != name])
+        variants[('removed', name)] = _without(queryset.query, [name])
+
+    compiled = {key: query.get_compiler(connection=connection).as_sql() for key, query in variants.items()}
+    timings = {key: [] for key in compiled}
+    # Alternate the variants so that they are equally affected by caches
+    # warming up and by the load of the database
+    for _ in range(repeat):
+        for key, (sql, params) in compiled.items():
+            timings[key].append(timed(connection, sql, params)[1] / 1000)
+    medians = {key: statistics.median(times) for key, times in timings.items()}
+
+    try:
+        plan = explain_queryset(queryset, using=connection.alias)
+    except NotImplementedError:
+        plan = None
+
+    annotations = {}
+    for name in names:
+        nodes = plan.nodes(name) if plan is not None else []
+        annotations[name] = {
+            'added': medians[('added', name)] - medians['base'],
+            'removed': medians['total'] - medians[('removed', name)],
+            'per_row': any(node.per_row for node in nodes),
+            'rows': _rows_read(plan, name) if plan is not None else None,
+        }
+    return {'total': medians['total'], 'base': medians['base'], 'annotations': annotations}
+
+
+def _sql_util_columns(expression):
+    """
+    Return the sql_util expressions in `expression`, an annotation, or an
+    empty list when it has none.
+    """
+    if isinstance(expression, JoinedColumn) or (isinstance(expression, Subquery) and
+                                                getattr(expression, 'expression', None) is not None):
+        return [expression]
+    found = []
+    for source in expression.get_source_expressions() if hasattr(expression, 'get_source_expressions') else []:
+        if source is not None:
+            found.extend(_sql_util_columns(source))
+    return found
+
+
+def _without(query, names):
+    """A copy of `query` selecting NULL instead of the annotations `names`"""
+    query = query.clone()
+    used = set()
+    for node in [query.where] + [annotation for name, annotation in query.annotations.items() if name not in names]:
+        used.update(column.alias for column in _joined_columns(node))
+
+    for name in names:
+        annotation = query.annotations[name]
+        for column in _joined_columns(annotation):
+            # Leave out the join unless something else needs it
+            if column.alias not in used:
+                query.unref_alias(column.alias)
+        query.annotations[name] = Value(None, output_field=annotation.output_field)
+    return query
+
+
+def _joined_columns(node):
+    if isinstance(node, JoinedColumn):
+        return [node]
+    children = getattr(node, 'children', None)
+    if children is None:
+        children = node.get_source_expressions() if hasattr(node, 'get_source_expressions') else []
+    return [column for child in children if child is not None for column in _joined_columns(child)]
+
+
+def _rows_read(plan, annotation):
+    """
+    Estimate the rows read from the tables of `annotation`'s subqueries. The
+    rows of a node run for each outer row are multiplied by the plan's
+    estimate of the outer rows.
+    """
+    total = None
+
+    def add(node, loops, marked):
+        nonlocal total
+        marked = marked or annotation in node.annotations
+        if node.per_row:
+            loops = loops * (plan.root.estimated_rows or 1)
+        if marked and node.relation and node.estimated_rows is not None:
+            total = (total or 0) + node.estimated_rows * loops
+        for child in node.children:
+            add(child, loops, marked)
+    add(plan.root, 1, False)
+    return total
@@ -0,0 +1,167 @@
+"""
+Evaluating repeated sql_util subqueries once per row.
+
+    Parent.objects.annotate(last=SubqueryMax('child__timestamp')).filter(last__gte=since)
+
+repeats the correlated subquery in the SELECT and the WHERE clause, which
+databases evaluate twice for each row. evaluate_once() computes the repeated
+subqueries in a derived table of the rows matching the other filters, joined
+on the primary key, and the annotations and filters select and compare its
+columns:
+
+    SELECT parent.id, parent.name, parent_once.once_1 AS last FROM parent
+    LEFT OUTER JOIN (
+        SELECT parent.id AS sql_util_key, (SELECT MAX(child.timestamp) ...) AS once_1 FROM parent
+        WHERE ... LIMIT 9223372036854775807
+    ) parent_once ON (parent.id = parent_once.sql_util_key)
+    WHERE parent_once.once_1 >= ...
+
+The LIMIT keeps the database from merging the derived table into the outer
+query, which would repeat the subquery again.
+"""
+import copy
+
+from django.db.models import F
+from django.db.models.expressions import Col, RawSQL
+from django.db.models.sql.where import AND, WhereNode
+
+from sql_util.aggregates import Subquery, CountThreshold
+from sql_util.joins import SubqueryJoin, JoinedColumn, KEY_COLUMN
+
+# A LIMIT no derived table reaches, it only prevents the merge
+NO_LIMIT = 2 ** 63 - 1
+
+
+def evaluate_once(queryset):
+    """
+    Return a copy of `queryset` where the sql_util subqueries the filters use,
+    and that are also selected annotations or are used more than once by the
+    filters, are computed once for each row, in a join against a derived
+    table.
+
+    Subqueries are the same when they compute the same thing over the same
+    relation, e.g. the annotation SubqueryMax('child__timestamp') and a filter
+    on another SubqueryMax('child__timestamp'). SubqueryCount compared with an
+    integer stops counting in the filter, it isn't a repetition. Subqueries
+    correlated with joined tables of the query are left as they are.
+
+    The filters of the query on its own table are applied to the derived
+    table too. A slice isn't, it applies after the filters on the subqueries.
+    """
+    queryset = queryset._chain()
+    query = queryset.query
+
+    counts = {}
+    filtered = set()
+    # Annotations of alias() aren't selected, they're only computed where they're used
+    for expression in list(query.annotation_select.values()) + [query.where]:
+        for subquery in subqueries(expression):
+            counts[subquery] = counts.get(subquery, 0) + 1
+            if expression is query.where:
+                filtered.add(subquery)
+    base_table = query.get_initial_alias()
+    repeated = [subquery for subquery, count in counts.items()
+                if count > 1 and subquery in filtered and set(subquery.query.external_aliases) <= {base_table}]
+    if repeated:
+        alias = OnceJoin.add(query, repeated)
+        replacements = {subquery: JoinedColumn(alias, 'once_%d' % (i + 1), subquery.output_field, source=subquery)
+                        for i, subquery in enumerate(repeated)}
+        query.annotations = {name: replace_expressions(annotation, replacements)
+                             for name, annotation in query.annotations.items()}
+        query.where = replace_expressions(query.where, replacements)
+    return queryset
+
+
+def subqueries(expression):
+    """The sql_util subqueries `expression`, which may be one, or a WhereNode, evaluates"""
+    if isinstance(expression, Subquery):
+        return [expression]
+    if isinstance(expression, CountThreshold) and expression.is_bounded():
+        return []
+    if isinstance(expression, WhereNode):
+        sources = expression.children
+    else:
+        sources = expression.get_source_expressions() if hasattr(expression, 'get_source_expressions') else []
+    found = []
+    for source in sources:
+        if source is not None:
+            found.extend(subqueries(source))
+    return found
+
+
+def replace_expressions(expression, replacements):
+    """
+    Return a copy of `expression`, an expression or a WhereNode, with the
+    expressions equal to a key of `replacements` replaced by its value. Parts
+    of `expression` without replacements are not copied.
+    """
+    if isinstance(expression, WhereNode):
+        return WhereNode([replace_expressions(child, replacements) for child in expression.children],
+                         expression.connector, expression.negated)
+    try:
+        replacement = replacements.get(expression)
+    except TypeError:
+        # e.g. a lookup on an unhashable value
+        replacement = None
+    if replacement is not None:
+        return replacement
+    sources = expression.get_source_expressions() if hasattr(expression, 'get_source_expressions') else []
+    replaced = [replace_expressions(source, replacements) if source is not None else None for source in sources]
+    if all(new is old for new, old in zip(replaced, sources)):
+        return expression
+    # Lookups only have copy() from Django 4.0
+    clone = copy.copy(expression)
+    clone.set_source_expressions(replaced)
+    return clone
+
+
+def reads_table(expression, alias):
+    """Whether `expression`, or a WhereNode, only reads the columns of the table `alias`, without subqueries"""
+    if isinstance(expression, Col):
+        return expression.alias == alias
+    if isinstance(expression, WhereNode):
+        sources = expression.children
+    elif hasattr(expression, 'external_aliases') or isinstance(expression, RawSQL):
+        return False
+    elif hasattr(expression, 'get_source_expressions'):
+        sources = expression.get_source_expressions()
+    else:
+        # e.g. extra(where=...)
+        return False
+    return all(reads_table(source, alias) for source in sources if source is not None)
+
+
+class OnceJoin(SubqueryJoin):
+    """
+    A join against subqueries computed for each row of the outer model
+    matching the filters of the outer query on its own table, in the columns
+    once_1, once_2..., keyed by its primary key. The subqueries are resolved
+    against the outer query and only reference its base table.
+    """
+    table_suffix = 'once'
+
+    @classmethod
+    def add(cls, query, repeated):
+        """Join the derived table of the `repeated` subqueries to `query` and return its alias"""
+        model = query.model
+        base_table = query.get_initial_alias()
+        inner_query = model._default_manager.order_by().values(**{KEY_COLUMN: F('pk')}).query
+        if query.where.connector == AND and not query.where.negated:
+            for child in query.where.children:
+                if reads_table(child, base_table):
+                    inner_query.where.add(child, AND)
+        for i, subquery in enumerate(repeated):
+            inner_query.add_annotation(subquery.copy(), 'once_%d' % (i + 1))
+        inner_query.set_limits(high=NO_LIMIT)
+        # The aliases of the derived table must not be those of the subqueries
+        inner_query.subq_aliases = inner_query.subq_aliases | query.subq_aliases
+        join = cls(table_name='%s_%s' % (model._meta.db_table, cls.table_suffix),
+                   parent_alias=base_table,
+                   relation=tuple(repeated),
+                   columns=['once_%d' % (i + 1) for i in range(len(repeated))],
+                   inner_query=inner_query.resolve_expression(query),
+                   lhs=query.resolve_ref('pk'))
+        alias, _ = query.table_alias(join.table_name, create=True)
+        join.table_alias = alias
+        query.alias_map[alias] = join
+        return alias
@@ -0,0 +1,227 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from django.db import DEFAULT_DB_ALIAS, connections, migrations, models
+from django.db.models import Q, UniqueConstraint
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Col
+from django.db.models.sql import Query
+
+from sql_util.aggregates import Subquery, SubqueryAggregate, SubqueryFirst
+from sql_util.joins import JoinedColumn
+
+# Lookups that compare a column with a single value or a set of values, so the
+# column can be followed by more index columns.
+EQUALITY_LOOKUPS = ('exact', 'iexact', 'in', 'isnull')
+
+
+def suggest_indexes(*items, **kwargs):
+    """
+    Return the indexes the sql_util expressions in `items` need and their models
+    don't have yet, as a dict of app label to migrations.AddIndex operations.
+
+    `items` are querysets, whose annotations and filters are searched for
+    sql_util expressions, or the expressions themselves, which are resolved
+    against the `model` keyword argument.
+
+    For each expression the index starts with the column the subquery is
+    correlated on, followed by the columns it is filtered on: equality lookups
+    first, then at most one range lookup, or for SubqueryFirst the columns it
+    is ordered by. The columns aggregated are covered by
+    the index, with INCLUDE where the database (`using`) supports it and as
+    trailing index columns elsewhere.
+    """
+    model = kwargs.pop('model', None)
+    connection = connections[kwargs.pop('using', DEFAULT_DB_ALIAS)]
+
+    needed = OrderedDict()
+    for outer_model, expression in _collect(items, model):
+        requirement = get_index_requirement(expression, outer_model)
+        if requirement is None:
+            continue
+        inner_model, fields, covering = requirement
+        covered = needed.setdefault((inner_model, fields), [])
+        covered.extend(field for field in covering if field not in covered)
+
+    suggestions = OrderedDict()
+    for (inner_model, fields), covering in needed.items():
+        if _is_redundant(inner_model, fields, covering, needed) or _is_indexed(inner_model, fields, covering):
+            continue
+        index = _build_index(inner_model, fields, covering, connection)
+        operation = migrations.AddIndex(model_name=inner_model._meta.model_name, index=index)
+        suggestions.setdefault(inner_model._meta.app_label, []).append(operation)
+    return suggestions
+
+
+def get_index_requirement(expression, model):
+    """
+    Return (model, fields, covering) for the index the subquery of `expression`
+    over the outer `model` would use, or None when it can't be derived: the
+    subquery's model, the tuple of index fields and the tuple of fields to cover.
+    """
+    query = Query(model)
+    inner_model, reverse, _ = expression._resolve_path(query, True, None, False)
+
+    correlated = _concrete_field(inner_model, reverse.split(LOOKUP_SEP)[0])
+    if correlated is None:
+        return None
+
+    equality, ranges = [correlated], []
+    for name, lookup in _filter_lookups(inner_model, expression.filter):
+        if lookup in EQUALITY_LOOKUPS:
+            equality.append(name)
+        else:
+            ranges.append(name)
+    fields = _unique(equality)
+    if isinstance(expression, SubqueryFirst):
+        # The first row is read from the index in the subquery's order
+        fields += [name for name in _unique(_concrete_field(inner_model, name.lstrip('-'))
+                                            for name in expression.ordering) if name and name not in fields]
+    else:
+        fields += [name for name in ranges[:1] if name not in fields]
+
+    covering = []
+    if isinstance(expression, SubqueryFirst):
+        target = expression._get_target(query, True, None, False)
+        covering = [name for name in _unique(_column_names(target, inner_model))
+                    if name not in fields and name != inner_model._meta.pk.name]
+    elif isinstance(expression, SubqueryAggregate):
+        aggregation = expression._get_annotation(query, True, None, False)['aggregation']
+        resolved = aggregation.resolve_expression(inner_model._default_manager.all().query)
+        covering = [name for name in _unique(_column_names(resolved, inner_model))
+                    if name not in fields and name != inner_model._meta.pk.name]
+
+    return inner_model, tuple(fields), tuple(covering)
+
+
+def _collect(items, model):
+    for item in items:
+        if isinstance(item, Mapping):
+            for expression in item.values():
+                yield model, expression
+        elif hasattr(item, 'query') and hasattr(item, 'model'):
+            seen = set()
+            for node in list(item.query.annotations.values()) + [item.query.where]:
+                for expression in _find_expressions(node):
+                    if id(expression) not in seen:
+                        seen.add(id(expression))
+                        yield item.model, expression
+        else:
+            yield model, item
+
+
+def _find_expressions(node):
+    if isinstance(node, JoinedColumn):
+        yield node.source
+    elif isinstance(node, Subquery):
+        if getattr(node, 'expression', None) is not None:
+            yield node
+    else:
+        children = getattr(node, 'children', None)
+        if children is None:
+            children = node.get_source_expressions() if hasattr(node, 'get_source_expressions') else []
+        for child in children:
+            if child is not None:
+                for expression in _find_expressions(child):
+                    yield expression
+
+
+def _filter_lookups(model, q):
+    """
+    Yield (field name, lookup) for the lookups in `q` an index on `model` can
+    be used for, i.e. on its own columns in the AND-ed, non negated part of q.
+    """
+    if q.negated or (q.connector != Q.AND and len(q.children) > 1):
+        return
+    for child in q.children:
+        if isinstance(child, Q):
+            for lookup in _filter_lookups(model, child):
+                yield lookup
+        elif isinstance(child, tuple):
+            parts = child[0].split(LOOKUP_SEP)
+            field = _concrete_field(model, parts[0])
+            if field is None or len(parts) > 2:
+                continue
+            if len(parts) == 1:
+                yield field, 'exact'
+            elif model._meta.get_field(field).get_lookup(parts[1]) is not None:
+                yield field, parts[1]
+
+
+def _concrete_field(model, name):
+    """The name of the field of `model` with a column matching `name`"""
+    for field in model._meta.concrete_fields:
+        if name in (field.name, field.attname) or (name == 'pk' and field.primary_key):
+            return field.name
+    return None
+
+
+def _column_names(expression, model):
+    if isinstance(expression, Col):
+        if expression.target.model._meta.concrete_model is model._meta.concrete_model:
+            yield expression.target.name
+        return
+    for source in expression.get_source_expressions():
+        if source is not None:
+            for name in _column_names(source, model):
+                yield name
+    if getattr(expression, 'filter', None) is not None and hasattr(expression.filter, 'get_source_expressions'):
+        for name in _column_names(expression.filter, model):
+            yield name
+
+
+def _unique(names):
+    unique = []
+    for name in names:
+        if name not in unique:
+            unique.append(name)
+    return unique
+
+
+def _existing_indexes(model):
+    """(fields, include) for each index on the model's table"""
+    opts = model._meta
+    for field in opts.concrete_fields:
+        if field.primary_key or field.unique or field.db_index:
+            yield (field.name,), ()
+    for index in opts.indexes:
+        if index.fields:
+            yield tuple(name.lstrip('-') for name in index.fields), tuple(index.include)
+    for constraint in opts.constraints:
+        if isinstance(constraint, UniqueConstraint) and constraint.fields and constraint.condition is None:
+            yield tuple(constraint.fields), tuple(constraint.include)
+    for fields in opts.unique_together:
+        yield tuple(fields), ()
+
+
+def _satisfies(index_fields, include, fields, covering):
+    """
+    Whether an index on `index_fields` serves lookups on `fields`, i.e. starts
+    with them, in any order, and has the `covering` fields.
+    """
+    if set(index_fields[:len(fields)]) != set(fields):
+        return False
+    return set(covering) <= set(index_fields) | set(include)
+
+
+def _is_indexed(model, fields, covering):
+    return any(_satisfies(index_fields, include, fields, covering)
+               for index_fields, include in _existing_indexes(model))
+
+
+def _is_redundant(model, fields, covering, needed):
+    """Whether another needed index on the model serves these lookups too"""
+    for (other_model, other_fields), other_covering in needed.items():
+        if other_model is model and other_fields != fields and other_fields[:len(fields)] == fields:
+            if set(covering) <= set(other_fields) | set(other_covering):
+                return True
+    return False
+
+
+def _build_index(model, fields, covering, connection):
+    include = covering if connection.features.supports_covering_indexes else ()
+    fields = list(fields) + [name for name in covering if name not in include]
+    # Name the index after all of its columns so covering variants don't clash
+    named = models.Index(fields=fields + list(include))
+    named.set_name_with_model(model)
+    return models.Index(fields=fields, include=list(include) or None, name=named.name)
@@ -0,0 +1,245 @@
+"""
+Recording how sql_util expressions affect the queries they are part of.
+
+    from sql_util.instrumentation import instrument
+
+    with instrument() as stats:
+        list(Parent.objects.annotate(child_count=SubqueryCount('child')))
+
+    stats.as_dict()
+
+While the block runs, compiling a sql_util expression records its compile
+time and the size and number of params of its SQL, and executing a query on
+the instrumented connections records its execution time when it contains
+fragments compiled that way. Queries are grouped by fingerprint, their SQL
+with literals and lists of params collapsed, see QueryStats.as_dict().
+"""
+import functools
+import hashlib
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+_local = threading.local()
+
+PERCENTILES = (50, 90, 99)
+
+
+def instrumented(as_sql):
+    """
+    Decorate the as_sql() of a sql_util expression to record its compilation
+    while an instrument() block is active.
+    """
+    @functools.wraps(as_sql)
+    def wrapper(self, compiler, connection, *args, **kwargs):
+        recorder = getattr(_local, 'recorder', None)
+        compiling = getattr(_local, 'compiling', set())
+        if recorder is None or id(self) in compiling:
+            return as_sql(self, compiler, connection, *args, **kwargs)
+
+        _local.compiling = compiling | {id(self)}
+        start = time.perf_counter()
+        try:
+            sql, params = as_sql(self, compiler, connection, *args, **kwargs)
+        finally:
+            _local.compiling = compiling
+        # Only expressions of the outer query tell which query is being compiled
+        outer = not compiling and not getattr(compiler.query, 'subquery', False)
+        recorder.add_fragment(Fragment(annotation_name(compiler.query, self), type(self).__name__,
+                                       time.perf_counter() - start, sql, len(params)),
+                              compiler if outer else None)
+        return sql, params
+    return wrapper
+
+
+def annotation_name(query, expression):
+    for name, annotation in query.annotations.items():
+        if annotation is expression:
+            return name
+    return None
+
+
+class Fragment(object):
+    def __init__(self, annotation, expression, compile_time, sql, param_count):
+        self.annotation = annotation
+        self.expression = expression
+        self.compile_time = compile_time
+        self.sql = sql
+        self.param_count = param_count
+
+    @property
+    def label(self):
+        if self.annotation is None:
+            return self.expression
+        return '{}={}'.format(self.annotation, self.expression)
+
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_placeholder_lists = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_whitespace = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    Return (fingerprint, normalized sql) for `sql`, with literals replaced by
+    placeholders and lists of placeholders collapsed, so queries only differing
+    in their values, or the number of values in IN (...), share a fingerprint.
+    """
+    normalized = _literals.sub('%s', sql)
+    normalized = _placeholder_lists.sub('(...)', normalized)
+    normalized = _whitespace.sub(' ', normalized).strip()
+    return hashlib.md5(normalized.encode()).hexdigest()[:16], normalized
+
+
+def percentiles(values):
+    values = sorted(values)
+    summary = {'count': len(values), 'total': sum(values), 'max': values[-1] if values else None}
+    for percentile in PERCENTILES:
+        # Nearest rank
+        rank = max(0, -(-percentile * len(values) // 100) - 1)
+        summary['p%d' % percentile] = values[rank] if values else None
+    return summary
+
+
+class QueryStats(object):
+    """
+    The queries and sql_util fragments recorded by instrument(), and an
+    optional `callback` called with the dict of each recorded query.
+    """
+    def __init__(self, callback=None, all_queries=False):
+        self.callback = callback
+        self.all_queries = all_queries
+        self.queries = {}
+        # (fragment, whether it was compiled by self._compiler)
+        self._pending = []
+        self._compiler = None
+        self._lock = threading.Lock()
+
+    def add_fragment(self, fragment, compiler=None):
+        """
+        Add a fragment compiled since the last query, by `compiler` when it
+        compiles the outer query. A different compiler starts another query, so
+        the fragments of the previous one, compiled but never executed, e.g. by
+        str(queryset.query), are dropped.
+        """
+        if compiler is not None and compiler is not self._compiler:
+            self._compiler = compiler
+            self._pending = [(pending, outer) for pending, outer in self._pending if not outer]
+        self._pending.append((fragment, compiler is not None))
+
+    def take_fragments(self, sql):
+        """Return the fragments compiled since the last query that are in `sql`"""
+        pending, self._pending, self._compiler = self._pending, [], None
+        return [fragment for fragment, _ in pending if fragment.sql and fragment.sql in sql]
+
+    def add_query(self, alias, sql, param_count, execute_time, fragments):
+        key, normalized = fingerprint(sql)
+        with self._lock:
+            query = self.queries.setdefault(key, {'sql': normalized, 'database': alias, 'execute': [],
+                                                  'sql_size': len(sql), 'params': param_count,
+                                                  'annotations': {}})
+            query['execute'].append(execute_time)
+            for fragment in fragments:
+                annotation = query['annotations'].setdefault(fragment.label, {
+                    'annotation': fragment.annotation,
+                    'expression': fragment.expression,
+                    'compile': [],
+                    'sql_size': len(fragment.sql),
+                    'params': fragment.param_count,
+                })
+                annotation['compile'].append(fragment.compile_time)
+
+        if self.callback is not None:
+            self.callback({
+                'fingerprint': key,
+                'database': alias,
+                'execute': execute_time,
+                'sql_size': len(sql),
+                'params': param_count,
+                'annotations': [{'annotation': f.annotation, 'expression': f.expression, 'compile': f.compile_time,
+                                 'sql_size': len(f.sql), 'params': f.param_count} for f in fragments],
+            })
+
+    def as_dict(self):
+        """
+        Return {fingerprint: stats} with, for each query fingerprint, the
+        normalized SQL, its database, size and number of params, percentiles of
+        the execution time in seconds, and for each sql_util annotation in it
+        the percentiles of its compile time, the size of its SQL and its number
+        of params.
+        """
+        with self._lock:
+            return {
+                key: {
+                    'sql': query['sql'],
+                    'database': query['database'],
+                    'sql_size': query['sql_size'],
+                    'params': query['params'],
+                    'execute': percentiles(query['execute']),
+                    'annotations': {
+                        label: dict(annotation, compile=percentiles(annotation['compile']))
+                        for label, annotation in query['annotations'].items()
+                    },
+                }
+                for key, query in self.queries.items()
+            }
+
+
+class ExecuteWrapper(object):
+    def __init__(self, stats, alias, comment):
+        self.stats = stats
+        self.alias = alias
+        self.comment = comment
+
+    def __call__(self, execute, sql, params, many, context):
+        fragments = self.stats.take_fragments(sql)
+        if not fragments and not self.stats.all_queries:
+            return execute(sql, params, many, context)
+
+        if fragments and self.comment:
+            labels = ', '.join(sorted(set(fragment.label for fragment in fragments)))
+            comment = '/* sql_util: {} */ '.format(labels.replace('*/', ''))
+            if params is not None:
+                comment = comment.replace('%', '%%')
+            sql = comment + sql
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            param_count = len(params) if params is not None and not many else 0
+            self.stats.add_query(self.alias, sql, param_count, time.perf_counter() - start, fragments)
+
+
+@contextmanager
+def instrument(using=None, callback=None, all_queries=False, comment=False):
+    """
+    Record sql_util compile and query execution statistics within the block,
+    for the connections in `using` (an alias or list of aliases, all of them
+    by default), and yield the QueryStats.
+
+    `callback` is called with each recorded query. Queries without sql_util
+    fragments are only recorded with `all_queries`. With `comment`, the
+    annotations are prepended to the SQL in a comment, to find them in the
+    database's logs.
+    """
+    if using is None:
+        aliases = list(connections)
+    elif isinstance(using, str):
+        aliases = [using]
+    else:
+        aliases = list(using)
+
+    stats = QueryStats(callback=callback, all_queries=all_queries)
+    previous = getattr(_local, 'recorder', None)
+    _local.recorder = stats
+    try:
+        with ExitStack() as stack:
+            for alias in aliases:
+                stack.enter_context(connections[alias].execute_wrapper(ExecuteWrapper(stats, alias, comment)))
+            yield stats
+    finally:
+        _local.recorder = previous
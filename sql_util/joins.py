@@ -0,0 +1,455 @@
+import copy
+
+from django.db.models import F, Q, Expression, OuterRef, Window
+from django.db.models.functions import RowNumber
+from django.db.models.sql.constants import LOUTER
+
+from sql_util.instrumentation import instrumented
+from sql_util.strategy import SUBQUERY, GROUPED_JOIN, choose_strategy
+
+# Name of the column holding the correlation key in a derived table
+KEY_COLUMN = 'sql_util_key'
+# Name of the column numbering the related rows in FirstJoin's window query
+RANK_COLUMN = 'sql_util_rank'
+
+
+class SubqueryJoin(object):
+    """
+    A join against a derived table, i.e.
+
+        LEFT OUTER JOIN (SELECT ...) alias ON (outer.column = alias.sql_util_key)
+
+    Instances live in Query.alias_map next to Django's own Join objects, so they
+    provide the same attributes and methods the query and the compiler rely on:
+    table_name, table_alias, parent_alias, join_type, nullable, as_sql() and
+    relabeled_clone().
+
+    `inner_query` is the already resolved query of the derived table, and `lhs`
+    is the resolved outer column compared with the derived table's key column.
+    `relation` identifies what the derived table is computed over, joins with
+    the same relation can be merged into one. `scalar_queries` maps column names
+    to equivalent correlated subqueries, for joins that aren't supported by every
+    backend.
+    """
+    filtered_relation = None
+    join_field = None
+
+    def __init__(self, table_name, parent_alias, relation, columns, inner_query, lhs,
+                 table_alias=None, join_type=LOUTER, nullable=True, scalar_queries=None):
+        self.table_name = table_name
+        self.parent_alias = parent_alias
+        self.table_alias = table_alias
+        self.relation = relation
+        self.columns = columns
+        self.inner_query = inner_query
+        self.lhs = lhs
+        self.join_type = join_type
+        self.nullable = nullable
+        self.scalar_queries = scalar_queries
+
+    @instrumented
+    def as_sql(self, compiler, connection):
+        inner_sql, inner_params = compiler.compile(self.get_inner_query(connection))
+        lhs_sql, lhs_params = compiler.compile(self.lhs)
+        alias = compiler.quote_name_unless_alias(self.table_alias)
+        sql = '%s %s %s ON (%s = %s.%s)' % (self.join_type, inner_sql, alias, lhs_sql, alias,
+                                            connection.ops.quote_name(KEY_COLUMN))
+        return sql, tuple(inner_params) + tuple(lhs_params)
+
+    def get_inner_query(self, connection):
+        """The query of the derived table compiled for `connection`"""
+        return self.inner_query
+
+    def _replace(self, **kwargs):
+        clone = copy.copy(self)
+        for name, value in kwargs.items():
+            setattr(clone, name, value)
+        return clone
+
+    def relabeled_clone(self, change_map):
+        return self._replace(parent_alias=change_map.get(self.parent_alias, self.parent_alias),
+                             table_alias=change_map.get(self.table_alias, self.table_alias),
+                             inner_query=self.inner_query.relabeled_clone(change_map),
+                             lhs=self.lhs.relabeled_clone(change_map) if self.lhs is not None else None,
+                             scalar_queries=None if self.scalar_queries is None else {
+                                 column: query.relabeled_clone(change_map)
+                                 for column, query in self.scalar_queries.items()})
+
+    def compiles_as_join(self, compiler, connection):
+        """
+        Whether the join is part of the SQL compiled by `compiler`. When it
+        isn't, the columns are computed with the correlated subqueries in
+        `scalar_queries` instead.
+        """
+        return True
+
+    def promote(self):
+        return self._replace(join_type=LOUTER)
+
+    def demote(self):
+        # Rows of the outer query without a match in the derived table must be
+        # kept, the join is never turned into an inner join.
+        return self._replace()
+
+    @property
+    def identity(self):
+        return self.__class__, self.table_name, self.parent_alias, self.relation, tuple(self.columns)
+
+    def equals(self, other, *args, **kwargs):
+        return self == other
+
+    def __eq__(self, other):
+        if not isinstance(other, SubqueryJoin):
+            return NotImplemented
+        return self.identity == other.identity
+
+    def __hash__(self):
+        return hash((self.__class__, self.table_name, self.parent_alias, tuple(self.columns)))
+
+
+class AggregateJoin(SubqueryJoin):
+    """
+    A join against a table of aggregates pre-grouped by the correlation key:
+
+        LEFT OUTER JOIN (
+            SELECT child.parent_id AS sql_util_key, COUNT(child.id) AS agg_1, SUM(child.x) AS agg_2
+            FROM child
+            GROUP BY child.parent_id
+        ) child_agg ON (parent.id = child_agg.sql_util_key)
+
+    `relation` is a (model, reverse, outer_ref, filter) tuple as computed by
+    Subquery, and `columns` maps column names to the (unresolved) aggregates.
+    """
+    table_suffix = 'agg'
+
+    @classmethod
+    def add(cls, query, relation, aggregation):
+        """
+        Add `aggregation` over `relation` to the query and return the
+        (alias, column) it can be selected as.
+
+        An aggregate join of the query over the same relation is extended with
+        the new column rather than joining another derived table, that's what
+        lets sibling aggregates share a single pass over the related rows.
+        """
+        for alias, join in query.alias_map.items():
+            if type(join) is cls and join.relation == relation and query.alias_refcount[alias]:
+                for column, existing in join.columns.items():
+                    if existing == aggregation:
+                        query.ref_alias(alias)
+                        return alias, column
+                column = 'agg_%d' % (len(join.columns) + 1)
+                columns = dict(join.columns, **{column: aggregation})
+                query.alias_map[alias] = join._replace(columns=columns, **cls.build(query, relation, columns))
+                query.ref_alias(alias)
+                return alias, column
+
+        model = relation[0]
+        column = 'agg_1'
+        columns = {column: aggregation}
+        join = cls(table_name='%s_%s' % (model._meta.db_table, cls.table_suffix),
+                   parent_alias=query.get_initial_alias(),
+                   relation=relation,
+                   columns=columns,
+                   **cls.build(query, relation, columns))
+        alias, _ = query.table_alias(join.table_name, create=True)
+        join.table_alias = alias
+        query.alias_map[alias] = join
+        return alias, column
+
+    @classmethod
+    def build(cls, query, relation, columns):
+        """
+        Return the attributes of a join computing `columns` over `relation`,
+        resolved against the outer query.
+        """
+        model, reverse, outer_ref, filter = relation
+        queryset = (model._default_manager.filter(filter)
+                    .order_by()
+                    .values(**{KEY_COLUMN: F(reverse)})
+                    .annotate(**columns))
+        return {'inner_query': queryset.query.resolve_expression(query), 'lhs': query.resolve_ref(outer_ref)}
+
+    def output_field(self, column):
+        return self.inner_query.annotations[column].output_field
+
+
+def correlated_queries(query, relation, columns):
+    """
+    Return the correlated subqueries computing each of `columns` over
+    `relation` for a row of the outer query, resolved against it.
+    """
+    model, reverse, outer_ref, filter = relation
+    queryset = (model._default_manager.filter(filter & Q(**{reverse: OuterRef(outer_ref)}))
+                .order_by()
+                .values(reverse))
+    return {column: queryset.annotate(**{column: aggregation}).values(column).query.resolve_expression(query)
+            for column, aggregation in columns.items()}
+
+
+class AutoAggregateJoin(AggregateJoin):
+    """
+    An AggregateJoin for strategy='auto'. Whether the grouped join or the
+    correlated subqueries are used is decided when the outer query is compiled,
+    see sql_util.strategy.
+    """
+    table_suffix = 'auto'
+
+    @classmethod
+    def build(cls, query, relation, columns):
+        attributes = super(AutoAggregateJoin, cls).build(query, relation, columns)
+        attributes['scalar_queries'] = correlated_queries(query, relation, columns)
+        return attributes
+
+    def as_sql(self, compiler, connection):
+        if not self.compiles_as_join(compiler, connection):
+            return '', ()
+        return super(AutoAggregateJoin, self).as_sql(compiler, connection)
+
+    def compiles_as_join(self, compiler, connection):
+        strategy = choose_strategy(compiler, connection, 'aggregate', self.relation, (SUBQUERY, GROUPED_JOIN))
+        return strategy == GROUPED_JOIN
+
+
+def supports_lateral(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'mysql':
+        return not connection.mysql_is_mariadb and connection.mysql_version >= (8, 0, 14)
+    return False
+
+
+class LateralAggregateJoin(AggregateJoin):
+    """
+    A lateral join against the correlated aggregates, computed for each row of
+    the outer query:
+
+        LEFT OUTER JOIN LATERAL (
+            SELECT COUNT(child.id) AS agg_1, SUM(child.x) AS agg_2
+            FROM child
+            WHERE child.parent_id = parent.id
+            GROUP BY child.parent_id
+        ) child_lateral ON TRUE
+
+    This lets the planner choose how to evaluate the correlated scan and returns
+    several aggregates from it. LATERAL is supported by PostgreSQL and MySQL
+    8.0.14+. Elsewhere the join is left out of the SQL and each column is a
+    correlated scalar subquery, like the default 'subquery' strategy.
+    """
+    table_suffix = 'lateral'
+
+    @classmethod
+    def build(cls, query, relation, columns):
+        model, reverse, outer_ref, filter = relation
+        queryset = (model._default_manager.filter(filter & Q(**{reverse: OuterRef(outer_ref)}))
+                    .order_by()
+                    .values(reverse))
+        scalar_queries = correlated_queries(query, relation, columns)
+        inner_query = queryset.annotate(**columns).values(*columns).query.resolve_expression(query)
+        return {'inner_query': inner_query, 'lhs': None, 'scalar_queries': scalar_queries}
+
+    def as_sql(self, compiler, connection):
+        return '', ()
+
+    @instrumented
+    def as_lateral_sql(self, compiler, connection):
+        if not supports_lateral(connection):
+            return self.as_sql(compiler, connection)
+        inner_sql, inner_params = compiler.compile(self.inner_query)
+        alias = compiler.quote_name_unless_alias(self.table_alias)
+        sql = '%s LATERAL %s %s ON TRUE' % (self.join_type, inner_sql, alias)
+        return sql, inner_params
+
+    as_postgresql = as_lateral_sql
+    as_mysql = as_lateral_sql
+
+    def compiles_as_join(self, compiler, connection):
+        return supports_lateral(connection)
+
+
+class FirstJoin(AggregateJoin):
+    """
+    A join against the columns of the first related row of each outer row,
+    in the order given by the relation:
+
+        LEFT OUTER JOIN (
+            SELECT DISTINCT ON (child.parent_id) child.parent_id AS sql_util_key, child.status AS agg_1
+            FROM child
+            ORDER BY child.parent_id, child.timestamp DESC
+        ) child_first ON (parent.id = child_first.sql_util_key)
+
+    on databases supporting DISTINCT ON (PostgreSQL). Elsewhere the related
+    rows are numbered by a window function in a derived table and those
+    numbered 1 are kept:
+
+        LEFT OUTER JOIN (
+            SELECT sql_util_key, agg_1 FROM (
+                SELECT child.parent_id AS sql_util_key, child.status AS agg_1,
+                       ROW_NUMBER() OVER (PARTITION BY child.parent_id ORDER BY child.timestamp DESC) AS sql_util_rank
+                FROM child
+            ) sql_util_ranked WHERE sql_util_rank = 1
+        ) child_first ON (parent.id = child_first.sql_util_key)
+
+    `relation` is a (model, reverse, outer_ref, filter, ordering) tuple and
+    `columns` maps column names to expressions over the related model.
+    """
+    table_suffix = 'first'
+
+    def __init__(self, *args, **kwargs):
+        self.distinct_query = kwargs.pop('distinct_query', None)
+        super(FirstJoin, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def build(cls, query, relation, columns):
+        model, reverse, outer_ref, filter, ordering = relation
+        queryset = model._default_manager.filter(filter).annotate(**{KEY_COLUMN: F(reverse)}).annotate(**columns)
+        # Window accepts '-field' strings from Django 4.1
+        order_by = [F(name[1:]).desc() if name.startswith('-') else F(name).asc() for name in ordering]
+        ranked = (queryset.annotate(**{RANK_COLUMN: Window(RowNumber(), partition_by=F(reverse), order_by=order_by)})
+                  .order_by()
+                  .values(KEY_COLUMN, RANK_COLUMN, *columns))
+        distinct = queryset.order_by(KEY_COLUMN, *ordering).distinct(KEY_COLUMN).values(KEY_COLUMN, *columns)
+        return {'inner_query': ranked.query.resolve_expression(query),
+                'distinct_query': distinct.query.resolve_expression(query),
+                'lhs': query.resolve_ref(outer_ref)}
+
+    def get_inner_query(self, connection):
+        if connection.features.can_distinct_on_fields:
+            return self.distinct_query
+        return FirstRows(self.inner_query, list(self.columns))
+
+    def relabeled_clone(self, change_map):
+        clone = super(FirstJoin, self).relabeled_clone(change_map)
+        clone.distinct_query = self.distinct_query.relabeled_clone(change_map)
+        return clone
+
+
+class FirstRows(object):
+    """
+    The rows numbered 1 of `query`, a query selecting the key, the rank and
+    `columns`. Filtering on a window function needs a derived table, Django
+    only filters on them itself from 4.2.
+    """
+    def __init__(self, query, columns):
+        self.query = query
+        self.columns = columns
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.query)
+        columns = ', '.join(connection.ops.quote_name(column) for column in [KEY_COLUMN] + self.columns)
+        return '(SELECT %s FROM %s %s WHERE %s = 1)' % (columns, sql, connection.ops.quote_name('sql_util_ranked'),
+                                                        connection.ops.quote_name(RANK_COLUMN)), params
+
+
+def first_queries(query, relation, columns):
+    """
+    Return the correlated subqueries selecting each of `columns` from the
+    first related row of `relation`, resolved against the outer query.
+    """
+    model, reverse, outer_ref, filter, ordering = relation
+    queryset = (model._default_manager.filter(filter & Q(**{reverse: OuterRef(outer_ref)}))
+                .annotate(**columns)
+                .order_by(*ordering))
+    return {column: queryset.values(column)[:1].query.resolve_expression(query) for column in columns}
+
+
+class LateralFirstJoin(LateralAggregateJoin):
+    """
+    A lateral join against the first related row, ORDER BY ... LIMIT 1 for
+    each row of the outer query, on the databases supporting LATERAL.
+    """
+    table_suffix = 'first_lateral'
+
+    @classmethod
+    def build(cls, query, relation, columns):
+        model, reverse, outer_ref, filter, ordering = relation
+        queryset = (model._default_manager.filter(filter & Q(**{reverse: OuterRef(outer_ref)}))
+                    .annotate(**columns)
+                    .order_by(*ordering))
+        inner_query = queryset.values(*columns)[:1].query.resolve_expression(query)
+        return {'inner_query': inner_query, 'lhs': None, 'scalar_queries': first_queries(query, relation, columns)}
+
+
+class KeysJoin(SubqueryJoin):
+    """
+    A join against the distinct keys of the related rows:
+
+        LEFT OUTER JOIN (
+            SELECT DISTINCT child.parent_id AS sql_util_key FROM child WHERE child.parent_id IS NOT NULL AND ...
+        ) child_keys ON (parent.id = child_keys.sql_util_key)
+
+    The rows of the outer query without related rows, including those with a
+    NULL outer column, are the ones where the key is NULL: the anti-join of
+    NOT EXISTS. The keys are distinct, so the join doesn't repeat outer rows.
+
+    `relation` is a (model, reverse, outer_ref, filter) tuple as computed by
+    Subquery.
+    """
+    table_suffix = 'keys'
+
+    @classmethod
+    def add(cls, query, relation):
+        """Join the keys of `relation` to the query, once, and return its alias"""
+        for alias, join in query.alias_map.items():
+            if type(join) is cls and join.relation == relation and query.alias_refcount[alias]:
+                query.ref_alias(alias)
+                return alias
+        model = relation[0]
+        join = cls(table_name='%s_%s' % (model._meta.db_table, cls.table_suffix),
+                   parent_alias=query.get_initial_alias(),
+                   relation=relation,
+                   columns=[],
+                   **cls.build(query, relation))
+        alias, _ = query.table_alias(join.table_name, create=True)
+        join.table_alias = alias
+        query.alias_map[alias] = join
+        return alias
+
+    @classmethod
+    def build(cls, query, relation):
+        model, reverse, outer_ref, filter = relation
+        queryset = (model._default_manager.filter(filter & Q(**{reverse + '__isnull': False}))
+                    .order_by()
+                    .values(**{KEY_COLUMN: F(reverse)})
+                    .distinct())
+        return {'inner_query': queryset.query.resolve_expression(query), 'lhs': query.resolve_ref(outer_ref)}
+
+    def output_field(self):
+        return self.inner_query.annotations[KEY_COLUMN].output_field
+
+
+class JoinedColumn(Expression):
+    """
+    A reference to a column of a SubqueryJoin, optionally replacing NULL, which
+    is what rows without a match in the derived table get, with `default`.
+
+    When the join isn't part of the SQL for the connection, the column compiles
+    to the join's correlated subquery for it instead.
+    """
+    def __init__(self, alias, column, output_field, default=None, source=None):
+        super(JoinedColumn, self).__init__(output_field=output_field)
+        self.alias = alias
+        self.column = column
+        self.default = default
+        # The sql_util expression this column was resolved from
+        self.source = source
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.alias, self.column)
+
+    @instrumented
+    def as_sql(self, compiler, connection):
+        join = compiler.query.alias_map.get(self.alias)
+        if isinstance(join, SubqueryJoin) and not join.compiles_as_join(compiler, connection):
+            sql, params = compiler.compile(join.scalar_queries[self.column])
+        else:
+            sql, params = '%s.%s' % (compiler.quote_name_unless_alias(self.alias),
+                                     connection.ops.quote_name(self.column)), ()
+        if self.default is None:
+            return sql, params
+        return 'COALESCE(%s, %%s)' % sql, tuple(params) + (self.default,)
+
+    def relabeled_clone(self, change_map):
+        clone = self.copy()
+        clone.alias = change_map.get(self.alias, self.alias)
+        return clone
@@ -0,0 +1,310 @@
+"""
+Denormalized aggregate columns kept up to date as the related rows change.
+
+    total_sales = maintain_aggregate(Seller.total_sales, SubqueryCount('sale'))
+
+adjusts Seller.total_sales of the seller of every Sale inserted, deleted or
+moved to another seller, instead of recomputing it over all the sales.
+"""
+from django.db import connections, router
+from django.db.backends.utils import truncate_name
+from django.db.models import Count, F, Sum, Value
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Col, RawSQL
+from django.db.models.fields.related import ForeignKey
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.db.models.sql import Query, UpdateQuery
+
+from sql_util.aggregates import SubqueryAggregate
+from sql_util.refresh import IsDistinctFrom, refresh_aggregate
+
+SIGNALS = 'signals'
+TRIGGERS = 'triggers'
+BACKENDS = (SIGNALS, TRIGGERS)
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+def maintain_aggregate(field, expression, backend=SIGNALS):
+    """
+    Keep `field`, e.g. Seller.total_sales, equal to `expression`, a
+    SubqueryAggregate over a foreign key to the field's model, e.g.
+    SubqueryCount('sale').
+
+    The 'signals' backend updates the field from the post_save and post_delete
+    signals of the related model and is connected right away. The 'triggers'
+    backend generates database triggers, created by MaintainedAggregate.install()
+    or the statements of install_sql() in a migration.
+
+    Return the MaintainedAggregate.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {!r}, expected one of {}'.format(backend, ', '.join(BACKENDS)))
+    maintained = MaintainedAggregate(field, expression)
+    if backend == SIGNALS:
+        maintained.connect()
+    return maintained
+
+
+class MaintainedAggregate(object):
+    """
+    A field holding an aggregate of the rows related to it by a foreign key.
+
+    Count and Sum without filter or distinct are incremental: the field is
+    changed by the count or the value of the rows inserted and deleted, and a
+    row moved to another parent is subtracted from the old one and added to
+    the new one. The other aggregates are recomputed for the parents of the
+    rows changed. A Sum is 0 rather than NULL for parents without rows.
+
+    bulk_create() and QuerySet.update() don't send signals, rows changed by them
+    are only accounted for by the triggers.
+    """
+    def __init__(self, field, expression):
+        self.field = getattr(field, 'field', field)
+        self.model = self.field.model
+        if not isinstance(expression, SubqueryAggregate) or getattr(expression, 'expression', None) is None:
+            raise TypeError('maintain_aggregate() takes a SubqueryAggregate over a relation, got {!r}'.format(
+                expression))
+        self.expression = expression
+
+        query = Query(self.model)
+        self.related_model, reverse, self.outer_ref = expression._resolve_path(query, True, None, False)
+        foreign_key = None
+        if LOOKUP_SEP not in reverse:
+            foreign_key = self.related_model._meta.get_field(reverse)
+        if not isinstance(foreign_key, ForeignKey) or foreign_key.target_field.model != self.model:
+            raise ValueError('maintain_aggregate() only maintains aggregates over a foreign key to {}, '
+                             'not {}'.format(self.model._meta.label, expression._get_lookup_name()))
+        self.foreign_key = foreign_key
+
+        aggregation = expression._get_annotation(query, True, None, False)['aggregation']
+        source = aggregation.get_source_expressions()[0]
+        # The aggregated column, when it is a column of the related model
+        self.column = None
+        if isinstance(source, Col) and source.target.model == self.related_model:
+            self.column = source.target
+        self.aggregate = type(aggregation)
+        self.distinct = aggregation.distinct
+        # Whether the aggregate is adjusted by deltas rather than recomputed
+        self.incremental = (self.aggregate in (Count, Sum) and not self.distinct and not expression.filter
+                            and self.column is not None)
+
+    @property
+    def name(self):
+        return 'sql_util_{}_{}'.format(self.model._meta.db_table, self.field.column)
+
+    def get_expression(self):
+        """The expression the field is equal to"""
+        if self.aggregate is Sum and self.incremental:
+            return Coalesce(self.expression, Value(0), output_field=self.field)
+        return self.expression
+
+    def verify(self, using=None):
+        """
+        Return the primary keys of the rows where the field differs from a full
+        recompute of the aggregate.
+        """
+        using = using or router.db_for_read(self.model)
+        return list(self.model._base_manager.using(using)
+                    .filter(IsDistinctFrom(F(self.field.name), self.get_expression()))
+                    .order_by('pk')
+                    .values_list('pk', flat=True))
+
+    def rebuild(self, **kwargs):
+        """Recompute the field for every row, see sql_util.refresh.refresh_aggregate()"""
+        return refresh_aggregate(self.model, **dict(kwargs, **{self.field.name: self.get_expression()}))
+
+    # Signals
+
+    def connect(self):
+        dispatch_uid = self.name
+        pre_save.connect(self.pre_save, sender=self.related_model, weak=False, dispatch_uid=dispatch_uid)
+        post_save.connect(self.post_save, sender=self.related_model, weak=False, dispatch_uid=dispatch_uid)
+        post_delete.connect(self.post_delete, sender=self.related_model, weak=False, dispatch_uid=dispatch_uid)
+
+    def disconnect(self):
+        dispatch_uid = self.name
+        pre_save.disconnect(sender=self.related_model, dispatch_uid=dispatch_uid)
+        post_save.disconnect(sender=self.related_model, dispatch_uid=dispatch_uid)
+        post_delete.disconnect(sender=self.related_model, dispatch_uid=dispatch_uid)
+
+    def get_columns(self):
+        """
+        The columns of the related model the aggregate depends on, None when
+        it may depend on any of them.
+        """
+        if self.column is None or self.expression.filter:
+            return None
+        if self.aggregate is Count and not self.distinct and not self.column.null:
+            return [self.foreign_key]
+        return [self.foreign_key, self.column]
+
+    def get_row_fields(self):
+        return [self.foreign_key] + ([self.column] if self.column is not None else [])
+
+    def pre_save(self, sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+        # Remember the row as it was before the update
+        old = None
+        columns = self.get_columns()
+        changes = update_fields is None or columns is None or any(c.name in update_fields for c in columns)
+        if instance.pk is not None and changes:
+            names = [field.attname for field in self.get_row_fields()]
+            old = sender._base_manager.using(using).filter(pk=instance.pk).values_list(*names).first()
+        instance.__dict__[self.name] = old
+
+    def post_save(self, sender, instance, created=False, using=None, update_fields=None, **kwargs):
+        old = instance.__dict__.pop(self.name, None)
+        columns = self.get_columns()
+        if not created and old is None and update_fields is not None and columns is not None:
+            # None of the columns were saved
+            return
+        new = self.get_row(instance)
+        if old == new and columns is not None:
+            return
+        if not self.incremental:
+            self.recompute(using, [row[0] for row in (old, new) if row is not None])
+            return
+        deltas = {}
+        if old is not None:
+            self.add_delta(deltas, old, -1)
+        self.add_delta(deltas, new, 1)
+        self.apply(using, deltas)
+
+    def post_delete(self, sender, instance, using=None, **kwargs):
+        row = self.get_row(instance)
+        if not self.incremental:
+            self.recompute(using, [row[0]])
+            return
+        deltas = {}
+        self.add_delta(deltas, row, -1)
+        self.apply(using, deltas)
+
+    def get_row(self, instance):
+        return tuple(getattr(instance, field.attname) for field in self.get_row_fields())
+
+    def add_delta(self, deltas, row, sign):
+        key, value = row
+        if key is None or value is None:
+            return
+        deltas[key] = deltas.get(key, 0) + sign * (1 if self.aggregate is Count else value)
+
+    def apply(self, using, deltas):
+        for key, delta in deltas.items():
+            if delta:
+                value = Coalesce(F(self.field.name), Value(0), output_field=self.field)
+                value += Value(delta, output_field=self.field)
+                self.get_parents(using, key).update(**{self.field.name: value})
+
+    def recompute(self, using, keys):
+        keys = {key for key in keys if key is not None}
+        if keys:
+            self.get_parents(using, *keys).update(**{self.field.name: self.get_expression()})
+
+    def get_parents(self, using, *keys):
+        return self.model._base_manager.using(using).filter(**{self.outer_ref + '__in': keys})
+
+    # Triggers
+
+    def install(self, using=None):
+        """Create the triggers on the `using` database"""
+        self.execute(using, self.install_sql)
+
+    def uninstall(self, using=None):
+        """Drop the triggers from the `using` database"""
+        self.execute(using, self.uninstall_sql)
+
+    def execute(self, using, get_statements):
+        connection = connections[using or router.db_for_write(self.related_model)]
+        with connection.cursor() as cursor:
+            for statement in get_statements(connection):
+                cursor.execute(statement)
+
+    def install_sql(self, connection):
+        """
+        Return the statements creating the triggers on `connection`, e.g. for a
+        RunSQL migration operation.
+        """
+        statements = []
+        for event in (INSERT, UPDATE, DELETE):
+            statements.extend(self.trigger_sql(connection, event))
+        return statements
+
+    def uninstall_sql(self, connection):
+        quote_name = connection.ops.quote_name
+        statements = []
+        for event in (INSERT, UPDATE, DELETE):
+            name = quote_name(self.trigger_name(connection, event))
+            if connection.vendor == 'postgresql':
+                statements.append('DROP TRIGGER IF EXISTS {} ON {}'.format(
+                    name, quote_name(self.related_model._meta.db_table)))
+                statements.append('DROP FUNCTION IF EXISTS {}()'.format(name))
+            else:
+                statements.append('DROP TRIGGER IF EXISTS {}'.format(name))
+        return statements
+
+    def trigger_name(self, connection, event):
+        return truncate_name('{}_{}'.format(self.name, event), connection.ops.max_name_length())
+
+    def trigger_sql(self, connection, event):
+        quote_name = connection.ops.quote_name
+        body = '; '.join(self.trigger_body(connection, event))
+        name = quote_name(self.trigger_name(connection, event))
+        table = quote_name(self.related_model._meta.db_table)
+        when = event.upper()
+        columns = self.get_columns()
+        if event == UPDATE and columns is not None and connection.vendor != 'mysql':
+            # MySQL triggers can't be limited to updates of some columns
+            when += ' OF {}'.format(', '.join(quote_name(column.column) for column in columns))
+
+        if connection.vendor == 'sqlite' or connection.vendor == 'mysql':
+            return ['CREATE TRIGGER {} AFTER {} ON {} FOR EACH ROW BEGIN {}; END'.format(name, when, table, body)]
+        if connection.vendor == 'postgresql':
+            return [
+                'CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$ BEGIN {}; RETURN NULL; END; $$ '
+                'LANGUAGE plpgsql'.format(name, body),
+                'CREATE TRIGGER {} AFTER {} ON {} FOR EACH ROW EXECUTE FUNCTION {}()'.format(name, when, table, name),
+            ]
+        raise NotImplementedError('maintain_aggregate() triggers are not supported on {}'.format(connection.vendor))
+
+    def trigger_body(self, connection, event):
+        """The UPDATE statements run by the trigger of `event`"""
+        rows = {INSERT: ['NEW'], UPDATE: ['OLD', 'NEW'], DELETE: ['OLD']}[event]
+        if not self.incremental:
+            keys = [self.row_sql(connection, row, self.foreign_key, self.foreign_key.target_field) for row in rows]
+            return [self.update_sql(connection, keys, self.get_expression())]
+
+        statements = []
+        for row in rows:
+            key = self.row_sql(connection, row, self.foreign_key, self.foreign_key.target_field)
+            value = self.row_sql(connection, row, self.column, self.field)
+            if self.aggregate is Count:
+                if self.column.null:
+                    value = RawSQL('CASE WHEN {} IS NULL THEN 0 ELSE 1 END'.format(value.sql), (),
+                                   output_field=self.field)
+                else:
+                    value = Value(1, output_field=self.field)
+            else:
+                value = Coalesce(value, Value(0), output_field=self.field)
+            current = Coalesce(F(self.field.name), Value(0), output_field=self.field)
+            statements.append(self.update_sql(connection, [key], current - value if row == 'OLD' else current + value))
+        return statements
+
+    def row_sql(self, connection, row, field, output_field):
+        """The column of `field` in the OLD or NEW row of a trigger"""
+        return RawSQL('{}.{}'.format(row, connection.ops.quote_name(field.column)), (), output_field=output_field)
+
+    def update_sql(self, connection, keys, value):
+        """
+        UPDATE of the field of the rows with `keys`, with the params inlined
+        since triggers don't take any.
+        """
+        queryset = self.model._base_manager.filter(**{self.outer_ref + '__in': keys})
+        query = queryset.query.chain(UpdateQuery)
+        query.add_update_values({self.field.name: value})
+        query.annotations = {}
+        sql, params = query.get_compiler(connection=connection).as_sql()
+        quote_value = connection.schema_editor().quote_value
+        return sql % tuple(quote_value(param) for param in params)
@@ -0,0 +1,43 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from sql_util.refresh import refresh_aggregate
+
+
+class Command(BaseCommand):
+    help = ('Recompute denormalized aggregate fields of a model in chunks of rows, each updated in its own '
+            'transaction.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model, as app_label.ModelName.')
+        parser.add_argument('aggregates', nargs='+', metavar='field=path',
+                            help='A field and the dotted path to its expression, or to a function returning it.')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Rows updated per transaction.')
+        parser.add_argument('--checkpoint',
+                            help='A file the progress is saved to, and resumed from when the refresh is restarted.')
+        parser.add_argument('--workers', type=int, default=1, help='Ranges of rows refreshed in parallel.')
+        parser.add_argument('--database', help='The database to refresh, by default the model\'s.')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        aggregates = {}
+        for argument in options['aggregates']:
+            field, _, path = argument.partition('=')
+            if not path:
+                raise CommandError('Expected field=path, got {!r}'.format(argument))
+            expression = import_string(path)
+            aggregates[field] = expression() if callable(expression) else expression
+
+        def callback(low, high, updated):
+            if options['verbosity'] > 1:
+                self.stdout.write('Refreshed pk {} to {}: {} rows updated'.format(low, high, updated))
+
+        stats = refresh_aggregate(model, chunk_size=options['chunk_size'], checkpoint=options['checkpoint'],
+                                  workers=options['workers'], using=options['database'], callback=callback,
+                                  **aggregates)
+        self.stdout.write('{} rows updated in {} chunks.'.format(stats['updated'], stats['chunks']))
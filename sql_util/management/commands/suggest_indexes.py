@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.db.migrations.writer import OperationWriter
+from django.utils.module_loading import import_string
+
+from sql_util.indexes import suggest_indexes
+
+
+class Command(BaseCommand):
+    help = ('Print the migration operations adding the indexes needed by the sql_util expressions '
+            'of the given querysets.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('querysets', nargs='+',
+                            help='Dotted paths to querysets, or to functions returning a queryset.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='The database the indexes are for, defaults to the "default" database.')
+
+    def handle(self, *args, **options):
+        querysets = []
+        for path in options['querysets']:
+            queryset = import_string(path)
+            querysets.append(queryset() if callable(queryset) else queryset)
+
+        suggestions = suggest_indexes(*querysets, using=options['database'])
+        if not suggestions:
+            self.stdout.write('No indexes needed.')
+        for app_label, operations in suggestions.items():
+            self.stdout.write('# {}'.format(app_label))
+            for operation in operations:
+                self.stdout.write(OperationWriter(operation, indentation=0).serialize()[0])
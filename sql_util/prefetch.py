@@ -0,0 +1,114 @@
+from django.db import connections, router
+from django.db.models import F
+from django.db.models.sql import Query
+
+from sql_util.aggregates import SubqueryAggregate, Exists
+from sql_util.joins import KEY_COLUMN
+
+
+def prefetch_aggregates(instances, **aggregates):
+    """
+    Compute sql_util aggregates for already fetched model instances and set
+    them as attributes, like the annotations of a queryset would be:
+
+    parents = list(Parent.objects.all()[:50])
+    prefetch_aggregates(parents, child_count=SubqueryCount('child'), has_toys=Exists('child__toy'))
+
+    The aggregates over the same relation and filter are computed together, in
+    one query per relation grouped by the related key:
+
+    SELECT child.parent_id, COUNT(child.id) FROM child WHERE child.parent_id IN (...) GROUP BY child.parent_id
+
+    Instances without related rows get the value of the aggregate over no rows,
+    0 for counts, False for Exists and None otherwise.
+
+    The keys are sent in batches that keep the queries under the database's
+    limit on the number of params, or of `batch_size` keys. The queries run on
+    the `using` database, by default the one the instances were read from.
+    Return the list of instances.
+    """
+    using = aggregates.pop('using', None)
+    batch_size = aggregates.pop('batch_size', None)
+    instances = list(instances)
+    if not instances or not aggregates:
+        return instances
+
+    model = type(instances[0])
+    query = Query(model)
+    relations = []
+    for name, expression in aggregates.items():
+        if getattr(expression, 'expression', None) is None or not isinstance(expression, (SubqueryAggregate, Exists)):
+            raise TypeError('prefetch_aggregates() takes SubqueryAggregates and Exists over a relation, '
+                            'got {!r} for {}'.format(expression, name))
+        inner_model, reverse, outer_ref = expression._resolve_path(query, True, None, False)
+        relation = (inner_model, reverse, outer_ref, expression.filter)
+        for existing, columns in relations:
+            if existing == relation:
+                break
+        else:
+            columns = {}
+            relations.append((relation, columns))
+        columns[name] = expression
+
+    for relation, columns in relations:
+        db = using or instances[0]._state.db or router.db_for_read(relation[0], instance=instances[0])
+        values = _fetch(connections[db], model, relation, columns, instances, batch_size)
+        for instance in instances:
+            key = getattr(instance, _outer_field(model, relation[2]).attname)
+            row = values.get(key)
+            for name, expression in columns.items():
+                if isinstance(expression, Exists):
+                    value = (row is not None) != expression.negated
+                else:
+                    value = row[name] if row is not None else expression.empty_value
+                setattr(instance, name, value)
+    return instances
+
+
+def _outer_field(model, outer_ref):
+    return model._meta.pk if outer_ref == 'pk' else model._meta.get_field(outer_ref)
+
+
+def _fetch(connection, model, relation, columns, instances, batch_size):
+    """
+    Return {key: {name: value}} with the aggregates in `columns` for the keys
+    of `instances` that have rows in `relation`.
+    """
+    inner_model, reverse, outer_ref, filter = relation
+    query = Query(model)
+    aggregations = {name: expression._get_annotation(query, True, None, False)['aggregation']
+                    for name, expression in columns.items() if not isinstance(expression, Exists)}
+
+    attname = _outer_field(model, outer_ref).attname
+    keys = list(dict.fromkeys(getattr(instance, attname) for instance in instances))
+    if None in keys:
+        keys.remove(None)
+
+    def get_queryset(batch):
+        queryset = (inner_model._default_manager.using(connection.alias)
+                    .filter(filter, **{reverse + '__in': batch})
+                    .order_by()
+                    .values(**{KEY_COLUMN: F(reverse)}))
+        if aggregations:
+            return queryset.annotate(**aggregations)
+        return queryset.distinct()
+
+    values = {}
+    size = batch_size or _batch_size(connection, get_queryset, keys)
+    for start in range(0, len(keys), size):
+        for row in get_queryset(keys[start:start + size]):
+            values[row.pop(KEY_COLUMN)] = row
+    return values
+
+
+def _batch_size(connection, get_queryset, keys):
+    """
+    The number of keys per query that keeps it under the database's limit on
+    the number of params, all of them when there is no limit.
+    """
+    limit = connection.features.max_query_params
+    if limit is None or not keys:
+        return max(len(keys), 1)
+    _, params = get_queryset(keys[:1]).query.get_compiler(connection=connection).as_sql()
+    # The other params are the filter's
+    return max(limit - (len(params) - 1), 1)
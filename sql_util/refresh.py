@@ -0,0 +1,220 @@
+"""
+Recomputing denormalized aggregate columns in chunks.
+
+    refresh_aggregate(Seller, total_sales=SubqueryCount('sale'), chunk_size=10000)
+
+is what Seller.objects.update(total_sales=SubqueryCount('sale')) does, but the
+table is walked in primary key order, chunk_size rows at a time, each chunk
+updated in its own transaction. Locks are only held for a chunk and rows
+already holding the right values aren't written at all.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.db.models import BooleanField, Expression, F, Q
+
+
+def refresh_aggregate(model, chunk_size=10000, checkpoint=None, workers=1, queryset=None, using=None,
+                      callback=None, **aggregates):
+    """
+    Set the fields of `model` named by the keywords of `aggregates` to the
+    value of their expressions, `chunk_size` rows per UPDATE and transaction.
+
+    `queryset` restricts the rows refreshed. With `checkpoint`, the path of a
+    JSON file, the progress is saved after each chunk and a refresh of the same
+    model and fields started with that file resumes where it stopped. The file
+    is removed when the refresh completes.
+
+    With `workers` greater than 1, the primary keys are split into as many
+    ranges, refreshed in parallel by threads with their own connections,
+    except on SQLite which only has one writer at a time.
+
+    `callback` is called with (first pk, last pk, rows updated) after each
+    chunk. Return a dict with the number of `chunks` and of rows `updated`.
+    """
+    if not aggregates:
+        raise ValueError('refresh_aggregate() needs at least one field=expression')
+    for name in aggregates:
+        model._meta.get_field(name)
+    using = using or router.db_for_write(model)
+    if queryset is None:
+        queryset = model._base_manager.all()
+    queryset = queryset.using(using).order_by()
+
+    progress = Progress(checkpoint, model, aggregates)
+    ranges = progress.load()
+    if ranges is None:
+        ranges = split(queryset, workers)
+        progress.start(ranges)
+
+    stats = {'chunks': 0, 'updated': 0}
+    lock = threading.Lock()
+
+    def refresh_range(index):
+        position, _, high = progress.ranges[index]
+        try:
+            for chunk_low, chunk_high, updated in refresh_chunks(queryset, aggregates, position, high, chunk_size,
+                                                                 using):
+                progress.save(index, chunk_high)
+                with lock:
+                    stats['chunks'] += 1
+                    stats['updated'] += updated
+                if callback is not None:
+                    callback(chunk_low, chunk_high, updated)
+        finally:
+            if parallel:
+                connections[using].close()
+
+    # SQLite has a single writer, the ranges are refreshed one after the other
+    parallel = workers > 1 and len(progress.ranges) > 1 and connections[using].vendor != 'sqlite'
+    if parallel:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(refresh_range, index) for index in range(len(progress.ranges))]:
+                future.result()
+    else:
+        for index in range(len(progress.ranges)):
+            refresh_range(index)
+
+    progress.finish()
+    return stats
+
+
+def split(queryset, workers):
+    """
+    Return [position, low, high] for `workers` ranges of primary keys: the
+    rows of a range have low < pk <= high, with None for no bound, and
+    position is the last pk refreshed, initially low.
+    """
+    bounds = [None]
+    if workers > 1:
+        count = queryset.count()
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        for i in range(1, workers):
+            offset = count * i // workers
+            if 0 < offset < count:
+                bound = pks[offset - 1]
+                if bound != bounds[-1]:
+                    bounds.append(bound)
+    bounds.append(None)
+    return [[low, low, high] for low, high in zip(bounds, bounds[1:])]
+
+
+def refresh_chunks(queryset, aggregates, low, high, chunk_size, using):
+    """
+    Refresh the rows with low < pk <= high, chunk_size at a time, and yield
+    (first pk, last pk, rows updated) for each chunk.
+    """
+    while True:
+        rows = queryset.order_by('pk')
+        if low is not None:
+            rows = rows.filter(pk__gt=low)
+        if high is not None:
+            rows = rows.filter(pk__lte=high)
+        pks = list(rows.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return
+        with transaction.atomic(using=using):
+            updated = update_changed(queryset.filter(pk__gte=pks[0], pk__lte=pks[-1]), aggregates)
+        yield pks[0], pks[-1], updated
+        low = pks[-1]
+
+
+def update_changed(queryset, aggregates):
+    """
+    Update the rows of `queryset` where one of the fields differs from its
+    aggregate, NULL being equal to NULL, and return their number.
+    """
+    changed = Q()
+    for name, expression in aggregates.items():
+        changed |= Q(IsDistinctFrom(F(name), expression))
+    return queryset.filter(changed).update(**aggregates)
+
+
+class IsDistinctFrom(Expression):
+    """
+    lhs IS DISTINCT FROM rhs, i.e. lhs <> rhs where NULL equals NULL, in the
+    syntax of each database.
+    """
+    conditional = True
+    output_field = BooleanField()
+
+    def __init__(self, lhs, rhs):
+        super(IsDistinctFrom, self).__init__()
+        self.lhs = lhs
+        self.rhs = rhs
+
+    def get_source_expressions(self):
+        return [self.lhs, self.rhs]
+
+    def set_source_expressions(self, exprs):
+        self.lhs, self.rhs = exprs
+
+    def compile_sides(self, compiler):
+        lhs_sql, lhs_params = compiler.compile(self.lhs)
+        rhs_sql, rhs_params = compiler.compile(self.rhs)
+        return lhs_sql, rhs_sql, tuple(lhs_params) + tuple(rhs_params)
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, rhs_sql, params = self.compile_sides(compiler)
+        return '%s IS DISTINCT FROM %s' % (lhs_sql, rhs_sql), params
+
+    def as_sqlite(self, compiler, connection):
+        lhs_sql, rhs_sql, params = self.compile_sides(compiler)
+        return '%s IS NOT %s' % (lhs_sql, rhs_sql), params
+
+    def as_mysql(self, compiler, connection):
+        lhs_sql, rhs_sql, params = self.compile_sides(compiler)
+        return 'NOT (%s <=> %s)' % (lhs_sql, rhs_sql), params
+
+    def as_oracle(self, compiler, connection):
+        lhs_sql, rhs_sql, params = self.compile_sides(compiler)
+        return 'DECODE(%s, %s, 0, 1) = 1' % (lhs_sql, rhs_sql), params
+
+
+class Progress(object):
+    """
+    The ranges being refreshed, saved to the `path` JSON file, if any, after
+    each chunk.
+    """
+    def __init__(self, path, model, aggregates):
+        self.path = path
+        self.key = {'model': model._meta.label, 'fields': sorted(aggregates)}
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Return the saved ranges of the same refresh, or None"""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            saved = json.load(f)
+        if {key: saved.get(key) for key in self.key} != self.key:
+            raise ValueError('{} is the checkpoint of a refresh of {} {}'.format(self.path, saved.get('model'),
+                                                                              ', '.join(saved.get('fields', []))))
+        self.ranges = saved['ranges']
+        return self.ranges
+
+    def start(self, ranges):
+        self.ranges = ranges
+        self.write()
+
+    def save(self, index, position):
+        with self.lock:
+            self.ranges[index][0] = position
+            self.write()
+
+    def write(self):
+        if self.path is None:
+            return
+        temporary = '{}.tmp'.format(self.path)
+        with open(temporary, 'w') as f:
+            json.dump(dict(self.key, ranges=self.ranges), f, cls=DjangoJSONEncoder)
+        os.replace(temporary, self.path)
+
+    def finish(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,231 @@
+"""
+Rewriting aggregates over joined multi-valued relations into subqueries.
+
+    Parent.objects.annotate(n=Count('child'), total=Sum('toy__price'))
+
+joins the children and the toys, which multiplies the rows each aggregate
+sees, and groups by every column of the parent. subqueryize() rewrites the
+aggregates into the equivalent SubqueryCount and SubquerySum, drops the joins
+and the GROUP BY:
+
+    subqueryize(Parent.objects.annotate(n=Count('child'), total=Sum('toy__price')))
+
+Each decision, rewritten or not and why, is a Rewrite returned by
+find_rewrites() and logged to the 'sql_util.rewrite' logger.
+"""
+import copy
+import logging
+from collections import namedtuple
+
+from django.core.exceptions import FieldError
+from django.db.models import Avg, Count, Max, Min, Q, Sum
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Col
+from django.db.models.lookups import Lookup
+from django.db.models.sql import Query
+from django.db.models.sql.datastructures import Join
+from django.db.models.sql.where import WhereNode
+
+from sql_util.aggregates import SubqueryAvg, SubqueryCount, SubqueryMax, SubqueryMin, SubquerySum
+from sql_util.dedupe import replace_expressions
+
+logger = logging.getLogger('sql_util.rewrite')
+
+SUBQUERY_AGGREGATES = {Count: SubqueryCount, Sum: SubquerySum, Min: SubqueryMin, Max: SubqueryMax,
+                       Avg: SubqueryAvg}
+
+# An aggregate annotation of a queryset: the `replacement` it's rewritten to,
+# or None with the `reason` it isn't.
+Rewrite = namedtuple('Rewrite', ['name', 'original', 'replacement', 'reason'])
+
+
+class NotRewritable(Exception):
+    pass
+
+
+def subqueryize(queryset):
+    """
+    Return a copy of `queryset` with its Count, Sum, Min, Max and Avg
+    annotations over multi-valued relations replaced by sql_util subqueries,
+    see find_rewrites(). Without aggregates left, the query isn't grouped.
+    """
+    queryset = queryset._chain()
+    query = queryset.query
+    replacements = {}
+    for rewrite in find_rewrites(queryset):
+        if rewrite.replacement is None:
+            logger.debug('Not rewriting %s=%r: %s', rewrite.name, rewrite.original, rewrite.reason)
+            continue
+        resolved = rewrite.replacement.resolve_expression(query, allow_joins=True, reuse=None)
+        query.annotations[rewrite.name] = resolved
+        replacements[rewrite.original] = resolved
+        logger.debug('Rewrote %s=%r to %r', rewrite.name, rewrite.original, rewrite.replacement)
+    if replacements:
+        # Filters on the annotations compare the subqueries, in WHERE
+        query.where = replace_expressions(query.where, replacements)
+        # Joins only the rewritten aggregates used are left out
+        used = _joined_aliases(query, [query.where] + list(query.annotations.values()))
+        for alias in _joined_aliases(query, replacements) - used:
+            query.alias_refcount[alias] = 0
+        if not any(annotation.contains_aggregate for annotation in query.annotations.values()):
+            query.group_by = None
+    return queryset
+
+
+def find_rewrites(queryset):
+    """
+    Return a Rewrite for each aggregate annotation of `queryset`, in order.
+
+    An aggregate is rewritten when it aggregates a column, with an optional
+    filter on the same table, reached through a reverse foreign key or a many
+    to many relation whose joins nothing else in the query uses. Filtering
+    the relation, e.g. filter(child__name='x').annotate(Count('child')),
+    restricts the rows the aggregate counts, so it isn't rewritten.
+    """
+    query = queryset.query
+    if query.combinator or not query.group_by:
+        return []
+    if query.group_by is not True and not any(isinstance(expression, Col) and expression.alias == query.base_table
+                                              and expression.target.primary_key for expression in query.group_by):
+        reason = 'the query is grouped by values() without the primary key'
+        return [Rewrite(name, annotation, None, reason) for name, annotation in query.annotations.items()
+                if annotation.contains_aggregate]
+
+    candidates = {}
+    for name, annotation in query.annotations.items():
+        if not annotation.contains_aggregate:
+            continue
+        try:
+            candidates[name] = get_replacement(query, annotation)
+        except NotRewritable as e:
+            candidates[name] = e
+    rewritable = [query.annotations[name] for name, replacement in candidates.items()
+                  if not isinstance(replacement, NotRewritable)]
+    others = [query.where] + [annotation for annotation in query.annotations.values() if annotation not in rewritable]
+    # Filters on the rewritable annotations themselves don't count
+    used = _joined_aliases(query, others, exclude=rewritable)
+
+    rewrites = []
+    for name, replacement in candidates.items():
+        annotation = query.annotations[name]
+        if isinstance(replacement, NotRewritable):
+            rewrites.append(Rewrite(name, annotation, None, str(replacement)))
+        elif _joined_aliases(query, [annotation], multi_valued=True) & used:
+            rewrites.append(Rewrite(name, annotation, None, 'the joins are also used by filters or annotations'))
+        else:
+            rewrites.append(Rewrite(name, annotation, replacement, None))
+    return rewrites
+
+
+def get_replacement(query, aggregate):
+    """
+    Return the sql_util subquery equivalent to `aggregate`, an annotation of
+    `query`, or raise NotRewritable.
+    """
+    subquery_class = SUBQUERY_AGGREGATES.get(type(aggregate))
+    if subquery_class is None:
+        raise NotRewritable('{} has no subquery equivalent'.format(type(aggregate).__name__))
+    column = aggregate.get_source_expressions()[0]
+    if not isinstance(column, Col):
+        raise NotRewritable('the aggregated expression is not a column')
+    path, multi_valued = _join_path(query, column.alias)
+    if not multi_valued:
+        raise NotRewritable('the column is not over a multi-valued relation')
+
+    kwargs = {}
+    if aggregate.distinct:
+        kwargs['distinct'] = True
+    if aggregate.filter is not None:
+        kwargs['filter'] = _to_q(aggregate.filter, column.alias)
+    replacement = subquery_class(LOOKUP_SEP.join(path + [column.target.name]), **kwargs)
+    try:
+        # Raises for paths or filters that can't be written relative to the
+        # related model
+        copy.copy(replacement).resolve_expression(Query(query.model))
+    except (FieldError, ValueError) as e:
+        raise NotRewritable('the relation can not be resolved: {}'.format(e))
+    return replacement
+
+
+def _join_path(query, alias):
+    """
+    Return the lookups from the outer model to the table of `alias`, and
+    whether they go through a multi-valued relation.
+    """
+    path = []
+    multi_valued = False
+    while isinstance(query.alias_map.get(alias), Join):
+        join = query.alias_map[alias]
+        if join.filtered_relation is not None:
+            raise NotRewritable('the relation is a FilteredRelation')
+        path.insert(0, join.join_field.name)
+        multi_valued = multi_valued or join.join_field.one_to_many or join.join_field.many_to_many
+        alias = join.parent_alias
+    if alias != query.base_table:
+        raise NotRewritable('the column is not joined from the outer table')
+    return path, multi_valued
+
+
+def _joined_aliases(query, expressions, multi_valued=False, exclude=()):
+    """
+    The aliases of the joins the columns of `expressions`, outside of the
+    `exclude` expressions, are reached through, with `multi_valued` only from
+    the outermost multi-valued relation down.
+    """
+    aliases = set()
+    for expression in expressions:
+        for column in _columns(expression, exclude):
+            chain = []
+            alias = column.alias
+            while isinstance(query.alias_map.get(alias), Join):
+                chain.append(alias)
+                alias = query.alias_map[alias].parent_alias
+            if multi_valued:
+                joins = [query.alias_map[alias].join_field for alias in chain]
+                chain = chain[:max([index + 1 for index, field in enumerate(joins)
+                                    if field.one_to_many or field.many_to_many] or [0])]
+            aliases.update(chain)
+    return aliases
+
+
+def _columns(expression, exclude=()):
+    if isinstance(expression, Col):
+        return [expression]
+    if expression in exclude:
+        return []
+    if isinstance(expression, WhereNode):
+        children = expression.children
+    else:
+        # An aggregate's source expressions include its filter
+        children = expression.get_source_expressions() if hasattr(expression, 'get_source_expressions') else []
+    return [column for child in children if child is not None for column in _columns(child, exclude)]
+
+
+def _to_q(node, alias):
+    """
+    The resolved filter `node` of an aggregate as a Q relative to the table
+    of `alias`, for lookups of its columns with plain values.
+    """
+    if isinstance(node, WhereNode):
+        q = Q()
+        q.connector = node.connector
+        q.children = [_to_q(child, alias) for child in node.children]
+        return ~q if node.negated else q
+    if not isinstance(node, Lookup) or not isinstance(node.lhs, Col) or node.lhs.alias != alias:
+        raise NotRewritable('the filter is not on the aggregated table')
+    if hasattr(node.rhs, 'resolve_expression'):
+        raise NotRewritable('the filter compares with an expression')
+    return Q(**{LOOKUP_SEP.join([node.lhs.target.name, node.lookup_name]): node.rhs})
+
+
+class SubqueryizeMixin(object):
+    """
+    A QuerySet mixin adding subqueryize():
+
+    class ParentQuerySet(SubqueryizeMixin, QuerySet):
+        pass
+
+    ParentQuerySet.as_manager().annotate(n=Count('child')).subqueryize()
+    """
+    def subqueryize(self):
+        return subqueryize(self)
@@ -0,0 +1,244 @@
+"""
+Choosing the SQL for expressions with strategy='auto'.
+
+The choice is between a correlated subquery, evaluated for each row of the
+outer query, and a set based alternative computed once for all rows: a grouped
+join for SubqueryAggregate, a semi-join (IN) for Exists. It is made when the
+outer query is compiled, since that's when its slice and filters are known.
+
+With the SQL_UTIL_EXPLAIN_STRATEGY setting, on PostgreSQL and MySQL, the outer
+query is EXPLAINed with each candidate and the cheaper plan wins. Otherwise, or
+when that fails, the choice is based on the size of the tables involved and
+the slice of the outer query.
+
+Unless SQL_UTIL_TABLE_SIZES or the chooser settle it, deciding runs queries,
+so compiling a query, even for str(queryset.query), can hit the database the
+first time its shape is seen.
+
+Decisions are cached per query shape and database, see
+sql_util.cache.strategy_cache, and logged to the 'sql_util.strategy' logger.
+The SQL_UTIL_STRATEGY_CHOOSER setting, a callable or its dotted path, can
+override them: it is called with the QueryShape and the candidate strategies
+and returns one of them, or None to leave the decision to sql_util.
+"""
+import json
+import logging
+import math
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models.sql import Query
+from django.utils.module_loading import import_string
+
+from sql_util.cache import strategy_cache
+
+SUBQUERY = 'subquery'
+GROUPED_JOIN = 'grouped_join'
+LATERAL = 'lateral'
+SEMI_JOIN = 'semi_join'
+ANTI_JOIN = 'anti_join'
+AUTO = 'auto'
+
+# Without table statistics, an outer query sliced to at most this many rows
+# uses the correlated subquery.
+SMALL_RESULT_SIZE = 1000
+
+# The fraction of the outer table assumed to be left by a WHERE clause
+WHERE_SELECTIVITY = 0.1
+
+logger = logging.getLogger('sql_util.strategy')
+
+QueryShape = namedtuple('QueryShape', ['vendor', 'using', 'kind', 'outer_table', 'inner_table', 'reverse',
+                                       'outer_ref', 'filter', 'negated', 'filtered', 'limit'])
+
+_local = threading.local()
+
+
+def get_shape(query, connection, kind, relation, negated=False):
+    """
+    Return the QueryShape of an expression of `kind` ('aggregate' or 'exists')
+    over `relation`, a (model, reverse, outer_ref, filter) tuple, in `query`.
+
+    The shape leaves out the values the query is filtered with, so that the
+    decision applies to every execution of the same queryset code.
+    """
+    model, reverse, outer_ref, filter = relation
+    limit = None
+    if query.high_mark is not None:
+        limit = query.high_mark - query.low_mark
+    return QueryShape(connection.vendor, connection.alias, kind, query.model._meta.db_table, model._meta.db_table,
+                      reverse, outer_ref, filter_shape(filter), negated, bool(query.where), limit)
+
+
+def filter_shape(node):
+    if isinstance(node, tuple):
+        return node[0]
+    if hasattr(node, 'children'):
+        return node.connector, node.negated, tuple(filter_shape(child) for child in node.children)
+    return type(node).__name__
+
+
+def choose_strategy(compiler, connection, kind, relation, candidates, negated=False):
+    """
+    Return the strategy, one of `candidates`, used for an expression with
+    strategy='auto' in the query being compiled by `compiler`.
+
+    The first candidate is the correlated subquery and the second one the set
+    based alternative. The answer is the same for every part of the SQL that
+    asks while compiling a query.
+    """
+    shape = get_shape(compiler.query, connection, kind, relation, negated)
+    forced = getattr(_local, 'forced', {})
+    if shape in forced:
+        return forced[shape]
+
+    decisions = compiler.__dict__.setdefault('_sql_util_strategies', {})
+    if shape not in decisions:
+        strategy = strategy_cache.get(shape)
+        if strategy is None:
+            strategy = decide(compiler, connection, shape, candidates)
+            strategy_cache.set(shape, strategy)
+        decisions[shape] = strategy
+    return decisions[shape]
+
+
+def decide(compiler, connection, shape, candidates):
+    strategy, reason = None, None
+
+    chooser = getattr(settings, 'SQL_UTIL_STRATEGY_CHOOSER', None)
+    if chooser is not None:
+        if isinstance(chooser, str):
+            chooser = import_string(chooser)
+        strategy, reason = chooser(shape, candidates), 'chooser'
+
+    if strategy is None and getattr(settings, 'SQL_UTIL_EXPLAIN_STRATEGY', False):
+        costs = explain_costs(compiler, connection, shape, candidates)
+        if costs is not None:
+            strategy = min(candidates, key=lambda candidate: costs[candidate])
+            reason = 'explain costs {}'.format(costs)
+
+    if strategy is None:
+        strategy, reason = estimate(connection, shape, candidates)
+
+    if strategy not in candidates:
+        raise ValueError('Unknown strategy {!r} for {}, expected one of {}'.format(strategy, shape,
+                                                                                  ', '.join(candidates)))
+    logger.debug('Chose %s for %s (%s)', strategy, shape, reason)
+    return strategy
+
+
+def estimate(connection, shape, candidates):
+    """
+    Pick a strategy from the row counts of the outer and inner tables.
+
+    A correlated subquery costs an index probe per row of the outer query,
+    the set based strategies a pass over the inner table plus a join.
+    """
+    correlated, set_based = candidates
+    outer_rows = table_size(connection, shape.outer_table)
+    inner_rows = table_size(connection, shape.inner_table)
+
+    if outer_rows is None or inner_rows is None:
+        if shape.limit is not None and shape.limit <= SMALL_RESULT_SIZE:
+            return correlated, 'outer query is sliced to {} rows'.format(shape.limit)
+        return set_based, 'no table statistics'
+
+    rows = outer_rows * WHERE_SELECTIVITY if shape.filtered else outer_rows
+    if shape.limit is not None:
+        rows = min(rows, shape.limit)
+    correlated_cost = rows * (1 + math.log2(inner_rows + 1))
+    set_based_cost = inner_rows + rows
+    reason = 'estimated cost {:.0f} correlated, {:.0f} set based'.format(correlated_cost, set_based_cost)
+    return (set_based if set_based_cost < correlated_cost else correlated), reason
+
+
+def table_size(connection, table):
+    """
+    Return the number of rows in `table`, from the SQL_UTIL_TABLE_SIZES
+    setting or the database's statistics, or None when it isn't known or the
+    statistics can't be read.
+    """
+    sizes = getattr(settings, 'SQL_UTIL_TABLE_SIZES', {})
+    if table in sizes:
+        return sizes[table]
+    sql = TABLE_SIZE_SQL.get(connection.vendor)
+    if sql is None:
+        return None
+    try:
+        # The savepoint keeps a failure from aborting the caller's transaction
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                # sqlite_stat1 only exists once ANALYZE has been run
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+                if cursor.fetchone() is None:
+                    return None
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        logger.warning('Could not read the size of %s', table, exc_info=True)
+        return None
+    if row is None or row[0] is None:
+        return None
+    # sqlite_stat1.stat starts with the number of rows, PostgreSQL reports -1
+    # for tables that were never analyzed.
+    rows = int(str(row[0]).split()[0].split('.')[0])
+    return rows if rows >= 0 else None
+
+
+TABLE_SIZE_SQL = {
+    'postgresql': "SELECT reltuples FROM pg_class WHERE relname = %s AND relkind = 'r' AND pg_table_is_visible(oid)",
+    'mysql': 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+    'sqlite': 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s',
+}
+
+
+def postgresql_cost(plan):
+    return plan[0]['Plan']['Total Cost']
+
+
+def mysql_cost(plan):
+    return float(plan['query_block']['cost_info']['query_cost'])
+
+
+EXPLAIN = {
+    'postgresql': ('EXPLAIN (FORMAT JSON) ', postgresql_cost),
+    'mysql': ('EXPLAIN FORMAT=JSON ', mysql_cost),
+}
+
+
+def explain_costs(compiler, connection, shape, candidates):
+    """
+    Return the planner's estimated cost of the outer query with each of the
+    candidate strategies, or None when it can't be EXPLAINed.
+    """
+    if connection.vendor not in EXPLAIN or type(compiler.query) is not Query or compiler.query.subquery:
+        return None
+    prefix, get_cost = EXPLAIN[connection.vendor]
+    costs = {}
+    try:
+        for candidate in candidates:
+            with force_strategy(shape, candidate):
+                sql, params = compiler.query.clone().get_compiler(connection=connection).as_sql()
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                plan = cursor.fetchone()[0]
+            costs[candidate] = get_cost(json.loads(plan) if isinstance(plan, str) else plan)
+    except (DatabaseError, KeyError, IndexError, TypeError, ValueError):
+        logger.warning('Could not EXPLAIN %s', shape, exc_info=True)
+        return None
+    return costs
+
+
+@contextmanager
+def force_strategy(shape, strategy):
+    """Use `strategy` for expressions of `shape` compiled within the block"""
+    previous = getattr(_local, 'forced', {})
+    _local.forced = dict(previous)
+    _local.forced[shape] = strategy
+    try:
+        yield
+    finally:
+        _local.forced = previous
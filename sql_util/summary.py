@@ -0,0 +1,225 @@
+"""
+Summary tables of aggregates, stored instead of computed on every query.
+
+    sellers = Summary(Seller, revenue=SubquerySum('sale__revenue'), sales=SubqueryCount('sale'))
+    sellers.create()
+    sellers.refresh()
+
+    sellers.annotate(Seller.objects.all(), max_age=timedelta(hours=1))
+
+selects the revenue and sales of each seller from the summary table while it
+was refreshed less than an hour ago, and computes them otherwise.
+"""
+import time
+from datetime import timedelta
+
+from django.db import connections, router, transaction
+from django.db.models import Expression, F, FloatField
+from django.db.models.sql.constants import LOUTER
+
+from sql_util.joins import KEY_COLUMN, SubqueryJoin, JoinedColumn
+
+# Name of the column of the summary's state table holding the time of its
+# last refresh, in seconds since the epoch
+REFRESHED_COLUMN = 'refreshed_at'
+
+
+class Summary(object):
+    """
+    The aggregates of each row of `model`, stored in the `table`, by default
+    <model table>_summary, with the model's primary key in the sql_util_key
+    column and each aggregate in the column of its name.
+
+    With `materialized_view` the summary is a materialized view on PostgreSQL,
+    refreshed with REFRESH MATERIALIZED VIEW CONCURRENTLY, and a table on the
+    other databases. The time of the last refresh is kept in the
+    <table>_state table.
+    """
+    def __init__(self, model, table=None, materialized_view=False, max_age=None, **aggregates):
+        if not aggregates:
+            raise ValueError('Summary() needs at least one name=expression')
+        self.model = model
+        self.table = table or '{}_summary'.format(model._meta.db_table)
+        self.materialized_view = materialized_view
+        self.max_age = max_age
+        self.aggregates = aggregates
+
+    @property
+    def state_table(self):
+        return '{}_state'.format(self.table)
+
+    def is_view(self, connection):
+        return self.materialized_view and connection.vendor == 'postgresql'
+
+    def get_connection(self, using):
+        return connections[using or router.db_for_write(self.model)]
+
+    def get_queryset(self, queryset=None):
+        """The rows of the summary computed from the model"""
+        if queryset is None:
+            queryset = self.model._base_manager.all()
+        return (queryset.order_by()
+                .annotate(**{KEY_COLUMN: F('pk')}, **self.aggregates)
+                .values_list(KEY_COLUMN, *self.aggregates))
+
+    def get_output_fields(self):
+        annotations = self.get_queryset().query.annotations
+        return {name: annotations[name].output_field for name in self.aggregates}
+
+    def create(self, using=None):
+        """Create the summary table, or view, and its state table, both empty"""
+        connection = self.get_connection(using)
+        quote_name = connection.ops.quote_name
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            if self.is_view(connection):
+                sql, params = self.compile(connection, self.get_queryset())
+                cursor.execute('CREATE MATERIALIZED VIEW {} AS {} WITH NO DATA'.format(
+                    quote_name(self.table), inline_params(connection, sql, params)))
+                cursor.execute('CREATE UNIQUE INDEX {} ON {} ({})'.format(
+                    quote_name('{}_key'.format(self.table)), quote_name(self.table), quote_name(KEY_COLUMN)))
+            else:
+                columns = ['{} {} NOT NULL PRIMARY KEY'.format(quote_name(KEY_COLUMN),
+                                                               self.model._meta.pk.rel_db_type(connection))]
+                for name, field in self.get_output_fields().items():
+                    columns.append('{} {} NULL'.format(quote_name(name), field.db_type(connection)))
+                cursor.execute('CREATE TABLE {} ({})'.format(quote_name(self.table), ', '.join(columns)))
+            cursor.execute('CREATE TABLE {} ({} {} NOT NULL)'.format(
+                quote_name(self.state_table), quote_name(REFRESHED_COLUMN), FloatField().db_type(connection)))
+
+    def drop(self, using=None):
+        connection = self.get_connection(using)
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            if self.is_view(connection):
+                cursor.execute('DROP MATERIALIZED VIEW IF EXISTS {}'.format(quote_name(self.table)))
+            else:
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(quote_name(self.table)))
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(quote_name(self.state_table)))
+
+    def refresh(self, queryset=None, using=None):
+        """
+        Recompute the summary. With `queryset`, only its rows of the model are
+        recomputed, e.g. those with related rows changed since the last
+        refresh; a materialized view is always refreshed as a whole.
+        """
+        connection = self.get_connection(using)
+        quote_name = connection.ops.quote_name
+        table = quote_name(self.table)
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            if self.is_view(connection):
+                concurrently = ' CONCURRENTLY' if self.refreshed_at(using) is not None else ''
+                cursor.execute('REFRESH MATERIALIZED VIEW{} {}'.format(concurrently, table))
+            else:
+                if queryset is None:
+                    cursor.execute('DELETE FROM {}'.format(table))
+                    rows = self.get_queryset()
+                else:
+                    keys = queryset.using(connection.alias).order_by().values('pk')
+                    sql, params = self.compile(connection, keys)
+                    cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(table, quote_name(KEY_COLUMN), sql),
+                                   params)
+                    rows = self.get_queryset(self.model._base_manager.filter(pk__in=keys))
+                sql, params = self.compile(connection, rows)
+                columns = ', '.join(quote_name(name) for name in [KEY_COLUMN] + list(self.aggregates))
+                cursor.execute('INSERT INTO {} ({}) {}'.format(table, columns, sql), params)
+            cursor.execute('DELETE FROM {}'.format(quote_name(self.state_table)))
+            cursor.execute('INSERT INTO {} ({}) VALUES (%s)'.format(quote_name(self.state_table),
+                                                                   quote_name(REFRESHED_COLUMN)), [time.time()])
+
+    def compile(self, connection, queryset):
+        return queryset.query.get_compiler(connection=connection).as_sql()
+
+    def refreshed_at(self, using=None):
+        """The time.time() of the last refresh, None if it was never refreshed"""
+        connection = self.get_connection(using)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT {} FROM {}'.format(connection.ops.quote_name(REFRESHED_COLUMN),
+                                                      connection.ops.quote_name(self.state_table)))
+            row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    def is_fresh(self, max_age=None, using=None):
+        """Whether the summary was refreshed less than `max_age` ago"""
+        max_age = max_age if max_age is not None else self.max_age
+        refreshed_at = self.refreshed_at(using)
+        if refreshed_at is None:
+            return False
+        if max_age is None:
+            return True
+        if isinstance(max_age, timedelta):
+            max_age = max_age.total_seconds()
+        return time.time() - refreshed_at < max_age
+
+    def annotate(self, queryset, max_age=None, names=None):
+        """
+        Annotate `queryset` with the aggregates in `names`, all of them by
+        default, joined from the summary when it is fresh, computed from the
+        expressions otherwise. Rows of the model missing from the summary, i.e.
+        created since it was refreshed, get the aggregates over no rows.
+        """
+        names = list(names or self.aggregates)
+        if self.is_fresh(max_age, using=queryset.db):
+            output_fields = self.get_output_fields()
+            return queryset.annotate(**{name: SummaryColumn(self, name, output_fields[name]) for name in names})
+        return queryset.annotate(**{name: self.aggregates[name] for name in names})
+
+
+def inline_params(connection, sql, params):
+    """`sql` with the params inlined, for statements that can't take any"""
+    quote_value = connection.schema_editor().quote_value
+    return sql % tuple(quote_value(param) for param in params)
+
+
+class SummaryColumn(Expression):
+    """
+    A column of the summary, selected from the summary table joined to the
+    query of the summary's model.
+    """
+    def __init__(self, summary, name, output_field):
+        super(SummaryColumn, self).__init__(output_field=output_field)
+        self.summary = summary
+        self.name = name
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        alias = SummaryJoin.add(query, self.summary)
+        default = getattr(self.summary.aggregates[self.name], 'empty_value', None)
+        return JoinedColumn(alias, self.name, self.output_field, default=default, source=self)
+
+
+class SummaryJoin(SubqueryJoin):
+    """
+    A join against a summary table:
+
+        LEFT OUTER JOIN seller_summary ON (seller.id = seller_summary.sql_util_key)
+    """
+    def __init__(self, table_name, parent_alias, relation, lhs, table_alias=None, join_type=LOUTER, nullable=True):
+        super(SummaryJoin, self).__init__(table_name, parent_alias, relation, [], None, lhs, table_alias=table_alias,
+                                          join_type=join_type, nullable=nullable)
+
+    @classmethod
+    def add(cls, query, summary):
+        """Join the table of `summary` to the query, once, and return its alias"""
+        for alias, join in query.alias_map.items():
+            if type(join) is cls and join.relation == summary.table and query.alias_refcount[alias]:
+                query.ref_alias(alias)
+                return alias
+        join = cls(table_name=summary.table, parent_alias=query.get_initial_alias(), relation=summary.table,
+                   lhs=query.resolve_ref('pk'))
+        alias, _ = query.table_alias(join.table_name, create=True)
+        join.table_alias = alias
+        query.alias_map[alias] = join
+        return alias
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, lhs_params = compiler.compile(self.lhs)
+        table = connection.ops.quote_name(self.table_name)
+        alias = compiler.quote_name_unless_alias(self.table_alias)
+        if self.table_alias != self.table_name:
+            table = '{} {}'.format(table, alias)
+        sql = '%s %s ON (%s = %s.%s)' % (self.join_type, table, lhs_sql, alias, connection.ops.quote_name(KEY_COLUMN))
+        return sql, tuple(lhs_params)
+
+    def relabeled_clone(self, change_map):
+        return self._replace(parent_alias=change_map.get(self.parent_alias, self.parent_alias),
+                             table_alias=change_map.get(self.table_alias, self.table_alias),
+                             lhs=self.lhs.relabeled_clone(change_map))
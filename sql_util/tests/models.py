@@ -150,6 +150,8 @@ class Seller(models.Model):
     store = models.ForeignKey(Store, on_delete=CASCADE)
     average_revenue = models.FloatField(default=0)
     total_sales = models.IntegerField(default=0)
+    total_revenue = models.FloatField(default=0)
+    last_sale = models.DateField(null=True)
 
 
 class Sale(models.Model):
@@ -158,6 +160,9 @@ class Sale(models.Model):
     expenses = models.FloatField()
     seller = models.ForeignKey(Seller, on_delete=CASCADE)
 
+    class Meta:
+        indexes = [models.Index(fields=['seller', 'date'], name='sale_seller_date_idx')]
+
 
 # Want to test the case where a model has two foreign keys to the same model
 class Player(models.Model):
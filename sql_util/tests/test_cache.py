@@ -0,0 +1,68 @@
+from django.test import TestCase, override_settings
+
+from sql_util.cache import LRUCache, path_cache
+from sql_util.tests.models import Parent, Child, Seller, Store, Sale
+from sql_util.utils import SubqueryCount, SubquerySum
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_counters(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+
+        info = cache.info()
+        self.assertEqual((info.hits, info.misses, info.maxsize, info.currsize), (1, 1, 2, 1))
+
+
+class TestPathCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestPathCache, cls).setUpClass()
+        parent = Parent.objects.create(name='John')
+        Parent.objects.create(name='Jane')
+        Child.objects.create(parent=parent, name='Joe', timestamp='2017-06-01')
+
+        store = Store.objects.create(name='A Store')
+        seller = Seller.objects.create(store=store, name='Seller 1')
+        Sale.objects.create(seller=seller, date='2020-01-01', revenue=1.5, expenses=0.2)
+        Sale.objects.create(seller=seller, date='2020-01-02', revenue=2.5, expenses=0.2)
+
+    def setUp(self):
+        path_cache.clear()
+
+    def test_repeated_annotation_hits_cache(self):
+        for _ in range(3):
+            parents = Parent.objects.annotate(child_count=SubqueryCount('da_child')).order_by('name')
+            self.assertEqual([p.child_count for p in parents], [0, 1])
+
+        info = path_cache.info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.currsize, 1)
+        self.assertGreaterEqual(info.hits, 2)
+
+    def test_key_includes_lookup(self):
+        sellers = Seller.objects.annotate(n=SubqueryCount('sale'), total=SubquerySum('sale__revenue'))
+        self.assertEqual([(s.n, s.total) for s in sellers], [(2, 4.0)])
+        self.assertEqual(path_cache.info().currsize, 2)
+
+    def test_invalidated_when_apps_change(self):
+        list(Parent.objects.annotate(child_count=SubqueryCount('da_child')))
+        self.assertEqual(len(path_cache), 1)
+
+        with override_settings(INSTALLED_APPS=['django.contrib.contenttypes', 'sql_util.tests']):
+            self.assertEqual(len(path_cache), 0)
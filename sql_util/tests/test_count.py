@@ -0,0 +1,78 @@
+import django
+from django.db.models import Count, OuterRef, Q
+from django.test import TestCase
+
+from sql_util.tests.models import Parent, Child
+from sql_util.utils import SubqueryCount
+
+
+class TestSubqueryCountThresholds(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryCountThresholds, cls).setUpClass()
+        for i in range(5):
+            parent = Parent.objects.create(name='Parent %d' % i)
+            for j in range(i):
+                Child.objects.create(parent=parent, name='Child %d' % j, timestamp='2017-06-01',
+                                     other_timestamp='2017-06-01' if j % 2 else None)
+
+    def counts(self, **lookups):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(**lookups).order_by('name')
+        return [p.n for p in queryset]
+
+    def test_thresholds(self):
+        self.assertEqual(self.counts(n__gte=3), [3, 4])
+        self.assertEqual(self.counts(n__gt=3), [4])
+        self.assertEqual(self.counts(n__lt=2), [0, 1])
+        self.assertEqual(self.counts(n__lte=2), [0, 1, 2])
+        self.assertEqual(self.counts(n=0), [0])
+        self.assertEqual(self.counts(n=2), [2])
+        self.assertEqual(self.counts(n__gte=0), [0, 1, 2, 3, 4])
+        self.assertEqual(self.counts(n__lt=0), [])
+        self.assertEqual(self.counts(n=-1), [])
+
+    def test_bounded_sql(self):
+        sql = str(Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__gte=3).query)
+
+        # Django < 4.0 doesn't parenthesize the outer column
+        outer = '("tests_parent"."id")' if django.VERSION >= (4, 0) else '"tests_parent"."id"'
+        self.assertIn('WHERE EXISTS(SELECT U0."id" FROM "tests_child" U0 WHERE U0."parent_id" = '
+                      '{} LIMIT 1 OFFSET 2)'.format(outer), sql)
+
+        sql = str(Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n=2).query)
+        self.assertIn('LIMIT 3) "sql_util_capped") = 2', sql)
+
+    def test_queryset(self):
+        counts = (Child.objects.filter(parent=OuterRef('pk')).order_by().values('parent')
+                  .annotate(count=Count('pk')).values('count'))
+        queryset = Parent.objects.annotate(n=SubqueryCount(counts))
+
+        self.assertEqual(sorted(p.n for p in queryset.filter(n__gte=1)), [1, 2, 3, 4])
+
+    def test_exclude_and_q(self):
+        queryset = (Parent.objects.annotate(n=SubqueryCount('da_child'))
+                    .exclude(Q(n__gte=3) | Q(n=0))
+                    .order_by('name'))
+
+        self.assertEqual([p.n for p in queryset], [1, 2])
+
+    def test_nullable_and_distinct(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child__other_timestamp', distinct=True))
+
+        self.assertEqual([p.name for p in queryset.filter(n=1).order_by('name')], ['Parent 2', 'Parent 3', 'Parent 4'])
+        self.assertEqual(list(queryset.filter(n__gte=2)), [])
+
+    def test_cap(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child', cap=3, strategy='grouped_join')).order_by('name')
+
+        self.assertEqual([p.n for p in queryset], [0, 1, 2, 3, 3])
+        self.assertIn('LIMIT 3', str(queryset.query))
+        self.assertNotIn('JOIN', str(queryset.query))
+        self.assertEqual([p.n for p in queryset.filter(n__gte=3)], [3, 3])
+        self.assertNotEqual(SubqueryCount('da_child', cap=3), SubqueryCount('da_child'))
+
+    def test_join_strategy(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child', strategy='grouped_join')).filter(n__gte=3)
+
+        self.assertEqual(sorted(p.n for p in queryset), [3, 4])
@@ -0,0 +1,175 @@
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+
+from sql_util.debug import (explain_queryset, parse_postgresql, parse_mysql, mark_annotations, profile_annotations,
+                            _without)
+from sql_util.tests.models import Parent, Child
+from sql_util.utils import SubqueryCount, SubqueryMax, Exists
+
+
+class TestExplainQueryset(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestExplainQueryset, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+
+    def test_explain(self):
+        queryset = Parent.objects.annotate(
+            n=SubqueryCount('da_child'),
+            last=SubqueryMax('da_child__timestamp', strategy='grouped_join')
+        ).filter(Exists('da_child', filter=Q(name='Joe')))
+
+        plan = explain_queryset(queryset, analyze=True)
+        self.assertEqual(plan.vendor, connection.vendor)
+        self.assertEqual(plan.params, ('Joe',))
+        self.assertIsNotNone(plan.execution_time)
+        self.assertEqual(plan.root.actual_rows, 1)
+
+        for annotation in ('n', 'last', 'filter'):
+            nodes = plan.nodes(annotation)
+            self.assertTrue(nodes, annotation)
+            self.assertTrue(any(node.relation for node in nodes), annotation)
+
+        # The tables of the outer query belong to no annotation
+        self.assertEqual([node.annotations for node in plan.nodes() if node.relation == 'tests_parent'], [[]])
+        self.assertIn('[n]', str(plan))
+        self.assertEqual(plan.as_dict()['plan']['operation'], plan.root.operation)
+
+        # The queryset itself is unchanged
+        self.assertEqual(list(queryset.values_list('name', 'n')), [('John', 2)])
+
+    def test_explain_sqlite(self):
+        if connection.vendor != 'sqlite':
+            return
+        plan = explain_queryset(Parent.objects.annotate(n=SubqueryCount('da_child')))
+        correlated, = [node for node in plan.nodes('n') if node.per_row]
+        search, = correlated.children
+        self.assertEqual(search.operation, 'SEARCH')
+        self.assertEqual(search.relation, 'sqlu1_0')
+        self.assertIn('parent_id', search.index)
+
+
+class TestProfileAnnotations(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestProfileAnnotations, cls).setUpClass()
+        parent = Parent.objects.create(name='John')
+        Child.objects.create(parent=parent, name='Joe', timestamp='2017-06-01')
+
+    def annotated(self):
+        return Parent.objects.annotate(
+            n=SubqueryCount('da_child'),
+            last=SubqueryMax('da_child__timestamp', strategy='grouped_join'),
+            named=SubqueryCount('da_child', filter=Q(name='Joe'), strategy='grouped_join'),
+        ).filter(n__gt=0)
+
+    def test_profile(self):
+        profile = profile_annotations(self.annotated(), repeat=2)
+        self.assertGreater(profile['total'], 0)
+        self.assertGreater(profile['base'], 0)
+        self.assertEqual(set(profile['annotations']), {'n', 'last', 'named'})
+        self.assertEqual(set(profile['annotations']['n']), {'added', 'removed', 'per_row', 'rows'})
+        if connection.vendor == 'sqlite':
+            self.assertTrue(profile['annotations']['n']['per_row'])
+            self.assertFalse(profile['annotations']['last']['per_row'])
+
+    def test_without(self):
+        query = self.annotated().query
+        sql = str(_without(query, ['n', 'last']))
+        # The join of `last` is left out, the filter still uses the subquery
+        self.assertNotIn('tests_child_agg', sql)
+        self.assertIn('"named"', sql)
+        self.assertIn('COUNT', sql)
+
+        base = self.annotated()
+        base.query = _without(base.query, ['n', 'last', 'named'])
+        self.assertEqual(list(base.values_list('name', 'n', 'last', 'named')), [('John', None, None, None)])
+        self.assertEqual(list(self.annotated().values_list('name', 'n', 'named')), [('John', 1, 1)])
+
+
+POSTGRESQL_PLAN = {
+    'Node Type': 'Seq Scan',
+    'Relation Name': 'tests_parent',
+    'Alias': 'tests_parent',
+    'Plan Rows': 2,
+    'Total Cost': 42.5,
+    'Actual Rows': 2,
+    'Actual Total Time': 0.05,
+    'Actual Loops': 1,
+    'Plans': [{
+        'Node Type': 'Aggregate',
+        'Parent Relationship': 'SubPlan',
+        'Subplan Name': 'SubPlan 1',
+        'Plan Rows': 1,
+        'Total Cost': 8.2,
+        'Plans': [{
+            'Node Type': 'Index Only Scan',
+            'Parent Relationship': 'Outer',
+            'Relation Name': 'tests_child',
+            'Alias': 'sqlu1_0',
+            'Index Name': 'tests_child_parent_id_bd9ba656',
+            'Plan Rows': 5,
+            'Total Cost': 8.1,
+        }],
+    }],
+}
+
+MYSQL_PLAN = {
+    'select_id': 1,
+    'cost_info': {'query_cost': '1.20'},
+    'table': {
+        'table_name': 'tests_parent',
+        'access_type': 'ALL',
+        'rows_examined_per_scan': 2,
+        'cost_info': {'prefix_cost': '0.45'},
+    },
+    'select_list_subqueries': [{
+        'dependent': True,
+        'cacheable': False,
+        'query_block': {
+            'select_id': 2,
+            'cost_info': {'query_cost': '0.35'},
+            'table': {
+                'table_name': 'sqlu1_0',
+                'access_type': 'ref',
+                'key': 'tests_child_parent_id_bd9ba656',
+                'rows_examined_per_scan': 1,
+                'cost_info': {'prefix_cost': '0.35'},
+            },
+        },
+    }],
+}
+
+
+class TestPlanParsers(TestCase):
+
+    def test_postgresql(self):
+        root = parse_postgresql(POSTGRESQL_PLAN)
+        mark_annotations(root, {'sqlu1_': ['n']})
+        self.assertEqual((root.operation, root.relation, root.estimated_cost, root.actual_rows),
+                         ('Seq Scan', 'tests_parent', 42.5, 2))
+        subplan, = root.children
+        self.assertEqual((subplan.operation, subplan.per_row, subplan.annotations), ('SubPlan', True, ['n']))
+        scan, = subplan.children
+        self.assertEqual((scan.relation, scan.alias, scan.index, scan.annotations),
+                         ('tests_child', 'sqlu1_0', 'tests_child_parent_id_bd9ba656', ['n']))
+        self.assertEqual(root.annotations, [])
+
+    def test_mysql(self):
+        root = parse_mysql(MYSQL_PLAN)
+        mark_annotations(root, {'sqlu1_': ['n']})
+        self.assertEqual(root.estimated_cost, 1.2)
+        table, subquery = root.children
+        self.assertEqual((table.operation, table.relation, table.estimated_rows), ('ALL', 'tests_parent', 2))
+        self.assertEqual((subquery.per_row, subquery.annotations), (True, ['n']))
+        ref, = subquery.children
+        self.assertEqual((ref.operation, ref.index, ref.annotations), ('ref', 'tests_child_parent_id_bd9ba656', ['n']))
@@ -0,0 +1,105 @@
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+
+from sql_util.debug import explain_queryset
+from sql_util.dedupe import evaluate_once
+from sql_util.tests.models import Parent, Child
+from sql_util.utils import SubqueryCount, SubqueryMax, Exists
+
+
+class TestSubqueryEquality(TestCase):
+
+    def test_equal(self):
+        self.assertEqual(SubqueryCount('da_child'), SubqueryCount('da_child'))
+        self.assertEqual(hash(SubqueryCount('da_child')), hash(SubqueryCount('da_child')))
+        self.assertEqual(SubqueryCount('da_child', filter=Q(name__in=['Joe'])),
+                         SubqueryCount('da_child', filter=Q(name__in=['Joe'])))
+        self.assertEqual(~Exists('da_child'), ~Exists('da_child'))
+
+    def test_not_equal(self):
+        self.assertNotEqual(SubqueryCount('da_child'), SubqueryCount('da_child', filter=Q(name='Joe')))
+        self.assertNotEqual(SubqueryCount('da_child__timestamp'), SubqueryMax('da_child__timestamp'))
+        self.assertNotEqual(Exists('da_child'), ~Exists('da_child'))
+        self.assertNotEqual(SubqueryCount('da_child'), SubqueryCount('da_child', strategy='grouped_join'))
+        queryset = Child.objects.all()
+        self.assertNotEqual(Exists(queryset), Exists(queryset))
+
+
+class TestEvaluateOnce(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestEvaluateOnce, cls).setUpClass()
+        parents = [Parent.objects.create(name=name) for name in ('John', 'Jane', 'Jim')]
+        for i, parent in enumerate(parents):
+            for j in range(i * 2):
+                Child.objects.create(parent=parent, name='Child %d' % j, timestamp='2017-06-01')
+
+    def correlated(self, queryset):
+        """The number of subqueries evaluated for each row in the plan"""
+        return len([node for node in explain_queryset(queryset).nodes() if node.per_row])
+
+    def assertEvaluatedOnce(self, queryset):
+        once = evaluate_once(queryset)
+        if connection.vendor == 'sqlite':
+            self.assertEqual(self.correlated(queryset), 2)
+            self.assertEqual(self.correlated(once), 1)
+        self.assertEqual(list(once), list(queryset))
+        return once
+
+    def test_filter_on_annotation(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__in=[2, 4]).order_by('-n')
+
+        once = self.assertEvaluatedOnce(queryset)
+        self.assertEqual([(p.name, p.n) for p in once], [('Jim', 4), ('Jane', 2)])
+
+    def test_alias(self):
+        queryset = (Parent.objects.alias(n=SubqueryCount('da_child'))
+                    .filter(n__in=[1, 2, 3]).exclude(n__in=[1]).values_list('name'))
+
+        self.assertEqual(list(self.assertEvaluatedOnce(queryset)), [('Jane',)])
+
+    def test_equal_expression(self):
+        queryset = (Parent.objects.annotate(has_children=Exists('da_child'))
+                    .filter(Exists('da_child'), name__in=['Jane', 'Jim'])
+                    .exclude(name='Jim')
+                    .order_by('name'))
+
+        once = self.assertEvaluatedOnce(queryset)
+        self.assertEqual([(p.name, p.has_children) for p in once], [('Jane', True)])
+
+    def test_other_filters(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__in=[2, 4], name='Jim')
+
+        once = self.assertEvaluatedOnce(queryset)
+        # In the derived table too
+        self.assertEqual(str(once.query).count('"name" = Jim'), 2)
+        self.assertEqual([(p.name, p.n) for p in once], [('Jim', 4)])
+
+    def test_alias_used_once(self):
+        queryset = Parent.objects.alias(n=SubqueryCount('da_child')).filter(n__in=[1, 2, 3])
+
+        self.assertEqual(str(evaluate_once(queryset).query), str(queryset.query))
+
+    def test_nothing_repeated(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(name='Jim')
+
+        self.assertEqual(str(evaluate_once(queryset).query), str(queryset.query))
+
+    def test_bounded_count(self):
+        # The filter doesn't count every row, it's not the annotation again
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__gt=1)
+
+        self.assertEqual(str(evaluate_once(queryset).query), str(queryset.query))
+
+    def test_count(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__in=[2, 4])
+
+        self.assertEqual(evaluate_once(queryset).count(), 2)
+
+    def test_update(self):
+        queryset = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__in=[2, 4])
+
+        self.assertEqual(evaluate_once(queryset).update(name='Many'), 2)
+        self.assertEqual(sorted(Parent.objects.values_list('name', flat=True)), ['John', 'Many', 'Many'])
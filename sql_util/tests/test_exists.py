@@ -52,6 +52,55 @@ class TestExists(TestCase):
         self.assertEqual(ps[1].has_children, True)
 
 
+class TestCombinedExists(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCombinedExists, cls).setUpClass()
+        john = Parent.objects.create(name='John')
+        jane = Parent.objects.create(name='Jane')
+        Parent.objects.create(name='Jill')
+        Child.objects.create(parent=john, name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=john, name='Jan', timestamp='2017-07-01')
+        Child.objects.create(parent=jane, name='Jim', timestamp='2017-06-01')
+
+    def names(self, condition):
+        queryset = Parent.objects.filter(condition).order_by('name')
+        return [p.name for p in queryset]
+
+    def test_or(self):
+        condition = Exists('da_child', filter=Q(name='Joe')) | Exists('da_child', filter=Q(name='Jim'))
+
+        self.assertIsInstance(condition, Exists)
+        self.assertEqual(self.names(condition), ['Jane', 'John'])
+        self.assertEqual(str(Parent.objects.filter(condition).query).count('EXISTS'), 1)
+
+    def test_and_negated(self):
+        condition = ~Exists('da_child', filter=Q(name='Joe')) & ~Exists('da_child', filter=Q(name='Jim'))
+
+        self.assertIsInstance(condition, Exists)
+        self.assertTrue(condition.negated)
+        self.assertEqual(self.names(condition), ['Jill'])
+        self.assertEqual(self.names(~condition), ['Jane', 'John'])
+
+    def test_empty_filter(self):
+        condition = Exists('da_child') | Exists('da_child', filter=Q(name='Nobody'))
+
+        self.assertEqual(self.names(condition), ['Jane', 'John'])
+
+    def test_not_merged(self):
+        both = Exists('da_child', filter=Q(name='Joe')) & Exists('da_child', filter=Q(name='Jan'))
+        either_missing = ~Exists('da_child', filter=Q(name='Joe')) | ~Exists('da_child', filter=Q(name='Jan'))
+        mixed = Exists('da_child', filter=Q(name='Joe')) | ~Exists('da_child')
+
+        self.assertIsInstance(both, Q)
+        self.assertEqual(self.names(both), ['John'])
+        self.assertEqual(self.names(either_missing), ['Jane', 'Jill'])
+        self.assertEqual(self.names(mixed), ['Jill', 'John'])
+        self.assertIsInstance(Exists('da_child') | Exists('da_child', outer_ref='pk', strategy='semi_join'), Q)
+        self.assertIsInstance(Exists(Child.objects.all()) | Exists('da_child'), Q)
+
+
 class TestExistsFilter(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -0,0 +1,140 @@
+from unittest import mock
+
+from django.db import connection
+from django.db.models import OuterRef, Q
+from django.db.models.functions import Upper
+from django.test import TestCase
+
+from sql_util.tests.models import Parent, Child, Seller, Store, Sale
+from sql_util.utils import SubqueryFirst, SubqueryLatest
+
+
+def distinct_on_sql(fields, params):
+    return ['DISTINCT ON ({})'.format(', '.join(fields))], list(params)
+
+
+class TestSubqueryFirst(TestCase):
+    strategy = 'subquery'
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryFirst, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+        Child.objects.create(parent=parents[0], name='Jim', timestamp='2017-05-01')
+
+    def annotate(self, **annotations):
+        return Parent.objects.annotate(**annotations).order_by('name')
+
+    def test_first_and_latest(self):
+        parents = self.annotate(first=SubqueryFirst('da_child__name', ordering='timestamp', strategy=self.strategy),
+                                latest=SubqueryLatest('da_child__name', ordering='timestamp', strategy=self.strategy))
+
+        self.assertEqual([(p.name, p.first, p.latest) for p in parents],
+                         [('Jane', None, None), ('John', 'Jim', 'Jan')])
+
+    def test_descending_ordering(self):
+        parents = self.annotate(latest=SubqueryLatest('da_child__timestamp', ordering='-name', strategy=self.strategy))
+
+        self.assertEqual([p.latest.month if p.latest else None for p in parents], [None, 7])
+
+    def test_filter_and_expression(self):
+        parents = self.annotate(first=SubqueryFirst(Upper('da_child__name'), ordering=['-timestamp'],
+                                                    filter=Q(name__startswith='Jo'), strategy=self.strategy))
+
+        self.assertEqual([p.first for p in parents], [None, 'JOE'])
+
+    def test_outer_ref_in_filter(self):
+        parents = self.annotate(first=SubqueryFirst('da_child__name', ordering='-timestamp',
+                                                    filter=Q(name__lt=OuterRef('name')), strategy=self.strategy))
+
+        self.assertEqual([p.first for p in parents], [None, 'Jan'])
+
+    def test_in_filter(self):
+        parents = Parent.objects.filter(pk__in=Parent.objects.annotate(
+            latest=SubqueryLatest('da_child__name', ordering='timestamp', strategy=self.strategy)
+        ).filter(latest='Jan').values('pk'))
+
+        self.assertEqual([p.name for p in parents], ['John'])
+
+    def test_requires_ordering(self):
+        with self.assertRaises(ValueError):
+            SubqueryFirst('da_child__name')
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            SubqueryFirst('da_child__name', ordering='timestamp', strategy='auto')
+
+
+class TestSubqueryFirstGroupedJoin(TestSubqueryFirst):
+    strategy = 'grouped_join'
+
+    def test_siblings_share_join(self):
+        parents = self.annotate(child=SubqueryLatest('da_child__name', ordering='timestamp', strategy=self.strategy),
+                                at=SubqueryLatest('da_child__timestamp', ordering='timestamp', strategy=self.strategy),
+                                first=SubqueryFirst('da_child__name', ordering='timestamp', strategy=self.strategy))
+
+        # Different orderings need different derived tables
+        self.assertEqual(str(parents.query).count('JOIN'), 2)
+        self.assertEqual([(p.child, p.at.month) for p in parents if p.at], [('Jan', 7)])
+
+    def test_window_function(self):
+        sql = str(self.annotate(first=SubqueryFirst('da_child__name', ordering='timestamp',
+                                                    strategy=self.strategy)).query)
+
+        self.assertIn('ROW_NUMBER() OVER (PARTITION BY', sql)
+        self.assertIn('"sql_util_ranked" WHERE "sql_util_rank" = 1', sql)
+        self.assertNotIn('DISTINCT', sql)
+
+    def test_distinct_on(self):
+        parents = self.annotate(first=SubqueryFirst('da_child__name', ordering='timestamp', strategy=self.strategy))
+
+        with mock.patch.object(connection.features, 'can_distinct_on_fields', True), \
+                mock.patch.object(connection.ops, 'distinct_sql', distinct_on_sql):
+            sql, _ = parents.query.get_compiler(connection=connection).as_sql()
+
+        # Django < 4.0 doesn't quote the DISTINCT ON fields
+        self.assertRegex(sql, r'SELECT DISTINCT ON \("?sql_util_key"?\)')
+        self.assertNotIn('ROW_NUMBER', sql)
+
+    def test_update_uses_subquery(self):
+        Parent.objects.filter(name='John').update(name=SubqueryLatest('da_child__name', ordering='timestamp',
+                                                                      strategy=self.strategy))
+
+        self.assertEqual(list(Parent.objects.values_list('name', flat=True)), ['Jan', 'Jane'])
+
+
+class TestSubqueryFirstLateral(TestSubqueryFirst):
+    strategy = 'lateral'
+
+    def test_postgresql(self):
+        parents = self.annotate(child=SubqueryLatest('da_child__name', ordering='timestamp', strategy=self.strategy),
+                                at=SubqueryLatest('da_child__timestamp', ordering='timestamp', strategy=self.strategy))
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            sql, _ = parents.query.get_compiler(connection=connection).as_sql()
+
+        self.assertEqual(sql.count('LEFT OUTER JOIN LATERAL'), 1)
+        self.assertIn('LIMIT 1', sql)
+
+
+class TestSubqueryFirstForeignKey(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryFirstForeignKey, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        seller = Seller.objects.create(store=store, name='Seller')
+        Sale.objects.create(seller=seller, date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=seller, date='2020-01-03', revenue=2.0, expenses=0.0)
+
+    def test_through_foreign_key(self):
+        for strategy in ('subquery', 'grouped_join', 'lateral'):
+            stores = Store.objects.annotate(revenue=SubqueryLatest('seller__sale__revenue', ordering='date',
+                                                                   strategy=strategy))
+            self.assertEqual([s.revenue for s in stores], [2.0], strategy)
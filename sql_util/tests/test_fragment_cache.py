@@ -0,0 +1,130 @@
+from django.apps import apps
+from django.db.models import Q, Subquery as DjangoSubquery
+from django.db.models.signals import post_migrate
+from django.test import TestCase, override_settings
+
+from sql_util.cache import fragment_cache
+from sql_util.tests import test_exists, test_subquery
+from sql_util.tests.models import Parent, Child
+from sql_util.utils import SubqueryCount, Exists
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestFragmentCache(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestFragmentCache, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+        Child.objects.create(parent=parents[1], name='Jan', timestamp='2017-05-01')
+
+    def setUp(self):
+        fragment_cache.clear()
+
+    def annotated(self, name='Jan'):
+        return Parent.objects.annotate(n=SubqueryCount('da_child', filter=Q(name=name))).order_by('name')
+
+    def test_reused(self):
+        with self.settings(SQL_UTIL_FRAGMENT_CACHE=False):
+            expected = str(self.annotated().query)
+
+        for _ in range(3):
+            parents = self.annotated()
+            self.assertEqual(str(parents.query), expected)
+            self.assertEqual([(p.name, p.n) for p in parents], [('Jane', 1), ('John', 1)])
+
+        # One built query and one compiled fragment
+        self.assertEqual(len(fragment_cache), 2)
+        self.assertGreaterEqual(fragment_cache.info().hits, 4)
+
+    def test_filter_values(self):
+        self.assertEqual([p.n for p in self.annotated('Jan')], [1, 1])
+        self.assertEqual([p.n for p in self.annotated('Joe')], [0, 1])
+        self.assertEqual([p.n for p in self.annotated('Jan')], [1, 1])
+
+    def test_nested_in_subquery(self):
+        self.assertEqual([p.n for p in self.annotated('Joe')], [0, 1])
+
+        inner = self.annotated('Joe').filter(n__gt=0).values('pk')
+        self.assertEqual(list(Parent.objects.filter(pk__in=inner).values_list('name', flat=True)), ['John'])
+
+    def test_nested_in_related_filter(self):
+        inner = Parent.objects.annotate(n=SubqueryCount('da_child')).filter(n__gt=1).values('pk')
+        for _ in range(2):
+            children = Child.objects.filter(parent__in=inner).order_by('name')
+            self.assertEqual(list(children.values_list('name', flat=True)), ['Jan', 'Joe'])
+            children = Child.objects.filter(parent__in=DjangoSubquery(inner)).order_by('name')
+            self.assertEqual(list(children.values_list('name', flat=True)), ['Jan', 'Joe'])
+
+    def test_exists_and_negation(self):
+        parents = Parent.objects.annotate(has_joe=Exists('da_child', filter=Q(name='Joe')),
+                                          no_joe=~Exists('da_child', filter=Q(name='Joe'))).order_by('name')
+
+        for _ in range(2):
+            self.assertEqual([(p.has_joe, p.no_joe) for p in parents.all()], [(False, True), (True, False)])
+
+    def test_cleared_after_migrate(self):
+        list(self.annotated())
+        self.assertEqual(len(fragment_cache), 2)
+
+        app_config = apps.get_app_config('tests')
+        post_migrate.send(sender=app_config, app_config=app_config, verbosity=0, interactive=False,
+                          using='default', plan=[], apps=apps)
+        self.assertEqual(len(fragment_cache), 0)
+
+    def test_off_by_default(self):
+        with self.settings(SQL_UTIL_FRAGMENT_CACHE=False):
+            list(self.annotated())
+
+        self.assertEqual(len(fragment_cache), 0)
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestParentChildFragmentCache(test_subquery.TestParentChild):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestManyToManyFragmentCache(test_subquery.TestManyToMany):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestForeignKeyFragmentCache(test_subquery.TestForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestReverseForeignKeyFragmentCache(test_subquery.TestReverseForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestUpdateFragmentCache(test_subquery.TestUpdate):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestMultipleForeignKeyToTheSameModelFragmentCache(test_subquery.TestMultipleForeignKeyToTheSameModel):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestExistsFragmentCache(test_exists.TestExists):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestManyToManyExistsFragmentCache(test_exists.TestManyToManyExists):
+    pass
+
+
+@override_settings(SQL_UTIL_FRAGMENT_CACHE=True)
+class TestGenericForeignKeyFragmentCache(test_exists.TestGenericForeignKey):
+    pass
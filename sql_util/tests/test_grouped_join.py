@@ -0,0 +1,124 @@
+from django.db import connection
+from django.db.models import DateTimeField, OuterRef, Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from sql_util.tests import test_subquery
+from sql_util.tests.models import Parent, Child, Seller, Store, Sale
+from sql_util.utils import SubqueryCount, SubqueryMax, SubquerySum
+
+
+class TestGroupedJoin(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestGroupedJoin, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-05-01')
+
+    def test_count_is_coalesced(self):
+        parents = Parent.objects.annotate(child_count=SubqueryCount('da_child', strategy='grouped_join'))
+
+        self.assertIn('JOIN', str(parents.query))
+        self.assertEqual({p.name: p.child_count for p in parents}, {'John': 3, 'Jane': 0})
+
+    def test_filter_and_distinct(self):
+        annotation = {
+            'jan_count': SubqueryCount('da_child', filter=Q(name='Jan'), strategy='grouped_join'),
+            'names': SubqueryCount('da_child__name', distinct=True, strategy='grouped_join'),
+        }
+        parents = Parent.objects.annotate(**annotation)
+
+        self.assertEqual({p.name: (p.jan_count, p.names) for p in parents}, {'John': (2, 2), 'Jane': (0, 0)})
+        # Different filters need different derived tables
+        self.assertEqual(str(parents.query).count('JOIN'), 2)
+
+    def test_siblings_share_join(self):
+        annotation = {
+            'child_count': SubqueryCount('da_child', strategy='grouped_join'),
+            'youngest': SubqueryMax('da_child__timestamp', output_field=DateTimeField(), strategy='grouped_join'),
+        }
+        parents = Parent.objects.annotate(**annotation).order_by('name')
+
+        self.assertEqual(str(parents.query).count('JOIN'), 1)
+        self.assertEqual([(p.child_count, p.youngest.month if p.youngest else None) for p in parents],
+                         [(0, None), (3, 7)])
+
+    def test_mixed_strategies(self):
+        parents = Parent.objects.annotate(a=SubqueryCount('da_child', strategy='grouped_join'),
+                                          b=SubqueryCount('da_child'))
+
+        self.assertEqual({p.name: (p.a, p.b) for p in parents}, {'John': (3, 3), 'Jane': (0, 0)})
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            SubquerySum('sale__revenue', strategy='nested_loop')
+
+    def test_outer_ref_in_filter_uses_subquery(self):
+        # The derived table can't refer to the outer row
+        parents = Parent.objects.annotate(
+            younger=SubqueryCount('da_child', filter=Q(name__lt=OuterRef('name')), strategy='grouped_join'))
+
+        self.assertNotIn('JOIN', str(parents.query))
+        self.assertEqual({p.name: p.younger for p in parents}, {'John': 3, 'Jane': 0})
+
+    def test_update_uses_subquery(self):
+        store = Store.objects.create(name='A Store')
+        sellers = [
+            Seller.objects.create(store=store, name='Seller 1'),
+            Seller.objects.create(store=store, name='Seller 2'),
+        ]
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=2.0, expenses=0.0)
+
+        with CaptureQueriesContext(connection) as queries:
+            Seller.objects.update(total_sales=SubqueryCount('sale', strategy='grouped_join'))
+
+        update_sql = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(update_sql), 1)
+        self.assertNotIn('JOIN', update_sql[0])
+        self.assertEqual(list(Seller.objects.order_by('name').values_list('name', 'total_sales')),
+                         [('Seller 1', 2), ('Seller 2', 0)])
+
+
+# The subquery test suite again, with grouped joins as the default strategy
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestParentChildGroupedJoin(test_subquery.TestParentChild):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestManyToManyGroupedJoin(test_subquery.TestManyToMany):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestForeignKeyGroupedJoin(test_subquery.TestForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestReverseForeignKeyGroupedJoin(test_subquery.TestReverseForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestUpdateGroupedJoin(test_subquery.TestUpdate):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestForeignKeyToFieldGroupedJoin(test_subquery.TestForeignKeyToField):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='grouped_join')
+class TestMultipleForeignKeyToTheSameModelGroupedJoin(test_subquery.TestMultipleForeignKeyToTheSameModel):
+    pass
@@ -0,0 +1,74 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Sum, Q
+from django.test import TestCase
+
+from sql_util.indexes import suggest_indexes
+from sql_util.tests.models import Parent, Seller, Author
+from sql_util.utils import (SubqueryCount, SubqueryMax, SubquerySum, SubqueryAggregates, SubqueryLatest,
+                            Exists)
+
+sellers_with_revenue = Seller.objects.annotate(revenue=SubquerySum('sale__revenue', filter=Q(expenses=0)))
+
+
+def indexes(suggestions):
+    return {(app_label, operation.model_name, tuple(operation.index.fields), tuple(operation.index.include))
+            for app_label, operations in suggestions.items() for operation in operations}
+
+
+class TestSuggestIndexes(TestCase):
+
+    def test_foreign_key_index_is_enough(self):
+        self.assertEqual(suggest_indexes(Parent.objects.annotate(n=SubqueryCount('da_child'))), {})
+
+    def test_filter_columns(self):
+        parents = Parent.objects.filter(Exists('da_child', filter=Q(timestamp__gte='2020-01-01',
+                                                                    name='Joe')))
+
+        self.assertEqual(indexes(suggest_indexes(parents)),
+                         {('tests', 'child', ('parent', 'name', 'timestamp'), ())})
+
+    def test_aggregated_column(self):
+        parents = Parent.objects.annotate(last=SubqueryMax('da_child__timestamp'))
+
+        with mock.patch.object(connection.features, 'supports_covering_indexes', True):
+            self.assertEqual(indexes(suggest_indexes(parents)),
+                             {('tests', 'child', ('parent',), ('timestamp',))})
+        with mock.patch.object(connection.features, 'supports_covering_indexes', False):
+            self.assertEqual(indexes(suggest_indexes(parents)),
+                             {('tests', 'child', ('parent', 'timestamp'), ())})
+
+    def test_first_ordering_columns(self):
+        parents = Parent.objects.annotate(latest=SubqueryLatest('da_child__name', ordering='timestamp'))
+
+        with mock.patch.object(connection.features, 'supports_covering_indexes', True):
+            self.assertEqual(indexes(suggest_indexes(parents)),
+                             {('tests', 'child', ('parent', 'timestamp'), ('name',))})
+
+    def test_existing_index(self):
+        sellers = Seller.objects.annotate(n=SubqueryCount('sale', filter=Q(date__gte='2020-01-01')))
+
+        self.assertEqual(suggest_indexes(sellers), {})
+
+    def test_expressions_and_shared_index(self):
+        suggestions = suggest_indexes(SubqueryCount('sale', filter=Q(expenses=0)),
+                                      SubqueryAggregates('sale', filter=Q(expenses=0), total=Sum('revenue'),
+                                                         n=Count('pk')),
+                                      model=Seller)
+
+        self.assertEqual(indexes(suggestions), {('tests', 'sale', ('seller', 'expenses', 'revenue'), ())})
+
+    def test_through_model(self):
+        authors = Author.objects.annotate(n=SubqueryCount('authored_books', strategy='grouped_join'))
+
+        self.assertEqual(indexes(suggest_indexes(authors)), {('tests', 'bookauthor', ('author', 'book'), ())})
+
+    def test_command(self):
+        out = StringIO()
+        call_command('suggest_indexes', 'sql_util.tests.test_indexes.sellers_with_revenue', stdout=out)
+
+        self.assertIn("migrations.AddIndex(\n    model_name='sale',\n", out.getvalue())
+        self.assertIn("fields=['seller', 'expenses', 'revenue']", out.getvalue())
@@ -0,0 +1,93 @@
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+
+from sql_util.instrumentation import instrument, fingerprint, percentiles
+from sql_util.tests.models import Parent, Child
+from sql_util.utils import SubqueryCount, SubqueryMax, Exists
+
+
+class TestInstrumentation(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestInstrumentation, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+
+    def annotated(self, name):
+        return Parent.objects.annotate(n=SubqueryCount('da_child', filter=Q(name=name)),
+                                       last=SubqueryMax('da_child__timestamp', strategy='grouped_join'))
+
+    def test_records_annotations(self):
+        with instrument() as stats:
+            list(self.annotated('Joe'))
+            list(self.annotated('Jan'))
+            list(Parent.objects.all())
+
+        queries = stats.as_dict()
+        self.assertEqual(len(queries), 1)
+        query, = queries.values()
+        self.assertEqual(query['execute']['count'], 2)
+        self.assertEqual(query['params'], 1)
+        self.assertEqual(set(query['annotations']), {'n=SubqueryCount', 'last=JoinedColumn', 'AggregateJoin'})
+
+        annotation = query['annotations']['n=SubqueryCount']
+        self.assertEqual((annotation['annotation'], annotation['expression'], annotation['params']),
+                         ('n', 'SubqueryCount', 1))
+        self.assertEqual(annotation['compile']['count'], 2)
+        self.assertGreater(annotation['compile']['p50'], 0)
+        self.assertGreater(annotation['sql_size'], 0)
+
+    def test_compiled_without_executing(self):
+        with instrument() as stats:
+            str(self.annotated('Joe').query)
+            list(self.annotated('Jan'))
+
+        query, = stats.as_dict().values()
+        self.assertEqual(query['execute']['count'], 1)
+        self.assertEqual({label: annotation['compile']['count'] for label, annotation in query['annotations'].items()},
+                         {'n=SubqueryCount': 1, 'last=JoinedColumn': 1, 'AggregateJoin': 1})
+
+    def test_filter_and_callback(self):
+        recorded = []
+        with instrument(callback=recorded.append):
+            self.assertEqual(list(Parent.objects.filter(Exists('da_child')).values_list('name', flat=True)),
+                             ['John'])
+
+        self.assertEqual(len(recorded), 1)
+        self.assertEqual([a['expression'] for a in recorded[0]['annotations']], ['Exists'])
+
+    def test_all_queries_and_comment(self):
+        with instrument(using='default', all_queries=True, comment=True) as stats:
+            list(Parent.objects.all())
+            with connection.execute_wrapper(self.assert_comment):
+                list(self.annotated('Joe'))
+
+        self.assertEqual(len(stats.as_dict()), 2)
+
+    def assert_comment(self, execute, sql, params, many, context):
+        self.assertTrue(sql.startswith('/* sql_util: AggregateJoin, last=JoinedColumn, n=SubqueryCount */'))
+        return execute(sql, params, many, context)
+
+    def test_inactive(self):
+        with instrument() as stats:
+            pass
+        list(self.annotated('Joe'))
+
+        self.assertEqual(stats.as_dict(), {})
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT a FROM t WHERE b = 'x' AND c IN (%s, %s, %s)"),
+                         fingerprint("SELECT a FROM t WHERE b = 'y' AND c IN (%s)"))
+        self.assertNotEqual(fingerprint('SELECT a FROM t')[0], fingerprint('SELECT b FROM t')[0])
+
+    def test_percentiles(self):
+        summary = percentiles([float(i) for i in range(1, 101)])
+        self.assertEqual((summary['p50'], summary['p90'], summary['p99'], summary['max'], summary['count']),
+                         (50.0, 90.0, 99.0, 100.0, 100))
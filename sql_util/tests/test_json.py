@@ -0,0 +1,78 @@
+from datetime import datetime
+from unittest import mock
+
+from django.db.models import Q
+from django.test import TestCase
+
+from sql_util.tests.models import Parent, Child, Publisher, Book
+from sql_util.aggregates import JSONArrayAgg
+from sql_util.utils import SubqueryJSONAgg
+
+
+class TestJSONAgg(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestJSONAgg, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane'),
+        ]
+        for name, day in [('Joe', 2), ('Jan', 3), ('Jim', 1)]:
+            Child.objects.create(parent=parents[0], name=name, timestamp=datetime(2017, 6, day))
+
+    def test_rows(self):
+        parents = Parent.objects.annotate(
+            children=SubqueryJSONAgg('da_child', fields=['name'], ordering='timestamp')
+        ).order_by('name')
+
+        self.assertIn('json_group_array', str(parents.query))
+        self.assertEqual([(p.name, p.children) for p in parents], [('Jane', []), ('John', [['Jim'], ['Joe'], ['Jan']])])
+
+    def test_ordering_and_limit(self):
+        parents = Parent.objects.filter(name='John').annotate(
+            children=SubqueryJSONAgg('da_child', fields=['name'], ordering='-timestamp', limit=2),
+            filtered=SubqueryJSONAgg('da_child', fields=['name'], filter=Q(name__startswith='Jo')),
+        )
+
+        self.assertEqual(parents.get().children, [['Jan'], ['Joe']])
+        self.assertEqual(parents.get().filtered, [['Joe']])
+
+    def test_ordered_aggregate(self):
+        parents = Parent.objects.annotate(children=SubqueryJSONAgg('da_child', fields=['name'], ordering='-timestamp'))
+
+        with mock.patch.object(JSONArrayAgg, 'supports_ordering', return_value=True):
+            sql = str(parents.query)
+        self.assertIn('json_array("sql_util_json"."sql_util_json_0") ORDER BY "sql_util_json"."sql_util_order_0" DESC)',
+                      sql)
+
+    def test_decode(self):
+        children = Parent.objects.filter(name='John').values_list(
+            SubqueryJSONAgg('da_child', fields=['name', 'timestamp', 'parent'], ordering='name', limit=1,
+                            decode='tuples'), flat=True).get()
+        jan = Child.objects.get(name='Jan')
+        self.assertEqual(children, [('Jan', jan.timestamp, jan.parent_id)])
+
+        children = Parent.objects.filter(name='John').values_list(
+            SubqueryJSONAgg('da_child', fields=['name', 'timestamp'], ordering='name', limit=1, decode='dicts'),
+            flat=True).get()
+        self.assertEqual(children, [{'name': 'Jan', 'timestamp': jan.timestamp}])
+
+    def test_related_fields(self):
+        publisher = Publisher.objects.create(name='Publisher', number=1)
+        Book.objects.create(title='Book', publisher=publisher)
+
+        publishers = Publisher.objects.annotate(books=SubqueryJSONAgg('book', fields=['title', 'publisher__name'],
+                                                                      decode='dicts'))
+        self.assertEqual(publishers.get().books, [{'title': 'Book', 'publisher__name': 'Publisher'}])
+
+    def test_equality(self):
+        self.assertEqual(SubqueryJSONAgg('da_child', fields=['name']), SubqueryJSONAgg('da_child', fields=['name']))
+        self.assertNotEqual(SubqueryJSONAgg('da_child', fields=['name']),
+                            SubqueryJSONAgg('da_child', fields=['name'], limit=1))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SubqueryJSONAgg('da_child')
+        with self.assertRaises(ValueError):
+            SubqueryJSONAgg('da_child', fields=['name'], decode='objects')
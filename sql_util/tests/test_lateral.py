@@ -0,0 +1,102 @@
+from unittest import mock
+
+from django.db import connection
+from django.db.models import Avg, Count, Sum
+from django.test import TestCase, override_settings
+
+from sql_util.tests import test_subquery
+from sql_util.tests.models import Store, Seller, Sale
+from sql_util.utils import SubqueryAggregates, SubqueryCount, SubquerySum
+
+
+class TestLateral(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestLateral, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        sellers = [
+            Seller.objects.create(store=store, name='Seller 1'),
+            Seller.objects.create(store=store, name='Seller 2'),
+        ]
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=2.0, expenses=0.0)
+
+    def sellers(self):
+        return Seller.objects.annotate(n=SubqueryCount('sale', strategy='lateral'),
+                                       total=SubquerySum('sale__revenue', strategy='lateral')).order_by('name')
+
+    def compile(self, queryset, vendor, **attributes):
+        with mock.patch.multiple(connection, vendor=vendor, create=True, **attributes):
+            return queryset.query.get_compiler(connection=connection).as_sql()[0]
+
+    def test_results(self):
+        self.assertEqual([(s.n, s.total) for s in self.sellers()], [(2, 3.0), (0, None)])
+
+    def test_postgresql(self):
+        sql = self.compile(self.sellers(), 'postgresql')
+
+        self.assertEqual(sql.count('LEFT OUTER JOIN LATERAL'), 1)
+        self.assertIn('ON TRUE', sql)
+        self.assertEqual(sql.count('SELECT'), 2)
+
+    def test_mysql(self):
+        sql = self.compile(self.sellers(), 'mysql', mysql_is_mariadb=False, mysql_version=(8, 0, 14))
+        self.assertIn('LATERAL', sql)
+
+        sql = self.compile(self.sellers(), 'mysql', mysql_is_mariadb=False, mysql_version=(8, 0, 13))
+        self.assertNotIn('LATERAL', sql)
+
+        sql = self.compile(self.sellers(), 'mysql', mysql_is_mariadb=True, mysql_version=(10, 6))
+        self.assertNotIn('LATERAL', sql)
+
+    def test_fallback_is_correlated_subquery(self):
+        sql = str(self.sellers().query)
+
+        self.assertNotIn('JOIN', sql)
+        self.assertEqual(sql.count('SELECT'), 3)
+
+    def test_subquery_aggregates(self):
+        aggregates = SubqueryAggregates('sale', strategy='lateral', n=Count('pk'), total=Sum('revenue'),
+                                        avg=Avg('revenue'))
+        sellers = Seller.objects.annotate(**aggregates).order_by('name')
+
+        self.assertEqual([(s.n, s.total, s.avg) for s in sellers], [(2, 3.0, 1.5), (0, None, None)])
+        self.assertEqual(self.compile(sellers, 'postgresql').count('LATERAL'), 1)
+
+
+# The subquery test suite again, with lateral joins as the default strategy
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestParentChildLateral(test_subquery.TestParentChild):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestManyToManyLateral(test_subquery.TestManyToMany):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestForeignKeyLateral(test_subquery.TestForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestReverseForeignKeyLateral(test_subquery.TestReverseForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestUpdateLateral(test_subquery.TestUpdate):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestForeignKeyToFieldLateral(test_subquery.TestForeignKeyToField):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='lateral')
+class TestMultipleForeignKeyToTheSameModelLateral(test_subquery.TestMultipleForeignKeyToTheSameModel):
+    pass
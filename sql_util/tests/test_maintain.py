@@ -0,0 +1,134 @@
+from datetime import date
+from unittest import mock
+
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+
+from sql_util.maintain import maintain_aggregate
+from sql_util.tests.models import Store, Seller, Sale
+from sql_util.utils import SubqueryCount, SubquerySum, SubqueryMax, SubqueryFirst
+
+
+class TestMaintainAggregateSignals(TestCase):
+    backend = 'signals'
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestMaintainAggregateSignals, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        for i in range(3):
+            Seller.objects.create(store=store, name='Seller %d' % i)
+
+    def setUp(self):
+        self.sellers = list(Seller.objects.order_by('name'))
+        self.maintained = [
+            self.maintain(Seller.total_sales, SubqueryCount('sale')),
+            self.maintain(Seller.total_revenue, SubquerySum('sale__revenue')),
+            self.maintain(Seller.last_sale, SubqueryMax('sale__date')),
+        ]
+
+    def maintain(self, field, expression):
+        maintained = maintain_aggregate(field, expression, backend=self.backend)
+        if self.backend == 'triggers':
+            maintained.install()
+            self.addCleanup(maintained.uninstall)
+        else:
+            self.addCleanup(maintained.disconnect)
+        return maintained
+
+    def assertMaintained(self, expected):
+        for maintained in self.maintained:
+            self.assertEqual(maintained.verify(), [], maintained.field.name)
+        self.assertEqual(list(Seller.objects.order_by('name').values_list('total_sales', 'total_revenue',
+                                                                          'last_sale')), expected)
+
+    def sale(self, seller, day, revenue):
+        return Sale.objects.create(seller=self.sellers[seller], date=date(2020, 1, day), revenue=revenue, expenses=0)
+
+    def test_maintain(self):
+        sales = [self.sale(0, 1, 1.0), self.sale(0, 3, 2.0), self.sale(1, 2, 4.0)]
+        self.assertMaintained([(2, 3.0, date(2020, 1, 3)), (1, 4.0, date(2020, 1, 2)), (0, 0, None)])
+
+        # Moving a sale to another seller
+        sales[1].seller = self.sellers[2]
+        sales[1].save()
+        self.assertMaintained([(1, 1.0, date(2020, 1, 1)), (1, 4.0, date(2020, 1, 2)), (1, 2.0, date(2020, 1, 3))])
+
+        sales[2].revenue = 5.0
+        sales[2].save()
+        sales[0].delete()
+        self.assertMaintained([(0, 0, None), (1, 5.0, date(2020, 1, 2)), (1, 2.0, date(2020, 1, 3))])
+
+        Sale.objects.filter(seller=self.sellers[1]).delete()
+        self.assertMaintained([(0, 0, None), (0, 0, None), (1, 2.0, date(2020, 1, 3))])
+
+    def test_filter(self):
+        maintained = self.maintain(Seller.average_revenue, SubqueryCount('sale', filter=Q(revenue__gt=1)))
+        self.assertFalse(maintained.incremental)
+
+        sale = self.sale(0, 1, 1.0)
+        sale.revenue = 2.0
+        sale.save()
+        self.sale(0, 1, 3.0)
+
+        self.assertEqual(maintained.verify(), [])
+        self.assertEqual(Seller.objects.get(pk=self.sellers[0].pk).average_revenue, 2)
+
+    def test_unsupported_expressions(self):
+        with self.assertRaises(ValueError):
+            maintain_aggregate(Store.name, SubqueryCount('seller__sale'))
+        with self.assertRaises(TypeError):
+            maintain_aggregate(Seller.last_sale, SubqueryFirst('sale__date', ordering='date'))
+        with self.assertRaises(ValueError):
+            maintain_aggregate(Seller.total_sales, SubqueryCount('sale'), backend='cron')
+
+    def test_unrelated_update(self):
+        sale = self.sale(0, 1, 1.0)
+        sale.expenses = 1.0
+        with self.assertNumQueries(1 if self.backend == 'triggers' else 1 + len(self.maintained)):
+            # Each signal reads the sale before the UPDATE, and doesn't update
+            # the seller
+            sale.save()
+        with self.assertNumQueries(1):
+            sale.save(update_fields=['expenses'])
+        self.assertMaintained([(1, 1.0, date(2020, 1, 1)), (0, 0, None), (0, 0, None)])
+
+    def test_rebuild(self):
+        sale = self.sale(0, 1, 1.0)
+        Seller.objects.update(total_sales=5, total_revenue=5.0)
+        self.assertEqual(self.maintained[0].verify(), [s.pk for s in self.sellers])
+
+        for maintained in self.maintained:
+            maintained.rebuild()
+        sale.delete()
+        self.assertMaintained([(0, 0, None)] * 3)
+
+
+class TestMaintainAggregateTriggers(TestMaintainAggregateSignals):
+    backend = 'triggers'
+
+    def test_bulk_changes(self):
+        Sale.objects.bulk_create([Sale(seller=seller, date=date(2020, 1, 1), revenue=1.0, expenses=0)
+                                  for seller in self.sellers])
+        Sale.objects.filter(seller=self.sellers[0]).update(seller=self.sellers[1], revenue=2.0)
+
+        self.assertMaintained([(0, 0, None), (2, 3.0, date(2020, 1, 1)), (1, 1.0, date(2020, 1, 1))])
+
+    def test_sql(self):
+        statements = self.maintained[0].install_sql(connection)
+        self.assertEqual(len(statements), 3)
+        self.assertIn('AFTER UPDATE OF "seller_id" ON "tests_sale"', statements[1])
+        self.assertIn('UPDATE "tests_seller" SET "total_sales" = (COALESCE("tests_seller"."total_sales", 0) - 1) '
+                      'WHERE "tests_seller"."id" IN ((OLD."seller_id"))', statements[1])
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            statements = self.maintained[2].install_sql(connection)
+            uninstall = self.maintained[2].uninstall_sql(connection)
+        self.assertEqual(len(statements), 6)
+        self.assertIn('RETURNS trigger', statements[0])
+        self.assertIn('IN ((OLD."seller_id"), (NEW."seller_id"))', statements[2])
+        self.assertIn('EXECUTE FUNCTION "sql_util_tests_seller_last_sale_update"()', statements[3])
+        self.assertEqual(uninstall[:2], ['DROP TRIGGER IF EXISTS "sql_util_tests_seller_last_sale_insert" ON '
+                                         '"tests_sale"',
+                                         'DROP FUNCTION IF EXISTS "sql_util_tests_seller_last_sale_insert"()'])
@@ -12,6 +12,7 @@ DATABASES = {
 
 INSTALLED_APPS = (
     'django.contrib.contenttypes',
+    'sql_util',
     'sql_util.tests',
 )
 
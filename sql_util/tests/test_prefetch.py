@@ -0,0 +1,87 @@
+from unittest import mock
+
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import TestCase
+
+from sql_util.prefetch import prefetch_aggregates
+from sql_util.tests.models import Parent, Child, Store, Seller, Sale, Author, Book, BookAuthor
+from sql_util.utils import SubqueryCount, SubquerySum, SubqueryMax, SubqueryAggregates, SubqueryFirst, Exists
+
+
+class TestPrefetchAggregates(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestPrefetchAggregates, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        sellers = [Seller.objects.create(store=store, name='Seller %d' % i) for i in range(5)]
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=2.0, expenses=0.0)
+        Sale.objects.create(seller=sellers[2], date='2020-01-02', revenue=4.0, expenses=0.0)
+
+    def sellers(self):
+        return list(Seller.objects.order_by('name'))
+
+    def test_aggregates(self):
+        sellers = self.sellers()
+        with self.assertNumQueries(2):
+            result = prefetch_aggregates(sellers,
+                                         n=SubqueryCount('sale'),
+                                         total=SubquerySum('sale__revenue'),
+                                         free=SubqueryCount('sale', filter=Q(expenses=0)),
+                                         **SubqueryAggregates('sale', sales=Count('pk')))
+
+        self.assertIs(result[0], sellers[0])
+        self.assertEqual([(s.n, s.total, s.free, s.sales) for s in sellers],
+                         [(2, 3.0, 1, 2), (0, None, 0, 0), (1, 4.0, 1, 1), (0, None, 0, 0), (0, None, 0, 0)])
+
+    def annotations(self):
+        return {'n': SubqueryCount('sale'), 'last': SubqueryMax('sale__date'), 'has_sales': Exists('sale'),
+                'no_free_sales': ~Exists('sale', filter=Q(expenses=0))}
+
+    def test_same_as_annotations(self):
+        sellers = prefetch_aggregates(self.sellers(), **self.annotations())
+        annotated = Seller.objects.annotate(**self.annotations()).order_by('name')
+
+        names = list(self.annotations())
+        self.assertEqual([[getattr(s, name) for name in names] for s in sellers],
+                         [[getattr(s, name) for name in names] for s in annotated])
+
+    def test_batches(self):
+        sellers = self.sellers()
+        with self.assertNumQueries(3):
+            prefetch_aggregates(sellers, n=SubqueryCount('sale'), batch_size=2)
+        self.assertEqual([s.n for s in sellers], [2, 0, 1, 0, 0])
+
+        sellers = self.sellers()
+        # One param is the filter's
+        with mock.patch.object(connection.features, 'max_query_params', 3), self.assertNumQueries(3):
+            prefetch_aggregates(sellers, n=SubqueryCount('sale', filter=Q(expenses__gte=0)))
+        self.assertEqual([s.n for s in sellers], [2, 0, 1, 0, 0])
+
+    def test_through_foreign_key(self):
+        stores = prefetch_aggregates(Store.objects.all(), revenue=SubquerySum('seller__sale__revenue'))
+
+        self.assertEqual([s.revenue for s in stores], [7.0])
+
+    def test_many_to_many(self):
+        authors = [Author.objects.create(name=name) for name in ('A', 'B')]
+        book = Book.objects.create(title='Book')
+        BookAuthor.objects.create(author=authors[0], book=book)
+
+        prefetch_aggregates(authors, books=SubqueryCount('authored_books'))
+        self.assertEqual([a.books for a in authors], [1, 0])
+
+    def test_no_instances(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(prefetch_aggregates([], n=SubqueryCount('sale')), [])
+
+    def test_unsupported_expression(self):
+        parent = Parent.objects.create(name='John')
+        Child.objects.create(parent=parent, name='Joe', timestamp='2017-06-01')
+
+        with self.assertRaises(TypeError):
+            prefetch_aggregates([parent], first=SubqueryFirst('da_child__name', ordering='timestamp'))
+        with self.assertRaises(TypeError):
+            prefetch_aggregates([parent], has_children=Exists(Child.objects.all()))
@@ -0,0 +1,129 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.db.models import DateTimeField, F, Value
+from django.db.models.functions import Coalesce
+from django.test import TestCase, TransactionTestCase
+
+from sql_util.refresh import refresh_aggregate, IsDistinctFrom
+from sql_util.tests.models import Parent, Child, Store, Seller, Sale
+from sql_util.utils import SubqueryCount, SubqueryAvg
+
+TOTAL_SALES = SubqueryCount('sale')
+
+
+def create_sellers():
+    store = Store.objects.create(name='A Store')
+    for i in range(10):
+        seller = Seller.objects.create(store=store, name='Seller %d' % i)
+        for j in range(i % 3):
+            Sale.objects.create(seller=seller, date='2020-01-01', revenue=i, expenses=0)
+
+
+class TestRefreshAggregate(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestRefreshAggregate, cls).setUpClass()
+        create_sellers()
+
+    def assertRefreshed(self):
+        self.assertEqual(list(Seller.objects.order_by('pk').values_list('total_sales', 'average_revenue')),
+                         list(Seller.objects.order_by('pk').annotate(
+                             n=SubqueryCount('sale'),
+                             avg=Coalesce(SubqueryAvg('sale__revenue'), 0.0)
+                         ).values_list('n', 'avg')))
+
+    def test_refresh(self):
+        chunks = []
+        stats = refresh_aggregate(Seller, chunk_size=4, callback=lambda *chunk: chunks.append(chunk),
+                                  total_sales=SubqueryCount('sale'),
+                                  average_revenue=Coalesce(SubqueryAvg('sale__revenue'), 0.0))
+
+        self.assertEqual(stats, {'chunks': 3, 'updated': 6})
+        pks = list(Seller.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual([chunk[:2] for chunk in chunks], [(pks[0], pks[3]), (pks[4], pks[7]), (pks[8], pks[9])])
+        self.assertRefreshed()
+
+    def test_only_changed_rows(self):
+        refresh_aggregate(Seller, total_sales=SubqueryCount('sale'))
+        Sale.objects.filter(seller__name='Seller 1').delete()
+
+        with self.assertNumQueries(5):
+            # Per chunk a SELECT of the pks, SAVEPOINT, UPDATE and RELEASE,
+            # and the SELECT finding no more rows
+            stats = refresh_aggregate(Seller, total_sales=SubqueryCount('sale'))
+        self.assertEqual(stats, {'chunks': 1, 'updated': 1})
+
+    def test_queryset(self):
+        stats = refresh_aggregate(Seller, queryset=Seller.objects.filter(name='Seller 2'), total_sales=TOTAL_SALES)
+
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(list(Seller.objects.filter(total_sales__gt=0).values_list('name', flat=True)),
+                         ['Seller 2'])
+
+    def test_checkpoint(self):
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        pks = list(Seller.objects.order_by('pk').values_list('pk', flat=True))
+
+        def interrupt(low, high, updated):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            refresh_aggregate(Seller, chunk_size=4, checkpoint=path, callback=interrupt, total_sales=TOTAL_SALES)
+        with open(path) as f:
+            saved = json.load(f)
+        self.assertEqual(saved, {'model': 'tests.Seller', 'fields': ['total_sales'], 'ranges': [[pks[3], None, None]]})
+
+        with self.assertRaises(ValueError):
+            refresh_aggregate(Seller, checkpoint=path, average_revenue=Coalesce(SubqueryAvg('sale__revenue'), 0.0))
+
+        chunks = []
+        refresh_aggregate(Seller, chunk_size=4, checkpoint=path, callback=lambda *chunk: chunks.append(chunk),
+                          total_sales=TOTAL_SALES)
+        self.assertEqual([chunk[:2] for chunk in chunks], [(pks[4], pks[7]), (pks[8], pks[9])])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Seller.objects.filter(total_sales__gt=0).count(), 6)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('refresh_aggregate', 'tests.Seller', 'total_sales=sql_util.tests.test_refresh.TOTAL_SALES',
+                     '--chunk-size', '5', '--verbosity', '2', stdout=stdout)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1], '6 rows updated in 2 chunks.')
+
+    def test_is_distinct_from(self):
+        parent = Parent.objects.create(name='John')
+        Child.objects.create(parent=parent, name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parent, name='Jan', timestamp='2017-06-01',
+                             other_timestamp='2017-06-01')
+        Child.objects.create(parent=parent, name='Jim', timestamp='2017-06-01',
+                             other_timestamp='2017-07-01')
+
+        def distinct(rhs):
+            return sorted(Child.objects.filter(IsDistinctFrom(F('other_timestamp'), rhs))
+                          .values_list('name', flat=True))
+
+        self.assertEqual(distinct(F('timestamp')), ['Jim', 'Joe'])
+        self.assertEqual(distinct(Value(None, output_field=DateTimeField())), ['Jan', 'Jim'])
+
+
+class TestRefreshAggregateWorkers(TransactionTestCase):
+    # The threads' connections must see the rows, which a TestCase's
+    # transaction would hide
+    available_apps = ['sql_util.tests']
+
+    def test_workers(self):
+        create_sellers()
+        chunks = []
+        stats = refresh_aggregate(Seller, chunk_size=2, workers=3, callback=lambda *chunk: chunks.append(chunk),
+                                  total_sales=TOTAL_SALES)
+
+        self.assertEqual(stats, {'chunks': 6, 'updated': 6})
+        self.assertEqual({pk for chunk in chunks for pk in chunk[:2]}, set(Seller.objects.values_list('pk', flat=True)))
+        self.assertEqual(sorted(Seller.objects.values_list('total_sales', flat=True)), [0] * 4 + [1] * 3 + [2] * 3)
@@ -0,0 +1,88 @@
+from django.db.models import Avg, Count, F, Max, Q, QuerySet, Sum
+from django.test import TestCase
+
+from sql_util.rewrite import SubqueryizeMixin, find_rewrites, subqueryize
+from sql_util.tests.models import Author, Book, BookAuthor, BookEditor, Store, Seller, Sale
+
+
+class TestSubqueryize(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryize, cls).setUpClass()
+        authors = [Author.objects.create(name='Author %d' % i) for i in range(1, 4)]
+        books = [Book.objects.create(title='Book %d' % i) for i in range(1, 4)]
+        BookAuthor.objects.create(author=authors[0], book=books[0])
+        BookAuthor.objects.create(author=authors[0], book=books[1])
+        BookAuthor.objects.create(author=authors[1], book=books[2])
+        BookEditor.objects.create(editor=authors[0], book=books[0])
+        BookEditor.objects.create(editor=authors[0], book=books[1])
+        BookEditor.objects.create(editor=authors[0], book=books[2])
+
+        stores = [Store.objects.create(name='Store 1'), Store.objects.create(name='Store 2')]
+        sellers = [Seller.objects.create(store=stores[0], name='Seller %d' % i) for i in range(1, 3)]
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.0)
+        Sale.objects.create(seller=sellers[0], date='2020-01-02', revenue=2.0, expenses=1.0)
+        Sale.objects.create(seller=sellers[1], date='2020-01-03', revenue=4.0, expenses=0.0)
+
+    def test_fan_out(self):
+        # Joining both relations multiplies the rows each count sees
+        authors = Author.objects.annotate(written=Count('authored_books'), edited=Count('edited_books'))
+        self.assertEqual(list(authors.values_list('name', 'written', 'edited')),
+                         [('Author 1', 6, 6), ('Author 2', 1, 0), ('Author 3', 0, 0)])
+
+        rewritten = subqueryize(authors)
+        sql = str(rewritten.query)
+        self.assertNotIn('JOIN', sql)
+        self.assertNotIn('GROUP BY "tests_author"', sql)
+        self.assertEqual(list(rewritten.values_list('name', 'written', 'edited')),
+                         [('Author 1', 2, 3), ('Author 2', 1, 0), ('Author 3', 0, 0)])
+
+    def test_matches_distinct_aggregates(self):
+        stores = Store.objects.annotate(sales=Count('seller__sale', distinct=True),
+                                        revenue=Sum('seller__sale__revenue'),
+                                        best=Max('seller__sale__revenue'),
+                                        average=Avg('seller__sale__revenue'),
+                                        free=Count('seller__sale', filter=Q(seller__sale__expenses=0)),
+                                        costly=Sum('seller__sale__revenue', filter=~Q(seller__sale__expenses=0)))
+        rewrites = find_rewrites(stores)
+
+        self.assertEqual([(rewrite.name, type(rewrite.replacement).__name__) for rewrite in rewrites],
+                         [('sales', 'SubqueryCount'), ('revenue', 'SubquerySum'), ('best', 'SubqueryMax'),
+                          ('average', 'SubqueryAvg'), ('free', 'SubqueryCount'), ('costly', 'SubquerySum')])
+        fields = ['name', 'sales', 'revenue', 'best', 'average', 'free', 'costly']
+        self.assertEqual(list(subqueryize(stores).order_by('name').values(*fields)),
+                         list(stores.order_by('name').values(*fields)))
+
+    def test_filter_on_aggregate(self):
+        stores = subqueryize(Store.objects.annotate(revenue=Sum('seller__sale__revenue')).filter(revenue__gt=1))
+
+        self.assertNotIn('HAVING', str(stores.query))
+        self.assertEqual([(s.name, s.revenue) for s in stores], [('Store 1', 7.0)])
+
+    def test_not_rewritten(self):
+        sellers = (Seller.objects.filter(sale__expenses=0)
+                   .annotate(free=Count('sale'), store_sellers=Count('store__seller'), stores=Count('store')))
+        rewrites = {rewrite.name: rewrite for rewrite in find_rewrites(sellers)}
+
+        self.assertIsNone(rewrites['free'].replacement)
+        self.assertEqual(rewrites['free'].reason, 'the joins are also used by filters or annotations')
+        self.assertIsNotNone(rewrites['store_sellers'].replacement)
+        self.assertEqual(rewrites['stores'].reason, 'the column is not over a multi-valued relation')
+        # Still grouped for the aggregates that are left
+        self.assertEqual(sorted(subqueryize(sellers).values_list('name', 'free', 'store_sellers', 'stores')),
+                         [('Seller 1', 1, 2, 1), ('Seller 2', 1, 2, 1)])
+
+        grouped = Seller.objects.values('store').annotate(n=Count('sale'))
+        self.assertEqual(find_rewrites(grouped)[0].reason, 'the query is grouped by values() without the primary key')
+        self.assertEqual(str(subqueryize(grouped).query), str(grouped.query))
+
+        expression = Store.objects.annotate(n=Sum(F('seller__sale__revenue') - F('seller__sale__expenses')))
+        self.assertEqual(find_rewrites(expression)[0].reason, 'the aggregated expression is not a column')
+
+    def test_mixin(self):
+        class StoreQuerySet(SubqueryizeMixin, QuerySet):
+            pass
+
+        stores = StoreQuerySet(Store).annotate(n=Count('seller__sale')).subqueryize().order_by('name')
+        self.assertEqual([(s.name, s.n) for s in stores], [('Store 1', 3), ('Store 2', 0)])
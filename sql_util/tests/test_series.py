@@ -0,0 +1,88 @@
+from datetime import date, datetime
+
+from django.db.models import Count, Max, Q
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils.timezone import make_aware
+
+from sql_util.tests.models import Parent, Child, Store, Seller, Sale
+from sql_util.utils import SubquerySeries, SubquerySum
+
+
+class TestSeries(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSeries, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        sellers = [Seller.objects.create(store=store, name='Seller %d' % i) for i in range(1, 3)]
+
+        Sale.objects.create(seller=sellers[0], date='2019-12-31', revenue=8.0, expenses=0)
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0)
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=2.0, expenses=0)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=4.0, expenses=1)
+        Sale.objects.create(seller=sellers[0], date='2020-02-10', revenue=16.0, expenses=0)
+
+    def test_days(self):
+        sellers = Seller.objects.annotate(
+            revenue=SubquerySeries('sale__revenue', date_field='date', start=date(2020, 1, 1), end=date(2020, 1, 4))
+        ).order_by('name')
+
+        sql = str(sellers.query)
+        self.assertEqual(sql.count('SELECT'), 3)
+        self.assertIn('django_date_trunc', sql)
+        self.assertEqual([s.revenue for s in sellers], [[3.0, 0, 4.0, 0], [0, 0, 0, 0]])
+
+    def test_matches_filtered_sums(self):
+        days = [date(2020, 1, day) for day in range(1, 4)]
+        series = Seller.objects.filter(name='Seller 1').values_list(
+            SubquerySeries('sale__revenue', date_field='date', start=days[0], end=days[-1], fill=None), flat=True)
+        sums = Seller.objects.filter(name='Seller 1').values_list(
+            *[SubquerySum('sale__revenue', filter=Q(date=day)) for day in days])
+
+        self.assertEqual(tuple(series.get()), sums.get())
+
+    def test_buckets(self):
+        sellers = Seller.objects.filter(name='Seller 1').annotate(
+            months=SubquerySeries('sale', aggregate=Count, bucket='month', start=date(2019, 12, 15),
+                                  end=date(2020, 2, 1), as_dict=True),
+            weeks=SubquerySeries('sale__revenue', aggregate=Max, bucket='week', start=date(2019, 12, 30),
+                                 end=date(2020, 1, 10), filter=Q(expenses=0)),
+        )
+
+        seller = sellers.get()
+        self.assertEqual(seller.months, {date(2019, 12, 1): 1, date(2020, 1, 1): 3, date(2020, 2, 1): 1})
+        self.assertEqual(seller.weeks, [8.0, 0])
+
+    def test_datetimes(self):
+        parent = Parent.objects.create(name='John')
+        for hour in (0, 1, 1, 5):
+            Child.objects.create(parent=parent, name='Child', timestamp=datetime(2020, 1, 1, hour))
+
+        parents = Parent.objects.annotate(children=SubquerySeries(
+            'da_child', aggregate=Count, bucket='hour', date_field='timestamp',
+            start=datetime(2020, 1, 1, 0, 30), end=datetime(2020, 1, 1, 2), as_dict=True))
+
+        self.assertEqual(parents.get().children, {self.aware(datetime(2020, 1, 1, 0)): 1,
+                                                  self.aware(datetime(2020, 1, 1, 1)): 2,
+                                                  self.aware(datetime(2020, 1, 1, 2)): 0})
+
+    @override_settings(USE_TZ=True, TIME_ZONE='Asia/Kolkata')
+    def test_time_zone(self):
+        parent = Parent.objects.create(name='John')
+        for hour in (0, 1, 1, 5):
+            Child.objects.create(parent=parent, name='Child', timestamp=make_aware(datetime(2020, 1, 1, hour)))
+
+        days = Parent.objects.values_list(SubquerySeries(
+            'da_child', aggregate=Count, date_field='timestamp', start=date(2020, 1, 1), end=date(2020, 1, 1),
+            as_dict=True), flat=True).get()
+        self.assertEqual(days, {make_aware(datetime(2020, 1, 1)): 4})
+
+    def aware(self, value):
+        return make_aware(value) if settings.USE_TZ else value
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SubquerySeries('sale__revenue', bucket='decade', start=date(2020, 1, 1), end=date(2020, 1, 1))
+        with self.assertRaises(ValueError):
+            SubquerySeries('sale__revenue', start=date(2020, 1, 1))
@@ -0,0 +1,261 @@
+from unittest import mock
+
+from django.db import DatabaseError, connection
+from django.db.models import OuterRef, Q
+from django.test import TestCase, override_settings
+
+from sql_util.cache import strategy_cache
+from sql_util.tests import test_exists, test_subquery
+from sql_util.tests.models import Parent, Child, Book, Publisher
+from sql_util.utils import SubqueryCount, Exists
+
+
+def always_subquery(shape, candidates):
+    return candidates[0]
+
+
+class TestAutoStrategy(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAutoStrategy, cls).setUpClass()
+        parents = [
+            Parent.objects.create(name='John'),
+            Parent.objects.create(name='Jane')
+        ]
+
+        Child.objects.create(parent=parents[0], name='Joe', timestamp='2017-06-01')
+        Child.objects.create(parent=parents[0], name='Jan', timestamp='2017-07-01')
+
+    def setUp(self):
+        strategy_cache.clear()
+
+    def annotated(self):
+        return Parent.objects.annotate(child_count=SubqueryCount('da_child', strategy='auto')).order_by('name')
+
+    def test_unsliced_uses_grouped_join(self):
+        parents = self.annotated()
+
+        self.assertIn('JOIN', str(parents.query))
+        self.assertEqual([(p.name, p.child_count) for p in parents], [('Jane', 0), ('John', 2)])
+
+    def test_sliced_uses_subquery(self):
+        parents = self.annotated()[:1]
+
+        self.assertNotIn('JOIN', str(parents.query))
+        self.assertEqual([(p.name, p.child_count) for p in parents], [('Jane', 0)])
+
+    @override_settings(SQL_UTIL_TABLE_SIZES={'tests_parent': 10, 'tests_child': 1000000})
+    def test_table_sizes(self):
+        self.assertNotIn('JOIN', str(self.annotated().query))
+
+    @override_settings(SQL_UTIL_TABLE_SIZES={'tests_parent': 1000000, 'tests_child': 1000000})
+    def test_table_sizes_with_slice(self):
+        self.assertIn('JOIN', str(self.annotated().query))
+        self.assertNotIn('JOIN', str(self.annotated()[:10].query))
+
+    def test_unreadable_table_sizes(self):
+        with self.assertLogs('sql_util.strategy', 'WARNING'), \
+                mock.patch.object(connection, 'cursor', side_effect=DatabaseError('permission denied')):
+            sql = str(self.annotated().query)
+
+        self.assertIn('JOIN', sql)
+
+    def test_decision_is_cached(self):
+        for _ in range(3):
+            self.assertEqual([p.child_count for p in self.annotated()], [0, 2])
+
+        info = strategy_cache.info()
+        self.assertEqual((info.misses, info.currsize), (1, 1))
+
+    def test_decision_is_logged(self):
+        with self.assertLogs('sql_util.strategy', 'DEBUG') as logs:
+            list(self.annotated())
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('grouped_join', logs.output[0])
+
+    @override_settings(SQL_UTIL_STRATEGY_CHOOSER='sql_util.tests.test_strategy.always_subquery')
+    def test_chooser(self):
+        parents = self.annotated()
+
+        self.assertNotIn('JOIN', str(parents.query))
+        self.assertEqual([p.child_count for p in parents], [0, 2])
+
+    @override_settings(SQL_UTIL_EXPLAIN_STRATEGY=True)
+    def test_explain_costs(self):
+        costs = {'subquery': 10.0, 'grouped_join': 20.0}
+        with mock.patch('sql_util.strategy.explain_costs', return_value=costs) as explain_costs:
+            self.assertNotIn('JOIN', str(self.annotated().query))
+
+        self.assertEqual(explain_costs.call_count, 1)
+
+    def test_update_uses_subquery(self):
+        Parent.objects.update(name=SubqueryCount('da_child', strategy='auto'))
+
+        self.assertEqual(sorted(Parent.objects.values_list('name', flat=True)), ['0', '2'])
+
+    def test_outer_ref_in_filter_uses_subquery(self):
+        parents = Parent.objects.annotate(
+            younger=SubqueryCount('da_child', filter=Q(name__lt=OuterRef('name')), strategy='auto'))
+
+        self.assertNotIn('JOIN', str(parents.query))
+        self.assertEqual({p.name: p.younger for p in parents}, {'John': 2, 'Jane': 0})
+
+    def test_exists(self):
+        parents = Parent.objects.annotate(has_children=Exists('da_child', strategy='auto')).order_by('name')
+
+        self.assertIn(' IN (SELECT', str(parents.query))
+        self.assertEqual([(p.name, p.has_children) for p in parents], [('Jane', False), ('John', True)])
+
+        parents = parents.all()[:1]
+        self.assertIn('EXISTS', str(parents.query))
+        self.assertEqual([p.has_children for p in parents], [False])
+
+
+class TestSemiJoin(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSemiJoin, cls).setUpClass()
+        publisher = Publisher.objects.create(name='Publisher', number=1)
+        Publisher.objects.create(name='Publisher without books', number=2)
+        Book.objects.create(title='Published', publisher=publisher)
+        Book.objects.create(title='Unpublished')
+
+    def test_negated_with_filter(self):
+        publishers = Publisher.objects.annotate(
+            no_book=~Exists('book', filter=Q(title='Published'), strategy='semi_join')
+        ).order_by('number')
+
+        self.assertIn('NOT IN', str(publishers.query))
+        self.assertEqual([p.no_book for p in publishers], [False, True])
+
+    def test_nullable_outer_column(self):
+        for strategy in ('subquery', 'semi_join', 'anti_join'):
+            books = Book.objects.annotate(published=Exists('publisher', strategy=strategy),
+                                          unpublished=~Exists('publisher', strategy=strategy)).order_by('title')
+
+            self.assertEqual([(b.published, b.unpublished) for b in books], [(True, False), (False, True)])
+            self.assertEqual(list(Book.objects.filter(~Exists('publisher', strategy=strategy))
+                                  .values_list('title', flat=True)), ['Unpublished'])
+
+    def test_invert_keeps_filter(self):
+        publishers = Publisher.objects.annotate(
+            no_book=~Exists('book', filter=Q(title='Unknown'))
+        ).order_by('number')
+
+        self.assertEqual([p.no_book for p in publishers], [True, True])
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            Exists('book', strategy='grouped_join')
+
+    def test_anti_join(self):
+        books = Book.objects.filter(~Exists('publisher', filter=Q(number=1), strategy='anti_join'))
+
+        sql = str(books.query)
+        self.assertIn('LEFT OUTER JOIN (SELECT DISTINCT', sql)
+        self.assertIn('"sql_util_key" IS NULL', sql)
+        self.assertNotIn('EXISTS', sql)
+        self.assertEqual(list(books.values_list('title', flat=True)), ['Unpublished'])
+
+    def test_anti_join_matches_not_exists(self):
+        expressions = [
+            lambda strategy: ~Exists('book', strategy=strategy),
+            lambda strategy: ~Exists('book', filter=Q(title='Published'), strategy=strategy),
+            lambda strategy: ~Exists('book', filter=Q(title='Unknown'), strategy=strategy),
+            lambda strategy: Exists('book', strategy=strategy),
+            lambda strategy: ~Exists('book', strategy=strategy) | Q(number=1),
+        ]
+        for expression in expressions:
+            expected = list(Publisher.objects.filter(expression('subquery')).order_by('number'))
+            for strategy in ('semi_join', 'anti_join'):
+                self.assertEqual(list(Publisher.objects.filter(expression(strategy)).order_by('number')), expected)
+
+    def test_anti_join_outer_ref_uses_subquery(self):
+        publishers = Publisher.objects.filter(~Exists('book', filter=Q(title__lt=OuterRef('name')),
+                                                      strategy='anti_join'))
+
+        self.assertNotIn('JOIN', str(publishers.query))
+        self.assertEqual(list(publishers.values_list('name', flat=True)), ['Publisher without books'])
+
+    def test_anti_join_shared(self):
+        # Both conditions are on the same relation, which is joined once
+        books = Book.objects.filter(~Exists('publisher', strategy='anti_join')).annotate(
+            published=Exists('publisher', strategy='anti_join'))
+
+        self.assertEqual(str(books.query).count('LEFT OUTER JOIN'), 1)
+        self.assertEqual([b.published for b in books], [False])
+
+    def test_anti_join_update(self):
+        # Joins aren't allowed in UPDATE, the semi-join is used instead
+        Publisher.objects.filter(~Exists('book', strategy='anti_join')).update(name='No books')
+
+        self.assertEqual(list(Publisher.objects.order_by('number').values_list('name', flat=True)),
+                         ['Publisher', 'No books'])
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='auto')
+class TestParentChildAuto(test_subquery.TestParentChild):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='auto')
+class TestManyToManyAuto(test_subquery.TestManyToMany):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='auto')
+class TestReverseForeignKeyAuto(test_subquery.TestReverseForeignKey):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_STRATEGY='auto')
+class TestUpdateAuto(test_subquery.TestUpdate):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='semi_join')
+class TestExistsSemiJoin(test_exists.TestExists):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='semi_join')
+class TestExistsFilterSemiJoin(test_exists.TestExistsFilter):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='semi_join')
+class TestManyToManyExistsSemiJoin(test_exists.TestManyToManyExists):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='semi_join')
+class TestExistsReverseNamesSemiJoin(test_exists.TestExistsReverseNames):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='anti_join')
+class TestExistsAntiJoin(test_exists.TestExists):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='anti_join')
+class TestExistsFilterAntiJoin(test_exists.TestExistsFilter):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='anti_join')
+class TestManyToManyExistsAntiJoin(test_exists.TestManyToManyExists):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='anti_join')
+class TestExistsReverseNamesAntiJoin(test_exists.TestExistsReverseNames):
+    pass
+
+
+@override_settings(SQL_UTIL_DEFAULT_EXISTS_STRATEGY='auto')
+class TestGenericForeignKeyAuto(test_exists.TestGenericForeignKey):
+    pass
@@ -1,5 +1,8 @@
+from unittest import mock
+
 from django.conf import settings
 from django.db.models import DateTimeField, Q
+from django.db.models.sql import Query
 from django.db.models.functions import Coalesce, Cast
 from django.test import TestCase
 
@@ -417,3 +420,25 @@ class TestMultipleForeignKeyToTheSameModel(TestCase):
         for g in games:
             self.assertEqual(g.team1_count, g.team1.players.count())
             self.assertEqual(g.team2_count, g.team2.players.count())
+
+
+class TestResolution(TestCase):
+
+    def test_outer_query_not_cloned(self):
+        queryset = Parent.objects.filter(name__startswith='J').filter(da_child__name='Joe')
+        annotations = {'count_%d' % i: SubqueryCount('da_child') for i in range(5)}
+
+        original_clone = Query.clone
+        outer_clones = []
+
+        def clone(query):
+            if query.model is Parent:
+                outer_clones.append(query)
+            return original_clone(query)
+
+        with mock.patch.object(Query, 'clone', clone):
+            queryset = queryset.annotate(**annotations)
+
+        # Only the clone made by annotate() itself
+        self.assertEqual(len(outer_clones), 1)
+        self.assertEqual(list(queryset), [])
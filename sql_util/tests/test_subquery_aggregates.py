@@ -0,0 +1,133 @@
+from datetime import date
+
+from django.db import connection
+from django.db.models import Count, Sum, Avg, Max, OuterRef, Q
+from django.test import TestCase
+
+from sql_util.tests.models import Store, Seller, Sale, Author, Book, BookAuthor
+from sql_util.utils import SubqueryAggregates, SubqueryPivot, SubqueryCount, SubquerySum, SubqueryAvg
+
+
+class TestSubqueryAggregates(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryAggregates, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+
+        sellers = [
+            Seller.objects.create(store=store, name='Seller 1'),
+            Seller.objects.create(store=store, name='Seller 2'),
+            Seller.objects.create(store=store, name='Seller 3'),
+        ]
+
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=2.0, expenses=0.0)
+        Sale.objects.create(seller=sellers[0], date='2020-01-06', revenue=6.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[1], date='2020-01-08', revenue=1.5, expenses=0.5)
+
+    def test_single_join(self):
+        aggregates = SubqueryAggregates('sale', n=Count('pk'), total=Sum('revenue'), avg=Avg('revenue'))
+        sellers = Seller.objects.annotate(**aggregates).order_by('name')
+
+        self.assertEqual(str(sellers.query).count('JOIN'), 1)
+        self.assertEqual([(s.name, s.n, s.total, s.avg) for s in sellers],
+                         [('Seller 1', 3, 9.0, 3.0),
+                          ('Seller 2', 1, 1.5, 1.5),
+                          ('Seller 3', 0, None, None)])
+
+    def test_matches_subquery_aggregates(self):
+        separate = Seller.objects.annotate(n=SubqueryCount('sale'),
+                                           total=SubquerySum('sale__revenue'),
+                                           avg=SubqueryAvg('sale__revenue')).order_by('name')
+        fused = Seller.objects.annotate(**SubqueryAggregates('sale', n=Count('pk'), total=Sum('revenue'),
+                                                             avg=Avg('revenue'))).order_by('name')
+
+        self.assertEqual(list(separate.values('name', 'n', 'total', 'avg')),
+                         list(fused.values('name', 'n', 'total', 'avg')))
+
+    def test_filter_and_aggregate_filter(self):
+        aggregates = SubqueryAggregates('sale', filter=Q(revenue__gt=1),
+                                        n=Count('pk'),
+                                        profitable=Count('pk', filter=Q(expenses=0)),
+                                        best=Max('revenue'))
+        sellers = Seller.objects.annotate(**aggregates).order_by('name')
+
+        self.assertEqual([(s.n, s.profitable, s.best) for s in sellers],
+                         [(2, 1, 6.0), (1, 0, 1.5), (0, 0, None)])
+
+    def test_outer_ref_uses_subqueries(self):
+        Seller.objects.filter(name='Seller 1').update(average_revenue=1.5)
+        aggregates = SubqueryAggregates('sale', filter=Q(revenue__gt=OuterRef('average_revenue')),
+                                        n=Count('pk'),
+                                        profitable=Count('pk', filter=Q(expenses__lt=OuterRef('average_revenue'))))
+        sellers = Seller.objects.annotate(**aggregates).order_by('name')
+
+        self.assertNotIn('JOIN', str(sellers.query))
+        self.assertEqual([(s.n, s.profitable) for s in sellers], [(2, 2), (1, 0), (0, 0)])
+
+    def test_filter_and_order_by_aggregate(self):
+        sellers = (Seller.objects.annotate(**SubqueryAggregates('sale', n=Count('pk'), total=Sum('revenue')))
+                   .filter(n__gt=0)
+                   .order_by('-total'))
+
+        self.assertEqual([s.name for s in sellers], ['Seller 1', 'Seller 2'])
+
+    def test_chained_annotations_share_join(self):
+        sellers = (Seller.objects.annotate(**SubqueryAggregates('sale', n=Count('pk')))
+                   .annotate(**SubqueryAggregates('sale', total=Sum('revenue')))
+                   .order_by('name'))
+
+        self.assertEqual(str(sellers.query).count('JOIN'), 1)
+        self.assertEqual([(s.n, s.total) for s in sellers], [(3, 9.0), (1, 1.5), (0, None)])
+
+    def test_update(self):
+        Seller.objects.update(**SubqueryAggregates('sale', total_sales=Count('pk')))
+
+        self.assertEqual(list(Seller.objects.values_list('name', 'total_sales').order_by('name')),
+                         [('Seller 1', 3), ('Seller 2', 1), ('Seller 3', 0)])
+
+    def test_pivot(self):
+        pivot = SubqueryPivot('sale', by='expenses', values=[0.0, 0.5])
+        sellers = Seller.objects.annotate(**pivot).order_by('name')
+
+        sql = str(sellers.query)
+        self.assertEqual(sql.count('JOIN'), 1)
+        self.assertIn('FILTER (WHERE' if connection.features.supports_aggregate_filter_clause else 'CASE WHEN', sql)
+        self.assertEqual(list(sellers.values_list('expenses_0.0', 'expenses_0.5')), [(1, 2), (0, 1), (0, 0)])
+
+    def test_pivot_matches_filtered_counts(self):
+        days = {'first': date(2020, 1, 1), 'third': date(2020, 1, 3), 'eighth': date(2020, 1, 8)}
+        separate = Seller.objects.annotate(**{name: SubqueryCount('sale', filter=Q(date=day))
+                                              for name, day in days.items()}).order_by('name')
+        pivoted = Seller.objects.annotate(**SubqueryPivot('sale', by='date', values=days)).order_by('name')
+
+        self.assertEqual(list(separate.values(*days)), list(pivoted.values(*days)))
+
+    def test_pivot_aggregate(self):
+        for strategy in ('grouped_join', 'lateral', 'subquery'):
+            pivot = SubqueryPivot('sale', by='expenses', values={'free': 0.0, 'paid': 0.5}, aggregate=Sum,
+                                  field='revenue', filter=Q(revenue__gt=1), strategy=strategy)
+            sellers = Seller.objects.annotate(**pivot).order_by('name')
+
+            self.assertEqual([(s.free, s.paid) for s in sellers], [(2.0, 6.0), (None, 1.5), (None, None)])
+
+
+class TestSubqueryAggregatesManyToMany(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubqueryAggregatesManyToMany, cls).setUpClass()
+        authors = [Author.objects.create(name='Author %d' % i) for i in range(1, 4)]
+        books = [Book.objects.create(title='Book %d' % i) for i in range(1, 3)]
+
+        BookAuthor.objects.create(author=authors[0], book=books[0])
+        BookAuthor.objects.create(author=authors[1], book=books[0])
+        BookAuthor.objects.create(author=authors[1], book=books[1])
+
+    def test_reverse_m2m(self):
+        authors = Author.objects.annotate(**SubqueryAggregates('authored_books', n=Count('pk'),
+                                                               last_title=Max('title'))).order_by('name')
+
+        self.assertEqual([(a.name, a.n, a.last_title) for a in authors],
+                         [('Author 1', 1, 'Book 1'), ('Author 2', 2, 'Book 2'), ('Author 3', 0, None)])
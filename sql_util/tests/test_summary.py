@@ -0,0 +1,98 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+
+from sql_util.summary import Summary
+from sql_util.tests.models import Store, Seller, Sale
+from sql_util.utils import SubqueryCount, SubquerySum
+
+
+class TestSummary(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSummary, cls).setUpClass()
+        store = Store.objects.create(name='A Store')
+        sellers = [Seller.objects.create(store=store, name='Seller %d' % i) for i in range(3)]
+        Sale.objects.create(seller=sellers[0], date='2020-01-01', revenue=1.0, expenses=0.5)
+        Sale.objects.create(seller=sellers[0], date='2020-01-03', revenue=2.0, expenses=0.0)
+        Sale.objects.create(seller=sellers[2], date='2020-01-02', revenue=4.0, expenses=0.0)
+
+    def setUp(self):
+        self.summary = Summary(Seller, revenue=SubquerySum('sale__revenue'), sales=SubqueryCount('sale'))
+        self.summary.create()
+        self.addCleanup(self.summary.drop)
+
+    def values(self, queryset):
+        return list(queryset.order_by('name').values_list('name', 'revenue', 'sales'))
+
+    def test_refresh(self):
+        computed = [('Seller 0', 3.0, 2), ('Seller 1', None, 0), ('Seller 2', 4.0, 1)]
+        queryset = self.summary.annotate(Seller.objects.all())
+        self.assertNotIn('tests_seller_summary', str(queryset.query))
+        self.assertEqual(self.values(queryset), computed)
+
+        self.summary.refresh()
+        queryset = self.summary.annotate(Seller.objects.all())
+        self.assertIn('LEFT OUTER JOIN "tests_seller_summary" ON ("tests_seller"."id" = '
+                      '"tests_seller_summary"."sql_util_key")', str(queryset.query))
+        self.assertNotIn('tests_sale', str(queryset.query))
+        self.assertEqual(self.values(queryset), computed)
+
+        # The summary isn't updated until the next refresh
+        Sale.objects.filter(seller__name='Seller 0').delete()
+        self.assertEqual(self.values(self.summary.annotate(Seller.objects.all())), computed)
+
+    def test_incremental_refresh(self):
+        self.summary.refresh()
+        seller = Seller.objects.get(name='Seller 1')
+        Sale.objects.create(seller=seller, date='2020-01-04', revenue=8.0, expenses=0.0)
+        Sale.objects.filter(seller__name='Seller 0').delete()
+        Seller.objects.create(store=seller.store, name='Seller 3')
+
+        with self.assertNumQueries(6):
+            # SAVEPOINT, DELETE and INSERT of the summary rows and of the
+            # refresh time, RELEASE
+            self.summary.refresh(Seller.objects.filter(pk=seller.pk))
+
+        queryset = self.summary.annotate(Seller.objects.filter(name__gt='Seller 0'), names=['sales'])
+        self.assertEqual(list(queryset.order_by('name').values_list('name', 'sales')),
+                         [('Seller 1', 1), ('Seller 2', 1), ('Seller 3', 0)])
+
+    def test_max_age(self):
+        self.assertFalse(self.summary.is_fresh())
+        self.summary.refresh()
+
+        self.assertTrue(self.summary.is_fresh())
+        self.assertTrue(self.summary.is_fresh(timedelta(hours=1)))
+        with mock.patch('time.time', return_value=self.summary.refreshed_at() + 7200):
+            self.assertFalse(self.summary.is_fresh(timedelta(hours=1)))
+            self.assertNotIn('tests_seller_summary', str(self.summary.annotate(Seller.objects.all(),
+                                                                              max_age=3600).query))
+
+    def test_filter_and_order_by(self):
+        self.summary.refresh()
+        queryset = self.summary.annotate(Seller.objects.all()).filter(sales__gt=0).order_by('-revenue')
+
+        self.assertEqual([s.name for s in queryset], ['Seller 2', 'Seller 0'])
+
+    def test_materialized_view(self):
+        summary = Summary(Seller, table='seller_totals', materialized_view=True, sales=SubqueryCount('sale'))
+        statements = []
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.execute.side_effect = lambda sql, params=None: statements.append(sql)
+        cursor.__enter__.return_value.fetchone.return_value = None
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor', return_value=cursor):
+            summary.create()
+            summary.refresh()
+
+        statements = [sql for sql in statements if 'SAVEPOINT' not in sql]
+        self.assertTrue(statements[0].startswith('CREATE MATERIALIZED VIEW "seller_totals" AS SELECT '
+                                                 '"tests_seller"."id" AS "sql_util_key", COALESCE((SELECT COUNT'))
+        self.assertTrue(statements[0].endswith(' WITH NO DATA'))
+        self.assertEqual(statements[1], 'CREATE UNIQUE INDEX "seller_totals_key" ON "seller_totals" ("sql_util_key")')
+        self.assertEqual(statements[4], 'REFRESH MATERIALIZED VIEW "seller_totals"')
@@ -1 +1,3 @@
-from sql_util.aggregates import SubqueryAggregate, SubqueryCount, SubqueryAvg, SubqueryMax, SubqueryMin, SubquerySum, Exists
\ No newline at end of file
+from sql_util.aggregates import (SubqueryAggregate, SubqueryCount, SubqueryAvg, SubqueryMax, SubqueryMin, SubquerySum,
+                                 SubqueryAggregates, SubqueryPivot, SubqueryFirst, SubqueryLatest, SubqueryJSONAgg,
+                                 SubquerySeries, Exists, decode_json_rows)